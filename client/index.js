@@ -206,9 +206,13 @@
             }, 5000);
         };
         lWebsocketConnection.onmessage = function(pEvent) {
+            // The server sends batches of messages as an array
             const lMessageData = JSON.parse(pEvent.data);
             console.log('Received message from the socket connection', lMessageData);
-            onUpdateMessageReceived(lMessageData);
+            const lMessageList = Array.isArray(lMessageData) ? lMessageData : [ lMessageData ];
+            lMessageList.forEach(function(pMessage) {
+                onUpdateMessageReceived(pMessage);
+            });
         };
         lWebsocketConnection.onerror = function(pEvent) {
             console.error('Encountered error in websocket', pEvent);
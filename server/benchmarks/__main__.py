@@ -0,0 +1,136 @@
+'''
+Runs the benchmark suite and writes the results as JSON, so that runs can be compared.
+
+Run from the server directory:
+    python -m benchmarks --output results.json
+    python -m benchmarks --only gcode engine --compare baseline.json --tolerance 0.2
+
+With --compare, every latency ('...Ms') that grew and every rate ('...PerSecond') that
+dropped by more than the tolerance is reported, and the exit code is 1.
+'''
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import sys
+import time
+import traceback
+
+def runGCode():
+    from benchmarks import gcode_roundtrip
+    return gcode_roundtrip.run(2000)
+
+def runEngine():
+    from benchmarks import engine_transitions
+    return engine_transitions.run(2000)
+
+def runMqtt():
+    from benchmarks import mqtt_load
+    return {
+        'throughput': mqtt_load.runThroughput(50000),
+        'steadyRate': mqtt_load.run(rate=2000, durationSeconds=3)
+    }
+
+def runNotifier():
+    from benchmarks import notifier_latency
+    return notifier_latency.run(count=500, intervalSeconds=0.002, clientCount=4)
+
+def runRest():
+    from benchmarks import rest_latency
+    return rest_latency.run(200)
+
+def runParsing():
+    from benchmarks import reply_parsing
+    return reply_parsing.run(100000)
+
+BENCHMARKS = [
+    ('gcode', runGCode),
+    ('engine', runEngine),
+    ('mqtt', runMqtt),
+    ('notifier', runNotifier),
+    ('rest', runRest),
+    ('parsing', runParsing)
+]
+
+def flatten(results, prefix=''):
+    ''' Flattens nested results to { 'benchmark.path.key': value } '''
+    values = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            values.update(flatten(value, path + '.'))
+        else:
+            values[path] = value
+    return values
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the regressions of 'results' against 'baseline', as a list of
+    (path, baselineValue, value). Values missing on either side are ignored.
+    '''
+    current = flatten(results)
+    regressions = []
+    for path, baselineValue in sorted(flatten(baseline).items()):
+        value = current.get(path)
+        if not isinstance(value, (int, float)) or not isinstance(baselineValue, (int, float)) or baselineValue <= 0:
+            continue
+
+        if path.endswith('Ms') and value > baselineValue * (1 + tolerance):
+            regressions.append((path, baselineValue, value))
+        elif path.endswith('PerSecond') and value < baselineValue * (1 - tolerance):
+            regressions.append((path, baselineValue, value))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='MachineApp control stack benchmarks')
+    parser.add_argument('--only', nargs='+', choices=[ name for name, _ in BENCHMARKS ], help='Benchmarks to run (all by default)')
+    parser.add_argument('--output', default=None, help='File to write the JSON results to (stdout by default)')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative change allowed before a value counts as a regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {},
+        'errors': {}
+    }
+
+    for name, benchmark in BENCHMARKS:
+        if args.only != None and not name in args.only:
+            continue
+
+        print('Running {}...'.format(name), file=sys.stderr)
+        try:
+            with contextlib.redirect_stdout(sys.stderr):     # Keeps stdout for the results
+                report['results'][name] = benchmark()
+        except Exception:
+            report['errors'][name] = traceback.format_exc()
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output != None:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output)
+    else:
+        print(output)
+
+    exitCode = 1 if len(report['errors']) > 0 else 0
+    if args.compare != None:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+
+        regressions = compare(report['results'], baseline['results'], args.tolerance)
+        for path, baselineValue, value in regressions:
+            print('Regression on {}: {:.4f} -> {:.4f}'.format(path, baselineValue, value), file=sys.stderr)
+        if len(regressions) > 0:
+            exitCode = 1
+
+    return exitCode
+
+if __name__ == '__main__':
+    sys.exit(main())
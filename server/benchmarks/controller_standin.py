@@ -0,0 +1,66 @@
+'''
+Local HTTP stand-in for the g-code endpoint of a MachineMotion controller (port 8000),
+so that GCode.__emit__ can be exercised without hardware. Every line is acknowledged the
+way the controller does; M114, M119 and V0 get plausible replies.
+'''
+import threading
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ControllerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'           # Keep-alive, like the controller
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        gCode = query.get('gcode', [ '' ])[0]
+        self.server.standIn.onLine(gCode)
+        self.__reply(self.server.standIn.replyTo(gCode))
+
+    def __reply(self, body):
+        body = body.encode('utf-8')
+        # Headers and body go out in a single write, otherwise delayed ACKs stall every request
+        head = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n\r\n'.format(len(body)).encode('ascii')
+        self.wfile.write(head + body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ControllerStandIn:
+    def __init__(self, host='127.0.0.1', port=8000):
+        self.host = host
+        self.port = port
+        self.receivedLines = []
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    def start(self):
+        self.__server = ThreadingHTTPServer((self.host, self.port), ControllerRequestHandler)
+        self.__server.standIn = self
+        thread = threading.Thread(name='ControllerStandIn', target=self.__server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.__server != None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def onLine(self, gCode):
+        with self.__lock:
+            self.receivedLines.append(gCode)
+
+    def replyTo(self, gCode):
+        if gCode == 'M114':
+            return 'echo:M114\nX:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0\nok\n'
+        if gCode == 'M119':
+            return 'echo:M119\nx_min: open \nx_max: open \ny_min: open \ny_max: open \nz_min: open \nz_max: open \nok\n'
+        if gCode == 'V0':
+            return 'echo:V0\nCOMPLETED\nok\n'
+        return 'echo:{}\nok\n'.format(gCode)
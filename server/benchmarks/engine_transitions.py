@@ -0,0 +1,124 @@
+'''
+Measures state transition latency in BaseMachineAppEngine.loop: the time between a
+gotoState request made from a state's update and the onEnter of the next state.
+
+The engine runs against the fake MachineMotion on a discrete clock and an in-process
+MQTT broker, so only the engine itself is measured.
+
+Run from the server directory:
+    python -m benchmarks.engine_transitions --count 2000
+'''
+import argparse
+import json
+import logging
+import threading
+import time
+import internal.mqtt_hub as mqtt_hub
+import internal.notifier as notifier
+from benchmarks.fake_mqtt import FakeBroker
+from benchmarks.stats import summarize
+from internal.base_machine_app import BaseMachineAppEngine, MachineAppState
+
+class NullNotifier:
+    ''' Stands in for the global Notifier, so that the websocket server is not measured '''
+    def sendMessage(self, level, message, customPayload=None, coalesceKey=None):
+        pass
+
+    def setDead(self):
+        pass
+
+class PingPongState(MachineAppState):
+    ''' Requests a transition to the other state on its first update, and records when it is entered '''
+    def __init__(self, engine, nextState):
+        super(PingPongState, self).__init__(engine)
+        self.nextState = nextState
+
+    def onEnter(self):
+        self.engine.onStateEntered()
+
+    def update(self):
+        self.engine.requestTransition(self.nextState)
+
+class BenchmarkEngine(BaseMachineAppEngine):
+    def __init__(self, transitionCount):
+        super(BenchmarkEngine, self).__init__()
+        self.transitionCount = transitionCount
+        self.latencies = []
+        self.doneEvent = threading.Event()
+        self.__requestedAt = None
+
+    def initialize(self):
+        from internal.fake_machine_motion import MachineMotion
+        from internal.motion_simulator import MotionSimulator, VirtualClock
+        self.machineMotion = MachineMotion('fake-broker', MotionSimulator(VirtualClock(None)))
+
+    def getDefaultState(self):
+        return 'Ping'
+
+    def buildStateDictionary(self):
+        return {
+            'Ping': PingPongState(self, 'Pong'),
+            'Pong': PingPongState(self, 'Ping')
+        }
+
+    def getMasterMachineMotion(self):
+        return self.machineMotion
+
+    def beforeRun(self):
+        pass
+
+    def afterRun(self):
+        pass
+
+    def onStop(self):
+        pass
+
+    def onPause(self):
+        pass
+
+    def requestTransition(self, state):
+        self.__requestedAt = time.perf_counter()
+        self.gotoState(state)
+
+    def onStateEntered(self):
+        if self.__requestedAt == None:
+            return                          # Default state, entered on start
+
+        self.latencies.append(time.perf_counter() - self.__requestedAt)
+        self.__requestedAt = None
+        if len(self.latencies) == self.transitionCount:
+            self.doneEvent.set()
+
+def setUpEngineEnvironment():
+    ''' Routes MQTT to an in-process broker and silences the notifier '''
+    mqtt_hub.setMqttClientFactory(FakeBroker().createClient)
+    notifier.globalNotifier = NullNotifier()
+
+def run(count=2000, timeoutSeconds=60):
+    setUpEngineEnvironment()
+    engine = BenchmarkEngine(count)
+    thread = threading.Thread(name='BenchmarkEngine', target=engine.loop)
+    thread.daemon = True
+    thread.start()
+
+    startTime = time.perf_counter()
+    engine.start(False, {})
+    completed = engine.doneEvent.wait(timeoutSeconds)
+    duration = time.perf_counter() - startTime
+
+    engine.stop()
+    engine.kill()
+
+    latencies = engine.latencies[:count]
+    result = summarize(latencies)
+    result['completed'] = completed
+    result['transitionsPerSecond'] = len(latencies) / duration
+    return result
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='MachineApp engine state transition latency')
+    parser.add_argument('--count', type=int, default=2000, help='Number of transitions to measure')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count), indent=4))
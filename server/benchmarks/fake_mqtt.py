@@ -0,0 +1,212 @@
+'''
+In-process MQTT broker stand-in, for load testing the MQTT consumers of the server
+without a controller.
+
+    broker = FakeBroker()
+    mqtt_hub.setMqttClientFactory(broker.createClient)
+
+Every hub created after that talks to the fake broker. Like paho, each client delivers
+its messages on its own network thread; the queue in front of that thread is bounded,
+and messages that do not fit are dropped and counted.
+'''
+import itertools
+import queue
+import threading
+import time
+from internal.topic_trie import TopicTrie
+
+class FakeMessage:
+    ''' Same attributes as paho.mqtt.client.MQTTMessage '''
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = time.perf_counter()
+
+class FakeMessageInfo:
+    ''' Same interface as paho.mqtt.client.MQTTMessageInfo, always published '''
+    def __init__(self, mid):
+        self.rc = 0
+        self.mid = mid
+
+    def wait_for_publish(self):
+        pass
+
+    def is_published(self):
+        return True
+
+class FakeClient:
+    '''
+    Implements the part of the paho client interface used by the server: callbacks,
+    connect/disconnect, loop_start/loop_stop, subscribe/unsubscribe and publish.
+    '''
+    STOP = object()
+
+    def __init__(self, broker, maxQueuedMessages):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.droppedCount = 0
+
+        self.__broker = broker
+        self.__inbox = queue.Queue(maxsize=maxQueuedMessages)
+        self.__thread = None
+        self.__isConnected = False
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.__broker.attach(self)
+        self.__isConnected = True
+        return 0
+
+    def disconnect(self):
+        self.__broker.detach(self)
+        self.__isConnected = False
+        self.__inbox.put(FakeClient.STOP)
+        return 0
+
+    def loop_start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(name='FakeMqttClient', target=self.__loop)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def loop_stop(self, force=False):
+        self.__inbox.put(FakeClient.STOP)
+
+    def subscribe(self, topic, qos=0):
+        return (0, self.__broker.subscribe(self, topic))
+
+    def unsubscribe(self, topic):
+        return (0, self.__broker.unsubscribe(self, topic))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return FakeMessageInfo(self.__broker.publish(topic, payload, qos, retain))
+
+    def is_connected(self):
+        return self.__isConnected
+
+    def deliver(self, message):
+        ''' Called by the broker. Returns False if the message was dropped. '''
+        try:
+            self.__inbox.put_nowait(message)
+            return True
+        except queue.Full:
+            self.droppedCount += 1
+            return False
+
+    def __loop(self):
+        if self.on_connect is not None and self.__isConnected:
+            self.on_connect(self, None, {}, 0)
+
+        while True:
+            message = self.__inbox.get()
+            if message is FakeClient.STOP:
+                break
+
+            if self.on_message is not None:
+                self.on_message(self, None, message)
+
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+        self.__thread = None
+
+class FakeBroker:
+    '''
+    Routes published messages to the subscribed FakeClients, with wildcard matching and
+    retained messages. Keeps counts of published, delivered and dropped messages.
+    '''
+
+    def __init__(self, maxQueuedMessagesPerClient=10000):
+        self.maxQueuedMessagesPerClient = maxQueuedMessagesPerClient
+        self.__lock = threading.Lock()
+        self.__clients = []
+        self.__subscriptions = TopicTrie()          # Topic filter -> clients
+        self.__clientFilters = {}                   # Client -> topic filters it subscribed to
+        self.__retained = {}                        # Topic -> FakeMessage
+        self.__mids = itertools.count(1)
+
+        self.publishedCount = 0
+        self.deliveredCount = 0
+        self.droppedCount = 0
+
+    def createClient(self, *args, **kwargs):
+        ''' Client factory, with the same signature as paho.mqtt.client.Client '''
+        return FakeClient(self, self.maxQueuedMessagesPerClient)
+
+    def attach(self, client):
+        with self.__lock:
+            if not client in self.__clients:
+                self.__clients.append(client)
+
+    def detach(self, client):
+        with self.__lock:
+            if client in self.__clients:
+                self.__clients.remove(client)
+            for topicFilter in self.__clientFilters.pop(client, []):
+                self.__subscriptions.remove(topicFilter, client)
+
+    def subscribe(self, client, topicFilter):
+        with self.__lock:
+            self.__subscriptions.add(topicFilter, client)
+            self.__clientFilters.setdefault(client, []).append(topicFilter)
+            topicParts = topicFilter.split('/')
+            retained = [ message for topic, message in self.__retained.items() if self.__filterMatches(topicParts, topic.split('/')) ]
+
+        for message in retained:
+            client.deliver(message)
+
+        return next(self.__mids)
+
+    def unsubscribe(self, client, topicFilter):
+        with self.__lock:
+            if topicFilter in self.__clientFilters.get(client, []):
+                self.__clientFilters[client].remove(topicFilter)
+                self.__subscriptions.remove(topicFilter, client)
+        return next(self.__mids)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        '''
+        Delivers a message to every client subscribed to a matching filter.
+
+        returns:
+            int
+                Message id
+        '''
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, bytes):
+            payload = str(payload).encode('utf-8')
+
+        message = FakeMessage(topic, payload, qos, retain)
+        with self.__lock:
+            self.publishedCount += 1
+            if retain:
+                self.__retained[topic] = message
+            clients = self.__subscriptions.match(topic.split('/'))
+
+        deliveredCount = 0
+        for client in clients:
+            if client.deliver(message):
+                deliveredCount += 1
+
+        with self.__lock:
+            self.deliveredCount += deliveredCount
+            self.droppedCount += len(clients) - deliveredCount
+
+        return next(self.__mids)
+
+    def getStats(self):
+        return {
+            'published': self.publishedCount,
+            'delivered': self.deliveredCount,
+            'dropped': self.droppedCount
+        }
+
+    @staticmethod
+    def __filterMatches(filterParts, topicParts):
+        trie = TopicTrie()
+        trie.add('/'.join(filterParts), True)
+        return len(trie.match(topicParts)) > 0
@@ -0,0 +1,44 @@
+'''
+Measures g-code round trips through GCode.__emit__ (HTTP keep-alive pool included)
+against the local controller stand-in.
+
+Run from the server directory:
+    python -m benchmarks.gcode_roundtrip --count 2000
+'''
+import argparse
+import json
+import logging
+import time
+from benchmarks.controller_standin import ControllerStandIn
+from benchmarks.stats import summarize
+
+def run(count=2000, port=8000):
+    from internal.machine_motion import GCode, httpConnectionPool
+
+    standIn = ControllerStandIn(port=port).start()
+    try:
+        gCode = GCode('127.0.0.1')
+        gCode.__emit__('G90')               # Warm up the connection
+
+        latencies = []
+        startTime = time.perf_counter()
+        for idx in range(count):
+            sentAt = time.perf_counter()
+            gCode.__emit__('G0 X{}'.format(idx % 100))
+            latencies.append(time.perf_counter() - sentAt)
+        duration = time.perf_counter() - startTime
+    finally:
+        standIn.stop()
+
+    result = summarize(latencies)
+    result['linesPerSecond'] = count / duration
+    result['connections'] = httpConnectionPool.getStats()
+    return result
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='G-code round trips against a local controller stand-in')
+    parser.add_argument('--count', type=int, default=2000, help='Number of g-code lines to send')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count), indent=4))
@@ -0,0 +1,304 @@
+'''
+Load test of the MQTT consumers of the server (MachineMotion callbacks, IOMonitor,
+MqttTopicSubscriber and Sensor) against the in-process FakeBroker.
+
+IO expander, encoder and estop traffic is synthesized (or replayed from a file) at a
+fixed rate and goes through the real hub and callback chain. For each consumer, the
+report gives the dispatch latency from publish to callback and the number of messages
+that never arrived.
+
+Run from the server directory:
+    python -m benchmarks.mqtt_load --rate 5000 --duration 5
+
+A replay file holds one JSON object per line: {"topic": "...", "payload": "..."}
+'''
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+import internal.mqtt_hub as mqtt_hub
+import internal.notifier as notifier
+from benchmarks.fake_mqtt import FakeBroker
+from benchmarks.stats import summarize
+
+BROKER_IP = 'fake-broker'
+
+def synthesizeTraffic(ioDevices=2, ioPins=4, encoders=3):
+    '''
+    Generates an endless stream of (topic, payload) in the formats published by a controller.
+    Each digital input toggles every time it is published, so every message is a change.
+    '''
+    ioTopics = [ 'devices/io-expander/{}/digital-input/{}'.format(device, pin) for device in range(1, ioDevices + 1) for pin in range(ioPins) ]
+    encoderTopics = [ 'devices/encoder/{}/realtime-position'.format(encoder) for encoder in range(encoders) ]
+    ioValues = { topic: 0 for topic in ioTopics }
+
+    idx = 0
+    while True:
+        for topic in ioTopics:
+            ioValues[topic] = 1 - ioValues[topic]
+            yield (topic, str(ioValues[topic]))
+
+        for topic in encoderTopics:
+            yield (topic, str(idx * 0.1))
+
+        if idx % 10 == 0:
+            yield ('estop/status', 'false')
+        idx += 1
+
+def loadReplay(path):
+    ''' Replays the messages of a file forever '''
+    with open(path) as replayFile:
+        messages = [ json.loads(line) for line in replayFile if len(line.strip()) > 0 ]
+
+    while True:
+        for message in messages:
+            yield (message['topic'], message['payload'])
+
+class ConsumerProbe:
+    '''
+    Measures one consumer. The traffic generator records the publish time of every message
+    the consumer should receive, per topic, and the consumer pops them in order when its
+    callback runs. Messages dropped by the broker are never recorded.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.expected = collections.defaultdict(collections.deque)
+        self.expectedCount = 0
+        self.latencies = []
+        self.unexpectedCount = 0
+        self.coalescedCount = 0
+
+    def expect(self, topic, sentAt):
+        self.expected[topic].append(sentAt)
+        self.expectedCount += 1
+
+    def receivedLatest(self, topic):
+        '''
+        For consumers that fold several messages into one: the latency is measured from the
+        oldest message not reported yet, and the other ones are counted as coalesced.
+        '''
+        receivedAt = time.perf_counter()
+        expected = self.expected[topic]
+        if len(expected) == 0:
+            return
+
+        self.latencies.append(receivedAt - expected.popleft())
+        self.coalescedCount += len(expected)
+        expected.clear()
+
+    def unexpect(self, topic):
+        self.expected[topic].pop()
+        self.expectedCount -= 1
+
+    def received(self, topic):
+        receivedAt = time.perf_counter()
+        try:
+            self.latencies.append(receivedAt - self.expected[topic].popleft())
+        except IndexError:
+            self.unexpectedCount += 1
+
+    def report(self):
+        result = summarize(self.latencies)
+        result['expected'] = self.expectedCount
+        result['received'] = len(self.latencies)
+        result['coalesced'] = self.coalescedCount
+        result['missing'] = self.expectedCount - len(self.latencies) - self.coalescedCount
+        result['unexpected'] = self.unexpectedCount
+        return result
+
+class ProbeNotifier:
+    '''
+    Stands in for the global Notifier, to catch the IO_STATE_SNAPSHOT messages of the IOMonitor.
+    A snapshot reports every change received before it, so the changes of an IO between two
+    snapshots are coalesced.
+    '''
+    def __init__(self, probe, topicsByName):
+        self.probe = probe
+        self.topicsByName = topicsByName
+
+    def sendMessage(self, level, message, customPayload=None, coalesceKey=None):
+        if level == notifier.NotificationLevel.IO_STATE_SNAPSHOT:
+            for name in customPayload:
+                self.probe.receivedLatest(self.topicsByName[name])
+
+def run(rate=2000, durationSeconds=5, traffic=None, maxQueuedMessages=10000, subscriberUpdateIntervalSeconds=0.01, drainSeconds=2):
+    '''
+    Publishes 'rate' messages per second for 'durationSeconds' and returns the report.
+    '''
+    from internal.machine_motion import MachineMotion
+    from internal.io_monitor import IOMonitor
+    from internal.mqtt_topic_subscriber import MqttTopicSubscriber
+    from sensor import Sensor
+
+    broker = FakeBroker(maxQueuedMessages)
+    mqtt_hub.setMqttClientFactory(broker.createClient)
+
+    if traffic == None:
+        traffic = synthesizeTraffic()
+
+    ioTopics = [ 'devices/io-expander/{}/digital-input/{}'.format(device, pin) for device in range(1, 3) for pin in range(4) ]
+
+    machineMotionProbe = ConsumerProbe('machineMotion')
+    ioMonitorProbe = ConsumerProbe('ioMonitor')             # Only reacts to changes
+    subscriberProbe = ConsumerProbe('topicSubscriber')
+    sensorProbe = ConsumerProbe('sensor')                   # Only reacts to changes, after the first value
+
+    # Consumers, all fed by the same hub like on the machine
+    machineMotion = MachineMotion(BROKER_IP)
+    machineMotion.addMqttCallback(lambda topic, msg: machineMotionProbe.received(topic))
+
+    topicsByName = {}
+    notifier.globalNotifier = ProbeNotifier(ioMonitorProbe, topicsByName)
+    ioMonitor = IOMonitor(machineMotion)
+
+    subscriber = MqttTopicSubscriber(machineMotion)
+    subscriber.registerCallback('devices/io-expander/#', lambda topic, msg: subscriberProbe.received(topic))
+
+    sensors = []
+    for topic in ioTopics:
+        topicParts = topic.split('/')
+        name = 'io-{}-{}'.format(topicParts[2], topicParts[4])
+        topicsByName[name] = topic
+        ioMonitor.startMonitoring(name, int(topicParts[2]), int(topicParts[4]))
+
+        sensor = Sensor(name, BROKER_IP, int(topicParts[2]), int(topicParts[4]))
+        sensor.register_on_value_change(lambda topic=topic: sensorProbe.received(topic))
+        sensors.append(sensor)
+
+    # The MqttTopicSubscriber is polled by the engine thread
+    isRunning = [ True ]
+    def updateSubscriber():
+        while isRunning[0]:
+            subscriber.update()
+            time.sleep(subscriberUpdateIntervalSeconds)
+
+    updateThread = threading.Thread(name='SubscriberUpdate', target=updateSubscriber)
+    updateThread.daemon = True
+    updateThread.start()
+
+    # Generate the traffic at a steady rate, recording what each consumer should receive
+    lastValues = {}
+    seenTopics = set()
+    publishedCount = 0
+    startTime = time.perf_counter()
+    endTime = startTime + durationSeconds
+    while True:
+        now = time.perf_counter()
+        if now >= endTime:
+            break
+
+        dueCount = int((now - startTime) * rate) - publishedCount
+        for _ in range(dueCount):
+            topic, payload = next(traffic)
+            isIo = topic in topicsByName.values()
+            isChange = lastValues.get(topic) != payload
+            isFirst = not topic in seenTopics
+
+            probes = [ machineMotionProbe ]
+            if isIo:
+                probes.append(subscriberProbe)
+                if isChange:
+                    probes.append(ioMonitorProbe)
+                    if not isFirst:
+                        probes.append(sensorProbe)
+
+            sentAt = time.perf_counter()
+            for probe in probes:
+                probe.expect(topic, sentAt)
+
+            droppedBefore = broker.droppedCount
+            broker.publish(topic, payload)
+            if broker.droppedCount != droppedBefore:
+                for probe in probes:
+                    probe.unexpect(topic)       # Never reaches the consumers
+            else:
+                lastValues[topic] = payload
+                seenTopics.add(topic)
+
+            publishedCount += 1
+
+        time.sleep(0.001)
+
+    time.sleep(drainSeconds)
+    isRunning[0] = False
+
+    for sensor in sensors:
+        sensor.close()
+    ioMonitor.close()
+    subscriber.delete()
+
+    stats = broker.getStats()
+    consumers = { probe.name: probe.report() for probe in [ machineMotionProbe, ioMonitorProbe, subscriberProbe, sensorProbe ] }
+
+    # Nothing received means the consumers are not connected to this broker: the numbers would be meaningless
+    for name, report in consumers.items():
+        if report['expected'] > 0 and report['received'] == 0:
+            raise RuntimeError('The {} consumer received none of the {} messages it expected'.format(name, report['expected']))
+
+    return {
+        'rate': rate,
+        'durationSeconds': durationSeconds,
+        'published': publishedCount,
+        'achievedRate': publishedCount / durationSeconds,
+        'brokerDropped': stats['dropped'],
+        'consumers': consumers
+    }
+
+def runThroughput(count=50000, traffic=None, timeoutSeconds=60):
+    '''
+    Publishes 'count' messages as fast as possible to a single MachineMotion and measures
+    how many messages per second go through MachineMotion.__onMessage and its callbacks.
+    '''
+    from internal.machine_motion import MachineMotion
+
+    broker = FakeBroker(count)
+    mqtt_hub.setMqttClientFactory(broker.createClient)
+    machineMotion = MachineMotion('fake-broker-throughput')
+
+    receivedCount = [ 0 ]
+    doneEvent = threading.Event()
+    def onMessage(topic, msg):
+        receivedCount[0] += 1
+        if receivedCount[0] == count:
+            doneEvent.set()
+
+    machineMotion.addMqttCallback(onMessage)
+
+    if traffic == None:
+        traffic = synthesizeTraffic()
+    messages = [ next(traffic) for _ in range(count) ]
+
+    startTime = time.perf_counter()
+    for topic, payload in messages:
+        broker.publish(topic, payload)
+    publishDuration = time.perf_counter() - startTime
+
+    completed = doneEvent.wait(timeoutSeconds)
+    duration = time.perf_counter() - startTime
+    machineMotion.removeMqttCallback(onMessage)
+
+    if receivedCount[0] == 0:
+        raise RuntimeError('MachineMotion received none of the {} messages published'.format(count))
+
+    return {
+        'count': count,
+        'completed': completed,
+        'received': receivedCount[0],
+        'publishSeconds': publishDuration,
+        'dispatchSeconds': duration,
+        'messagesPerSecond': receivedCount[0] / duration
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='MQTT consumer load test against an in-process broker')
+    parser.add_argument('--rate', type=int, default=2000, help='Messages per second')
+    parser.add_argument('--duration', type=float, default=5, help='Duration of the test in seconds')
+    parser.add_argument('--queue', type=int, default=10000, help='Maximum number of messages queued per client before dropping')
+    parser.add_argument('--replay', default=None, help='Replay the messages of a JSON lines file instead of synthesizing them')
+    args = parser.parse_args()
+
+    traffic = loadReplay(args.replay) if args.replay != None else None
+    print(json.dumps(run(args.rate, args.duration, traffic, args.queue), indent=4))
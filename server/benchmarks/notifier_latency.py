@@ -0,0 +1,107 @@
+'''
+Measures the latency between Notifier.sendMessage and the reception of the
+matching websocket frame by one or more clients, for messages sent at a steady
+rate from a regular (non-asyncio) thread, like the engine and MQTT threads do.
+
+Run from the server directory:
+    python -m benchmarks.notifier_latency --count 1000 --interval 0.005 --clients 4
+'''
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+import websockets
+import internal.notifier as notifierModule
+from internal.notifier import Notifier, NotificationLevel
+from benchmarks.stats import summarize
+
+def runClient(url, count, connectedEvent, doneSendingEvent, latencies, timeoutSeconds):
+    '''
+    Receives frames on its own event loop and records the latency of each benchmark message,
+    until every message arrived or nothing arrived for a second after the last one was sent.
+    '''
+    async def receive():
+        async with websockets.connect(url) as websocket:
+            connectedEvent.set()
+            deadline = time.time() + timeoutSeconds
+            while len(latencies) < count and time.time() < deadline:
+                try:
+                    frame = await asyncio.wait_for(websocket.recv(), timeout=1)
+                except asyncio.TimeoutError:
+                    if doneSendingEvent.is_set():
+                        break           # The missing messages were dropped
+                    continue
+
+                receivedAt = time.perf_counter()
+                messages = json.loads(frame)
+                if not isinstance(messages, list):
+                    messages = [ messages ]
+
+                for message in messages:
+                    payload = message['customPayload']
+                    if isinstance(payload, dict) and 'benchmarkSentAt' in payload:
+                        latencies.append(receivedAt - payload['benchmarkSentAt'])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(receive())
+
+def run(count=1000, intervalSeconds=0.005, clientCount=1, port=8081, timeoutSeconds=30):
+    '''
+    Sends 'count' messages, one every 'intervalSeconds', to 'clientCount' websocket clients
+    and returns the latency summary over every client.
+    '''
+    # Other benchmarks of the same run may have replaced the global notifier with a stand-in
+    if not isinstance(notifierModule.globalNotifier, Notifier):
+        notifierModule.globalNotifier = Notifier()
+    notifier = notifierModule.globalNotifier
+    time.sleep(0.5)                 # Let the websocket server start
+
+    doneSendingEvent = threading.Event()
+    clients = []
+    for idx in range(clientCount):
+        latencies = []
+        connectedEvent = threading.Event()
+        clientThread = threading.Thread(name='NotifierBenchmarkClient{}'.format(idx), target=runClient,
+            args=('ws://127.0.0.1:{}'.format(port), count, connectedEvent, doneSendingEvent, latencies, timeoutSeconds))
+        clientThread.daemon = True
+        clientThread.start()
+        clients.append((clientThread, connectedEvent, latencies))
+
+    for _, connectedEvent, _ in clients:
+        if not connectedEvent.wait(5):
+            raise RuntimeError('Could not connect to the notifier websocket')
+    time.sleep(0.1)                 # Let the server register the clients
+
+    startTime = time.perf_counter()
+    for idx in range(count):
+        notifier.sendMessage(NotificationLevel.INFO, 'Benchmark message {}'.format(idx), { 'benchmarkSentAt': time.perf_counter() })
+        if intervalSeconds > 0:
+            time.sleep(intervalSeconds)
+    sendDuration = time.perf_counter() - startTime
+    doneSendingEvent.set()
+
+    allLatencies = []
+    for clientThread, _, latencies in clients:
+        clientThread.join(timeoutSeconds)
+        allLatencies.extend(latencies)
+
+    result = summarize(allLatencies)
+    result['sent'] = count
+    result['clients'] = clientCount
+    result['missing'] = count * clientCount - len(allLatencies)
+    result['intervalSeconds'] = intervalSeconds
+    result['sendDurationSeconds'] = sendDuration
+    return result
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='Notifier sendMessage to websocket frame latency')
+    parser.add_argument('--count', type=int, default=1000, help='Number of messages to send')
+    parser.add_argument('--interval', type=float, default=0.005, help='Seconds between two messages (0 for a burst)')
+    parser.add_argument('--clients', type=int, default=1, help='Number of websocket clients')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count, args.interval, args.clients), indent=4))
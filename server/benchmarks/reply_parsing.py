@@ -0,0 +1,97 @@
+'''
+Micro-benchmark of internal.reply_parser against the string slicing it replaced in
+MachineMotion (getCurrentPositions, getEndStopState and isMotionCompleted).
+
+Replies are parsed in the form returned by HTTPSend (str() of the response bytes).
+
+Run from the server directory:
+    python -m benchmarks.reply_parsing --count 100000
+'''
+import argparse
+import json
+import timeit
+from internal import reply_parser
+
+def _httpReply(text):
+    return str(text.encode('utf-8'))          # What HTTPSend returns on python 3
+
+POSITIONS_REPLY = _httpReply('echo:M114\nX:152.30 Y:-4.50 Z:0.00 E:0.00 Count X:12184 Y:-360 Z:0\nok\n')
+END_STOPS_REPLY = 'echo:M119\nx_min: open \nx_max: TRIGGERED \ny_min: open \ny_max: open \nz_min: open \nz_max: open \nok\n'
+MOTION_REPLY = _httpReply('echo:V0\nCOMPLETED\nok\n')
+
+# Parsing code removed from MachineMotion, kept as the reference
+def legacyPositions(reply):
+    positions = { 1: None, 2: None, 3: None }
+    if ( "echo" in reply and "ok" in reply ) :
+        positions[1] = float(reply[reply.find('X')+2:(reply.find('Y')-1)])
+        positions[2] = float(reply[reply.find('Y')+2:(reply.find('Z')-1)])
+        positions[3] = float(reply[reply.find('Z')+2:(reply.find('E')-1)])
+    else : raise Exception('Error in gCode execution')
+    return positions
+
+def legacyEndStops(reply):
+    states = { 'x_min': None, 'x_max': None, 'y_min': None, 'y_max': None, 'z_min': None, 'z_max': None }
+
+    def trimUntil(S, key) :
+        return S[S.find(key) + len(key) :]
+
+    if ( "echo" in reply and "ok" in reply ) :
+        reply = trimUntil(reply, "\n")
+        for name in reply_parser.END_STOP_NAMES :
+            if name in reply :
+                keyB = name + ": "
+                keyE = " \n"
+                states[name] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
+                reply = trimUntil(reply, "\n")
+            else : raise Exception('Error in gCode')
+    else : raise Exception('Error in gCode execution')
+    return states
+
+def legacyMotionCompleted(reply):
+    if ( "echo" in reply and "ok" in reply ) :
+        if ("COMPLETED" in reply) : return True
+        else : return False
+    else : raise Exception('Error in gCode execution')
+
+def parserPositions(reply):
+    return reply_parser.parsePositions(reply).positions
+
+def parserEndStops(reply):
+    return reply_parser.parseEndStops(reply).states
+
+def parserMotionCompleted(reply):
+    completed = reply_parser.isMotionCompleted(reply)
+    if completed is None : raise Exception('Error in gCode execution')
+    return completed
+
+CASES = [
+    ('positions', POSITIONS_REPLY, legacyPositions, parserPositions),
+    ('endStops', END_STOPS_REPLY, legacyEndStops, parserEndStops),
+    ('motionCompleted', MOTION_REPLY, legacyMotionCompleted, parserMotionCompleted)
+]
+
+def measure(function, reply, count):
+    seconds = min(timeit.repeat(lambda: function(reply), number=count, repeat=3))
+    return {
+        'usPerReply': 1e6 * seconds / count,
+        'parsesPerSecond': count / seconds
+    }
+
+def run(count=100000):
+    results = {}
+    for name, reply, legacy, parser in CASES:
+        if legacy(reply) != parser(reply):
+            raise RuntimeError('The parser and the legacy code disagree on the {} reply: {} != {}'.format(name, parser(reply), legacy(reply)))
+
+        results[name] = {
+            'legacy': measure(legacy, reply, count),
+            'parser': measure(parser, reply, count)
+        }
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Controller reply parsing micro-benchmark')
+    parser.add_argument('--count', type=int, default=100000, help='Number of parses per measurement')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count), indent=4))
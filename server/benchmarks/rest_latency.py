@@ -0,0 +1,107 @@
+'''
+Measures REST control latency on RestServer: the HTTP round trip of the control
+endpoints, and for pause and resume, the time until the engine has applied the command.
+
+Run from the server directory:
+    python -m benchmarks.rest_latency --count 200
+'''
+import argparse
+import http.client
+import json
+import logging
+import threading
+import time
+from benchmarks.engine_transitions import BenchmarkEngine, setUpEngineEnvironment
+from benchmarks.stats import summarize
+from internal.base_machine_app import MachineAppState
+
+class IdleState(MachineAppState):
+    def onEnter(self):
+        pass
+
+    def onResume(self):
+        self.engine.resumedEvent.set()
+
+class ControlledEngine(BenchmarkEngine):
+    ''' Stays in one state and signals when pause and resume have been applied '''
+    def __init__(self):
+        super(ControlledEngine, self).__init__(0)
+        self.pausedEvent = threading.Event()
+        self.resumedEvent = threading.Event()
+
+    def buildStateDictionary(self):
+        return { 'Ping': IdleState(self) }
+
+    def onPause(self):
+        self.pausedEvent.set()
+
+def request(connection, method, path):
+    connection.request(method, path, body=None if method == 'GET' else b'', headers={ 'Content-Type': 'application/json' })
+    response = connection.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise RuntimeError('{} {} failed with status {}: {}'.format(method, path, response.status, body))
+    return body
+
+def run(count=200, port=3012, timeoutSeconds=5):
+    from internal.rest_server import RestServer
+
+    setUpEngineEnvironment()
+    engine = ControlledEngine()
+    engineThread = threading.Thread(name='BenchmarkEngine', target=engine.loop)
+    engineThread.daemon = True
+    engineThread.start()
+
+    restServer = RestServer(engine)
+    serverThread = threading.Thread(name='BenchmarkRestServer', target=restServer.run,
+        kwargs={ 'host': '127.0.0.1', 'port': port, 'server': 'paste', 'quiet': True, 'daemon_threads': True })
+    serverThread.daemon = True
+    serverThread.start()
+
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeoutSeconds)
+    deadline = time.time() + timeoutSeconds
+    while True:
+        try:
+            request(connection, 'GET', '/ping')
+            break
+        except Exception:
+            connection.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+    logging.getLogger('wsgi').setLevel(logging.WARNING)      # Paste logs every request otherwise
+    request(connection, 'POST', '/run/start')
+
+    roundTrips = { 'GET /run/state': [], 'GET /run/estop': [], 'POST /run/pause': [], 'POST /run/resume': [] }
+    applied = { 'pause': [], 'resume': [] }
+    for _ in range(count):
+        for path in [ '/run/state', '/run/estop' ]:
+            sentAt = time.perf_counter()
+            request(connection, 'GET', path)
+            roundTrips['GET ' + path].append(time.perf_counter() - sentAt)
+
+        for command, event in [ ('pause', engine.pausedEvent), ('resume', engine.resumedEvent) ]:
+            event.clear()
+            sentAt = time.perf_counter()
+            request(connection, 'POST', '/run/' + command)
+            roundTrips['POST /run/' + command].append(time.perf_counter() - sentAt)
+            if event.wait(timeoutSeconds):
+                applied[command].append(time.perf_counter() - sentAt)
+
+    request(connection, 'POST', '/run/stop')
+    connection.close()
+    engine.kill()
+
+    return {
+        'roundTrip': { name: summarize(latencies) for name, latencies in roundTrips.items() },
+        'commandApplied': { name: summarize(latencies) for name, latencies in applied.items() }
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='REST control latency')
+    parser.add_argument('--count', type=int, default=200, help='Number of requests per endpoint')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count), indent=4))
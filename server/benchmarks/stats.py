@@ -0,0 +1,22 @@
+''' Helpers shared by the benchmarks '''
+
+def percentile(sortedValues, fraction):
+    if len(sortedValues) == 0:
+        return None
+    index = min(len(sortedValues) - 1, int(round(fraction * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+def summarize(latencies):
+    ''' Summarizes a list of latencies (seconds) in milliseconds '''
+    values = sorted(latencies)
+    if len(values) == 0:
+        return { 'count': 0 }
+
+    return {
+        'count': len(values),
+        'meanMs': 1000 * sum(values) / len(values),
+        'p50Ms': 1000 * percentile(values, 0.50),
+        'p95Ms': 1000 * percentile(values, 0.95),
+        'p99Ms': 1000 * percentile(values, 0.99),
+        'maxMs': 1000 * values[-1]
+    }
@@ -2,7 +2,23 @@ from abc import ABC, abstractmethod
 import logging
 from internal.notifier import getNotifier, NotificationLevel
 import time
+from threading import Condition
+from collections import deque
 from internal.mqtt_topic_subscriber import MqttTopicSubscriber
+from internal.state_profiler import StateProfiler
+from internal.machine_motion import ControllerUnreachableError
+from internal.controller_registry import ControllerRegistry
+
+class EngineCommand:
+    '''
+    Control commands sent to the engine loop by the REST server and the e-stop callback.
+    '''
+    START           = 'start'
+    STOP            = 'stop'
+    PAUSE           = 'pause'
+    RESUME          = 'resume'
+    ESTOP           = 'estop'
+    RELEASE_ESTOP   = 'release_estop'
 
 class MachineAppState(ABC):
     '''
@@ -11,6 +27,8 @@ class MachineAppState(ABC):
     methods. See IdleState for an example.
     '''
     
+    updateIntervalSeconds = None                        # Time between two 'update' calls in this state. None uses the engine's interval
+
     def __init__(self, engine: 'BaseMachineAppEngine'):
         '''
         Constructor that initializes state that will remain consistent throguhout the
@@ -160,6 +178,8 @@ class BaseMachineAppEngine(ABC):
     Base class for the MachineApp engine
     '''
     UPDATE_INTERVAL_SECONDS = 0.16
+    MAX_CHAINED_TRANSITIONS = 32
+    PROFILE_NOTIFY_INTERVAL_SECONDS = 1.0
 
     def __init__(self):
         self.configuration  = None                                      # Python dictionary containing the loaded configuration payload
@@ -174,27 +194,91 @@ class BaseMachineAppEngine(ABC):
         self.__inStateStepperMode   = False                             # If True, the engine will enter a Pause state in between each state transition
         self.__hasPausedForStepper  = False                             # Keeps track of whether or not we have allowed stepper mode to pause the app between transitions
         
-        self.__shouldStart  = False                                     # Tells the MachineApp loop that it should begin processing the state machine
-        self.__shouldStop   = False                                     # Tells the MachineApp loop that it should stop on its next update
-        self.__shouldPause  = False                                     # Tells the MachineApp loop that it should pause on its next update
-        self.__shouldResume = False                                     # Tells the MachineApp loop that it should resume on its next update
-        self.__shouldEstop          = False                             # Tells the update loop that we have entered the e-stop state
-        self.__shouldReleaseEstop   = False                             # Tells the update loop that we have released the e-stop and reset the system
+        self.updateIntervalSeconds  = BaseMachineAppEngine.UPDATE_INTERVAL_SECONDS     # Time between two 'update' calls, unless the state defines its own
+        self.maxChainedTransitions  = BaseMachineAppEngine.MAX_CHAINED_TRANSITIONS     # Transitions run back to back before the engine forces an update tick. 1 runs a single transition per tick
+        self.__chainedTransitionCount = 0                               # Transitions run since the last update tick
+
+        self.__commandQueue         = deque()                           # EngineCommands waiting to be processed by the MachineApp loop
+        self.__condition            = Condition()                       # Wakes the MachineApp loop up on new commands and state transitions
 
         self.__currentState         = None                              # Active state of the engine
         self.__stateDictionary      = {}                                # Mapping of state names to MachineAppState definitions
         self.notifier               = getNotifier()                     # Used to broadcast information to the Web App's console
+
+        self.profiler               = StateProfiler()                   # Time spent in each state, transition counts and cycle times
+        self.profileNotifyIntervalSeconds = BaseMachineAppEngine.PROFILE_NOTIFY_INTERVAL_SECONDS   # Time between two profiles streamed to the Web App. None disables streaming
+        self.__lastProfileNotifyTime = 0
+
+        self.controllers            = ControllerRegistry()              # Every MachineMotion of the machine. Register them in 'initialize'; the master is added automatically
         
     def resetState(self):
         self.isRunning = False
-        self.__shouldStart = False
-        self.__shouldStop = False
         self.isPaused = False
-        self.__shouldPause = False
-        self.__shouldResume = False
         self.__hasPausedForStepper  = False 
         self.__currentState = self.getDefaultState()
 
+        # Pending run commands are obsolete, but e-stop events must still be processed
+        with self.__condition:
+            for command in [EngineCommand.START, EngineCommand.STOP, EngineCommand.PAUSE, EngineCommand.RESUME]:
+                while command in self.__commandQueue:
+                    self.__commandQueue.remove(command)
+
+    def __postCommand(self, command):
+        '''
+        (Internal, for engine use only)
+
+        Queues a command for the MachineApp loop and wakes it up.
+        '''
+        with self.__condition:
+            if command == EngineCommand.START and command in self.__commandQueue:
+                return
+
+            self.__commandQueue.append(command)
+            self.__condition.notify_all()
+
+    def __popCommand(self, acceptedCommands=None):
+        '''
+        (Internal, for engine use only)
+
+        Removes and returns the oldest queued command among acceptedCommands (any
+        command if None). Returns None if there is no such command.
+        '''
+        with self.__condition:
+            for command in self.__commandQueue:
+                if acceptedCommands == None or command in acceptedCommands:
+                    self.__commandQueue.remove(command)
+                    return command
+
+        return None
+
+    def __waitForWork(self, timeout, acceptedCommands=None, wakeOnTransition=True):
+        '''
+        (Internal, for engine use only)
+
+        Blocks the MachineApp loop until a command among acceptedCommands arrives, a state
+        transition is requested (if wakeOnTransition), the engine is killed, or the timeout
+        expires (None waits forever).
+        '''
+        def hasWork():
+            if not self.__isAlive or (wakeOnTransition and self.__nextRequestedState != None):
+                return True
+
+            for command in self.__commandQueue:
+                if acceptedCommands == None or command in acceptedCommands:
+                    return True
+
+            return False
+
+        with self.__condition:
+            self.__condition.wait_for(hasWork, timeout)
+
+    def __getUpdateInterval(self, state):
+        ''' Returns the time between two updates of the provided state '''
+        if state != None and state.updateIntervalSeconds != None:
+            return state.updateIntervalSeconds
+
+        return self.updateIntervalSeconds
+
     @abstractmethod
     def initialize(self):
         ''' 
@@ -249,7 +333,8 @@ class BaseMachineAppEngine(ABC):
     def onStop(self):
         '''
         Called when a stop is requested from the REST API. 99% of the time, you will
-        simply call 'emitStop' on all of your machine motions in this methiod.
+        simply call 'emitStop' on all of your machine motions in this methiod, which
+        'self.controllers.emitStop()' does in parallel.
 
         Warning: This logic is happening in a separate thread.
         '''
@@ -265,11 +350,25 @@ class BaseMachineAppEngine(ABC):
         '''
         pass
 
+    def onControllerUnreachable(self, error):
+        '''
+        Called when a request to a controller failed after every retry allowed by the HTTP
+        retry policy, or was refused because the controller is known to be down. The run
+        is already over when this is called.
+
+        params:
+            error: ControllerUnreachableError
+                error.host is the controller that could not be reached
+
+        Default behavior: Do nothing
+        '''
+        pass
+
     @abstractmethod
     def getMasterMachineMotion(self):
         ''' 
-        Returns the master machine motion, which will be used for estopping,
-        releasing the estop, and resetting the system.
+        Returns the master machine motion. Estops, estop releases and system resets are
+        sent to it and to every other controller registered in 'self.controllers'.
         
         returns:
             MachineMotion
@@ -317,7 +416,10 @@ class BaseMachineAppEngine(ABC):
             self.logger.error('Trying to move to an unknown state: {}'.format(newState))
             return False
 
-        self.__nextRequestedState = newState
+        with self.__condition:
+            self.__nextRequestedState = newState
+            self.__condition.notify_all()
+
         return True
 
     def __tryExecuteStateTransition(self):
@@ -339,10 +441,14 @@ class BaseMachineAppEngine(ABC):
 
         self.__hasPausedForStepper = False # We have paused for the stepper at this point, so let's reset it
 
+        self.profiler.recordTransition(self.__currentState, self.__nextRequestedState, time.perf_counter())
+
         if not self.__currentState == None:
             prevState = self.getCurrentState()
             if prevState != None:
+                startTime = time.perf_counter()
                 prevState.onLeave()
+                self.profiler.recordPhase(self.__currentState, StateProfiler.ON_LEAVE, time.perf_counter() - startTime)
                 prevState.freeCallbacks()
 
         self.notifier.sendMessage(NotificationLevel.APP_STATE_CHANGE, 'Entered MachineApp state: {}'.format(self.__nextRequestedState))
@@ -351,121 +457,209 @@ class BaseMachineAppEngine(ABC):
         nextState = self.getCurrentState()
 
         if nextState != None:
+            startTime = time.perf_counter()
             nextState.onEnter()
+            self.profiler.recordPhase(self.__currentState, StateProfiler.ON_ENTER, time.perf_counter() - startTime)
 
         return True
 
+    def __handleControllerUnreachable(self, error):
+        '''
+        (Internal, for engine use only)
+
+        A request to a controller failed for good (see HTTPSend): the run is ended, since the
+        states can not rely on the machine anymore, and the engine goes back to the default state.
+        '''
+        self.logger.error('Ending the MachineApp run: {}'.format(error))
+        self.notifier.sendMessage(NotificationLevel.ERROR, 'Lost communication with the controller, stopping the MachineApp: {}'.format(error))
+
+        self.resetState()
+        self.onControllerUnreachable(error)
+
+    def __notifyProfile(self):
+        '''
+        (Internal, for engine use only)
+
+        Streams the state profile to the Web App, at most once every profileNotifyIntervalSeconds.
+        '''
+        if self.profileNotifyIntervalSeconds == None:
+            return
+
+        now = time.time()
+        if now - self.__lastProfileNotifyTime < self.profileNotifyIntervalSeconds:
+            return
+
+        self.__lastProfileNotifyTime = now
+        self.notifier.sendMessage(NotificationLevel.STATE_PROFILE, 'MachineApp state profile', self.profiler.getReport(), NotificationLevel.STATE_PROFILE)
+
+    def getProfile(self):
+        '''
+        Returns the time spent in each state, the transition counts and the cycle times.
+        See StateProfiler.getReport.
+        '''
+        return self.profiler.getReport()
+
+    def resetProfile(self):
+        ''' Clears the state profile '''
+        self.profiler.reset()
+
     def loop(self):
         '''
-        Main loop of your MachineApp. If we set __shouldStart to True, the MachineApp begins processing
+        Main loop of your MachineApp. When a start command arrives, the MachineApp begins processing
         the nodes in its core loop.
+
+        The loop sleeps until it receives a command (start, stop, pause, resume, estop) or a state
+        transition request, so that these are handled right away. While a state is active, its
+        'update' method is called every 'updateIntervalSeconds'.
         '''
         self.logger.info('Starting the main MachineApp loop')
         self.initialize()
-        self.getMasterMachineMotion().bindeStopEvent(self.__setEstopped)
-        self.__setEstopped(self.getMasterMachineMotion().isEstopped())
-            
+        self.controllers.setMaster(self.getMasterMachineMotion())
+        self.controllers.bindeStopEvent(self.__setEstopped)
+        self.__setEstopped(self.controllers.isEstopped())
+
 
         # Outer Loop dealing with e-stops and start functionality
         while self.__isAlive:
-            if self.__shouldEstop:
+            command = self.__popCommand()
+            if command == None:
+                self.__waitForWork(None)
+                continue
+
+            if command == EngineCommand.ESTOP:
                 self.notifier.sendMessage(NotificationLevel.APP_ESTOP, 'Machine is in estop')
-                self.__shouldEstop = False
 
-            if self.__shouldReleaseEstop:
+            elif command == EngineCommand.RELEASE_ESTOP:
                 self.notifier.sendMessage(NotificationLevel.APP_ESTOP_RELEASE, 'MachineApp estop released')
-                self.__shouldReleaseEstop = False
 
                 currentState = self.getCurrentState()
                 if currentState != None:
-                    currentState.onEstopReleased()
+                    try:
+                        currentState.onEstopReleased()
+                    except ControllerUnreachableError as error:
+                        self.__handleControllerUnreachable(error)
 
-            if self.__shouldStart:              # Running start behavior
-                self.beforeRun()
-                self.__stateDictionary = self.buildStateDictionary()
+            elif command == EngineCommand.START:              # Running start behavior
+                try:
+                    self.beforeRun()
+                    self.__stateDictionary = self.buildStateDictionary()
 
-                self.notifier.sendMessage(NotificationLevel.APP_START, 'MachineApp started')
+                    self.notifier.sendMessage(NotificationLevel.APP_START, 'MachineApp started')
 
-                # Begin the Application by moving to the default state
-                self.gotoState(self.getDefaultState())
-                self.isRunning = True
-                self.__shouldStart = False
-            else:
-                time.sleep(0.16)
-                continue
+                    # Begin the Application by moving to the default state
+                    self.profiler.onRunStarted(self.getDefaultState())
+                    self.gotoState(self.getDefaultState())
+                    self.isRunning = True
+                    self.__chainedTransitionCount = 0
 
-            # Inner Loop running the actual MachineApp program
-            while self.isRunning:
-                if self.__shouldEstop:          # Running E-Stop behavior
-                    self.notifier.sendMessage(NotificationLevel.APP_ESTOP, 'Machine is in estop')
-                    self.__shouldEstop = False
-                    self.isRunning = False
+                    self.__runStateMachine()
+                except ControllerUnreachableError as error:
+                    self.__handleControllerUnreachable(error)
 
-                    currentState = self.getCurrentState()
-                    if currentState != None:
-                        currentState.onEstop()
+                self.logger.info('Exiting MachineApp loop')
+                self.notifier.sendMessage(NotificationLevel.APP_COMPLETE, 'MachineApp completed')
 
-                    break
+                try:
+                    self.afterRun()
+                except ControllerUnreachableError as error:
+                    self.logger.error('afterRun could not reach the controller: {}'.format(error))
 
-                if self.__shouldStop:           # Running stop behavior
-                    self.__shouldStop = False
-                    self.isRunning = False
+            # Stop, pause and resume commands have no effect while the MachineApp is not running
 
-                    self.onStop()
+    def __runStateMachine(self):
+        '''
+        (Internal, for engine use only)
 
-                    currentState = self.getCurrentState()
-                    if currentState != None:
-                        currentState.onStop()
+        Inner loop running the actual MachineApp program, until it is stopped or estopped.
+        Estop release commands are left in the queue, to be handled once the run is over.
+        '''
+        runCommands = [EngineCommand.ESTOP, EngineCommand.STOP, EngineCommand.PAUSE, EngineCommand.RESUME]
 
-                    break
+        while self.isRunning:
+            command = self.__popCommand(runCommands)
 
-                if self.__shouldPause:          # Running pause behavior
-                    if self.__hasPausedForStepper:
-                        self.notifier.sendMessage(NotificationLevel.APP_PAUSE, 'Paused for stepper mode: Moving from {} state to {} state'.format(self.__currentState, self.__nextRequestedState))
-                    else:
-                        self.notifier.sendMessage(NotificationLevel.APP_PAUSE, 'MachineApp paused')
+            if command == EngineCommand.ESTOP:          # Running E-Stop behavior
+                self.notifier.sendMessage(NotificationLevel.APP_ESTOP, 'Machine is in estop')
+                self.isRunning = False
 
-                    self.__shouldPause = False
-                    self.isPaused = True
+                currentState = self.getCurrentState()
+                if currentState != None:
+                    currentState.onEstop()
 
-                    if not self.__hasPausedForStepper: # Only do pause behavior if we're not doing the stepper-mandated pause
-                        self.onPause()
+                break
 
-                        currentState = self.getCurrentState()
-                        if currentState != None:
-                            currentState.onPause()
+            if command == EngineCommand.STOP:           # Running stop behavior
+                self.isRunning = False
 
-                if self.__shouldResume:         # Running resume behavior
-                    self.notifier.sendMessage(NotificationLevel.APP_RESUME, 'MachineApp resumed')
-                    self.__shouldResume = False
-                    self.isPaused = False
+                self.onStop()
 
-                    if not self.__hasPausedForStepper: # Only do resume behavior if we're not doing the stepper-mandated pause
-                        currentState = self.getCurrentState()
-                        if currentState != None:
-                            currentState.onResume()
+                currentState = self.getCurrentState()
+                if currentState != None:
+                    currentState.onStop()
 
-                if self.isPaused:               # While paused, don't do anything
-                    time.sleep(BaseMachineAppEngine.UPDATE_INTERVAL_SECONDS)
-                    continue
+                break
 
-                if self.__nextRequestedState != None:       # Running state transition behavior
-                    if self.__tryExecuteStateTransition():
-                        continue # If the transition is executed successfully, let's get a clean update loop
+            if command == EngineCommand.PAUSE:          # Running pause behavior
+                if self.__hasPausedForStepper:
+                    self.notifier.sendMessage(NotificationLevel.APP_PAUSE, 'Paused for stepper mode: Moving from {} state to {} state'.format(self.__currentState, self.__nextRequestedState))
+                else:
+                    self.notifier.sendMessage(NotificationLevel.APP_PAUSE, 'MachineApp paused')
 
-                currentState = self.getCurrentState()
-                if currentState == None:
-                    self.logger.error('Currently in an invalid state')
-                    continue
+                self.isPaused = True
+
+                if not self.__hasPausedForStepper: # Only do pause behavior if we're not doing the stepper-mandated pause
+                    self.onPause()
+
+                    currentState = self.getCurrentState()
+                    if currentState != None:
+                        currentState.onPause()
+
+            if command == EngineCommand.RESUME:         # Running resume behavior
+                self.notifier.sendMessage(NotificationLevel.APP_RESUME, 'MachineApp resumed')
+                self.isPaused = False
 
-                currentState.updateCallbacks()
-                currentState.update()
+                if not self.__hasPausedForStepper: # Only do resume behavior if we're not doing the stepper-mandated pause
+                    currentState = self.getCurrentState()
+                    if currentState != None:
+                        currentState.onResume()
+
+            if command != None:
+                continue # Handle every queued command before doing any state work
+
+            if self.isPaused:               # While paused, don't do anything until the next command
+                with self.__condition:
+                    self.__condition.wait_for(lambda: not self.__isAlive or any(c in runCommands for c in self.__commandQueue))
+                continue
+
+            isChainLimited = False
+            if self.__nextRequestedState != None:       # Running state transition behavior
+                if self.__chainedTransitionCount < self.maxChainedTransitions:
+                    if self.__tryExecuteStateTransition():
+                        # Chain the next transition right away if the new state requested one in onEnter.
+                        # Commands (stop, pause, stepper pauses, ...) are still handled between links.
+                        self.__chainedTransitionCount += 1
+                        continue
+
+                # Chain is too long: let the current state run a full update tick first
+                isChainLimited = True
+                if self.maxChainedTransitions > 1:
+                    self.logger.warning('{} state transitions in a row without an update, forcing an update tick'.format(self.__chainedTransitionCount))
+
+            self.__chainedTransitionCount = 0
+
+            currentState = self.getCurrentState()
+            if currentState == None:
+                self.logger.error('Currently in an invalid state')
+                self.__waitForWork(self.updateIntervalSeconds, runCommands)
+                continue
 
-                time.sleep(BaseMachineAppEngine.UPDATE_INTERVAL_SECONDS)
+            currentState.updateCallbacks()
+            startTime = time.perf_counter()
+            currentState.update()
+            self.profiler.recordPhase(self.__currentState, StateProfiler.UPDATE, time.perf_counter() - startTime)
+            self.__notifyProfile()
 
-            self.logger.info('Exiting MachineApp loop')
-            self.notifier.sendMessage(NotificationLevel.APP_COMPLETE, 'MachineApp completed')
-            self.afterRun()
+            self.__waitForWork(self.__getUpdateInterval(currentState), runCommands, not isChainLimited)
 
     def start(self, inStateStepperMode, configuration):
         '''
@@ -488,7 +682,7 @@ class BaseMachineAppEngine(ABC):
 
         self.__inStateStepperMode = inStateStepperMode
         self.setConfiguration(configuration)
-        self.__shouldStart = True
+        self.__postCommand(EngineCommand.START)
         return True
 
     def pause(self):
@@ -500,7 +694,7 @@ class BaseMachineAppEngine(ABC):
         you implement any on-pause behavior in your MachineAppStates instead
         '''
         self.logger.info('Pausing the MachineApp')
-        self.__shouldPause = True
+        self.__postCommand(EngineCommand.PAUSE)
 
     def resume(self):
         '''
@@ -511,7 +705,7 @@ class BaseMachineAppEngine(ABC):
         you implement any on-resume behavior in your MachineAppStates instead
         '''
         self.logger.info('Resuming the MachineApp')
-        self.__shouldResume = True
+        self.__postCommand(EngineCommand.RESUME)
 
     def stop(self):
         '''
@@ -522,17 +716,17 @@ class BaseMachineAppEngine(ABC):
         you implement any on-stop behavior in your MachineAppStates instead
         '''
         self.logger.info('Stopping the MachineApp')
-        self.__shouldStop = True
+        self.__postCommand(EngineCommand.STOP)
 
     def __setEstopped(self, isEstopped):
         ''' Callback when we receive an e-stop event '''
         if isEstopped:
             if not self.isEstopped:
                 self.isEstopped = True
-                self.__shouldEstop = True
+                self.__postCommand(EngineCommand.ESTOP)
                 self.logger.info('Estop triggered')
         else:
-            self.__shouldReleaseEstop = True
+            self.__postCommand(EngineCommand.RELEASE_ESTOP)
             self.isEstopped = False
             self.logger.info('System reset')
 
@@ -544,9 +738,7 @@ class BaseMachineAppEngine(ABC):
         alter this behavior if you know what you are doing. It is recommended that
         you implement any on-estop behavior in your MachineAppStates instead
         '''
-        masterMachineMotion = self.getMasterMachineMotion()
-        masterMachineMotion.triggerEstop()
-        return True
+        return self.controllers.triggerEstop().isOk()
 
     def getEstop(self):
         ''' Returns whether or not the machine is currently in estop '''
@@ -554,16 +746,15 @@ class BaseMachineAppEngine(ABC):
 
     def releaseEstop(self):
         ''' Releases the estop of all machine motions '''
-        masterMachineMotion = self.getMasterMachineMotion()
-        masterMachineMotion.releaseEstop()
+        if not self.controllers.releaseEstop().isOk():
+            return False
+
         self.logger.info('Estop released')
         return True
 
     def resetSystem(self):
         ''' Resets the system for all machine motions '''
-        masterMachineMotion = self.getMasterMachineMotion()
-        masterMachineMotion.resetSystem()
-        return True
+        return self.controllers.resetSystem().isOk()
 
     def kill(self):
         ''' 
@@ -572,4 +763,6 @@ class BaseMachineAppEngine(ABC):
 
         Warning: Do not use.
         '''
-        self.__isAlive      = False
\ No newline at end of file
+        with self.__condition:
+            self.__isAlive  = False
+            self.__condition.notify_all()
\ No newline at end of file
@@ -0,0 +1,327 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+class ControllerResult:
+    '''
+    Outcome of a command on one controller.
+    '''
+    def __init__(self, name, value=None, error=None):
+        self.name = name
+        self.value = value                      # Value returned by the command, None if it failed
+        self.error = error                      # Exception raised by the command, None if it succeeded
+
+    def isOk(self):
+        return self.error == None
+
+    def toJson(self):
+        return {
+            'value': self.value,
+            'error': str(self.error) if self.error != None else None
+        }
+
+class FanOutResult:
+    '''
+    Outcome of a command sent to several controllers, by controller name.
+    '''
+    def __init__(self, commandName, results):
+        self.commandName = commandName
+        self.results = results                  # OrderedDict<str, ControllerResult>, in registration order
+
+    def isOk(self):
+        ''' Whether the command succeeded on every controller '''
+        return all(result.isOk() for result in self.results.values())
+
+    def getValues(self):
+        return OrderedDict((name, result.value) for name, result in self.results.items())
+
+    def getErrors(self):
+        ''' Returns the exception raised by each controller on which the command failed '''
+        return OrderedDict((name, result.error) for name, result in self.results.items() if not result.isOk())
+
+    def raiseIfFailed(self):
+        if not self.isOk():
+            raise ControllerFanOutError(self)
+
+    def toJson(self):
+        return { name: result.toJson() for name, result in self.results.items() }
+
+class ControllerFanOutError(Exception):
+    ''' Raised by FanOutResult.raiseIfFailed when the command failed on at least one controller '''
+    def __init__(self, result):
+        errors = result.getErrors()
+        super(ControllerFanOutError, self).__init__('{} failed on {}'.format(
+            result.commandName,
+            '; '.join('{}: {}'.format(name, error) for name, error in errors.items())))
+        self.result = result
+
+class ControllerRegistry:
+    '''
+    The MachineMotion controllers of a machine, by name. Commands can be sent to all of
+    them at once: each controller is called on its own worker thread, so the command takes
+    as long as the slowest controller instead of the sum of all of them, and the outcome
+    on every controller is returned as a FanOutResult.
+
+        registry.register('conveyor', MachineMotion('192.168.7.3'))
+        registry.emitStop().raiseIfFailed()
+        registry.waitForMotionCompletion(timeout=30)
+
+    Once bindeStopEvent is called, an estop on any controller is propagated to the others.
+
+    Stops, estops and resets run on their own workers, so they are never queued behind a
+    fan-out that is still waiting for motion to complete.
+    '''
+    MASTER_NAME = 'master'
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, maxWorkers=DEFAULT_MAX_WORKERS, propagateEstop=True):
+        '''
+        params:
+            maxWorkers: int
+                Maximum number of controllers called at the same time, per kind of command
+
+            propagateEstop: bool
+                (Optional) Set to False to only report estops, without triggering the estop
+                of the other controllers.
+        '''
+        self.logger = logging.getLogger(__name__)
+        self.maxWorkers = maxWorkers
+        self.propagateEstop = propagateEstop
+
+        self.__lock = threading.RLock()
+        self.__controllers = OrderedDict()             # Name -> MachineMotion
+        self.__masterName = None
+        self.__safetyExecutor = None                    # Stops, estops and resets. Created on first use
+        self.__executor = None                          # Every other command. Created on first use
+
+        self.__eStopCallback = None
+        self.__isEstopped = False                       # Whether any controller is estopped, as of the last estop event
+        self.__estopsInFlight = set()                   # Controllers on which triggerEstop is running
+
+    def register(self, name, machineMotion, isMaster=False):
+        '''
+        Adds a controller. The first controller registered is the master, unless another one
+        is registered with isMaster=True.
+        '''
+        with self.__lock:
+            if name in self.__controllers and self.__controllers[name] is not machineMotion:
+                raise ValueError('A different controller is already registered as {}'.format(name))
+
+            self.__controllers[name] = machineMotion
+            if isMaster or self.__masterName == None:
+                self.__masterName = name
+
+            if self.__eStopCallback != None:
+                self.__bindController(name, machineMotion)
+
+    def unregister(self, name):
+        with self.__lock:
+            machineMotion = self.__controllers.pop(name, None)
+            if self.__masterName == name:
+                self.__masterName = next(iter(self.__controllers), None)
+
+        if machineMotion != None and self.__eStopCallback != None:
+            machineMotion.bindeStopEvent(lambda isEstopped: None)
+
+    def setMaster(self, machineMotion):
+        '''
+        Makes a controller the master, registering it as MASTER_NAME if it is not registered yet.
+        '''
+        with self.__lock:
+            for name, registered in self.__controllers.items():
+                if registered is machineMotion:
+                    self.__masterName = name
+                    return
+
+            self.register(ControllerRegistry.MASTER_NAME, machineMotion, True)
+
+    def getMaster(self):
+        with self.__lock:
+            return self.__controllers.get(self.__masterName)
+
+    def get(self, name):
+        with self.__lock:
+            return self.__controllers[name]
+
+    def getNames(self):
+        with self.__lock:
+            return list(self.__controllers.keys())
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__controllers)
+
+    def __getExecutor(self, isSafetyCommand):
+        with self.__lock:
+            if isSafetyCommand:
+                if self.__safetyExecutor == None:
+                    self.__safetyExecutor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+                return self.__safetyExecutor
+
+            if self.__executor == None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+            return self.__executor
+
+    def fanOut(self, command, names=None, timeout=None, isSafetyCommand=False):
+        '''
+        Calls command(machineMotion) on several controllers in parallel and waits for all of them.
+
+        params:
+            command: func(machineMotion) -> value, or str
+                Function to call, or the name of a MachineMotion method taking no arguments
+
+            names: list<str>
+                (Optional) Controllers to call, every registered controller if None
+
+            timeout: float
+                (Optional) Maximum time to wait in seconds. Controllers that have not answered
+                by then get a TimeoutError, but their call keeps running in the background.
+
+        returns:
+            FanOutResult
+        '''
+        commandName = command if isinstance(command, str) else getattr(command, '__name__', 'command')
+        if isinstance(command, str):
+            methodName = command
+            command = lambda machineMotion: getattr(machineMotion, methodName)()
+
+        with self.__lock:
+            controllers = [ (name, self.__controllers[name]) for name in (self.__controllers.keys() if names == None else names) ]
+
+        executor = self.__getExecutor(isSafetyCommand)
+        futures = OrderedDict((name, executor.submit(command, machineMotion)) for name, machineMotion in controllers)
+        wait(list(futures.values()), timeout)
+
+        results = OrderedDict()
+        for name, future in futures.items():
+            if not future.done():
+                results[name] = ControllerResult(name, error=TimeoutError('No answer after {} seconds'.format(timeout)))
+            elif future.exception() != None:
+                results[name] = ControllerResult(name, error=future.exception())
+            else:
+                results[name] = ControllerResult(name, future.result())
+
+        result = FanOutResult(commandName, results)
+        for name, error in result.getErrors().items():
+            self.logger.error('{} failed on controller {}: {}'.format(commandName, name, error))
+
+        return result
+
+    def emitStop(self, names=None):
+        ''' Immediately stops all motion on every controller. See MachineMotion.emitStop '''
+        return self.fanOut('emitStop', names, isSafetyCommand=True)
+
+    def triggerEstop(self, names=None):
+        ''' Triggers the software estop of every controller '''
+        with self.__lock:
+            names = self.getNames() if names == None else names
+            self.__estopsInFlight.update(names)
+
+        try:
+            return self.fanOut('triggerEstop', names, isSafetyCommand=True)
+        finally:
+            with self.__lock:
+                self.__estopsInFlight.difference_update(names)
+
+    def releaseEstop(self, names=None):
+        ''' Releases the software estop of every controller '''
+        return self.fanOut('releaseEstop', names, isSafetyCommand=True)
+
+    def resetSystem(self, names=None):
+        ''' Resets every controller after an estop '''
+        return self.fanOut('resetSystem', names, isSafetyCommand=True)
+
+    def waitForMotionCompletion(self, timeout=None, names=None):
+        '''
+        Waits until every controller has finished its current movement. See MachineMotion.waitForMotionCompletion,
+        to which timeout is passed.
+
+        returns:
+            FanOutResult
+                The value for each controller is the dictionary returned by MachineMotion.waitForMotionCompletion
+        '''
+        def waitForMotionCompletion(machineMotion):
+            return machineMotion.waitForMotionCompletion(timeout)
+
+        return self.fanOut(waitForMotionCompletion, names)
+
+    def isEstopped(self):
+        ''' Whether any controller is estopped '''
+        with self.__lock:
+            controllers = list(self.__controllers.values())
+
+        return any(machineMotion.isEstopped() for machineMotion in controllers)
+
+    def bindeStopEvent(self, callback):
+        '''
+        Binds the estop event of every controller, including those registered later.
+
+        params:
+            callback: func(isEstopped: bool) -> void
+                Called with True when the first controller gets estopped, and with False once
+                none of them is estopped anymore.
+        '''
+        with self.__lock:
+            self.__eStopCallback = callback
+            for name, machineMotion in self.__controllers.items():
+                self.__bindController(name, machineMotion)
+
+            self.__isEstopped = self.isEstopped()
+
+    def __bindController(self, name, machineMotion):
+        machineMotion.bindeStopEvent(lambda isEstopped: self.__onEstopEvent(name, isEstopped))
+
+    def __onEstopEvent(self, name, isEstopped):
+        '''
+        Called on the MQTT thread of the controller whose estop state changed. Propagation
+        runs on the workers, so that this thread is free to receive the estop responses.
+        '''
+        with self.__lock:
+            wasEstopped = self.__isEstopped
+            controllers = list(self.__controllers.items())
+
+            propagateTo = []
+            if isEstopped:
+                self.__isEstopped = True
+                if self.propagateEstop:
+                    propagateTo = [ other for other, machineMotion in controllers
+                        if other != name and not other in self.__estopsInFlight and not machineMotion.isEstopped() ]
+                    self.__estopsInFlight.update(propagateTo)
+            else:
+                self.__isEstopped = any(machineMotion.isEstopped() for other, machineMotion in controllers if other != name)
+
+            isChanged = wasEstopped != self.__isEstopped
+            callback = self.__eStopCallback
+
+        if len(propagateTo) > 0:
+            self.logger.warning('Controller {} is estopped, estopping {}'.format(name, ', '.join(propagateTo)))
+            for other in propagateTo:
+                self.__getExecutor(True).submit(self.__propagateEstop, other)
+
+        if isChanged and callback != None:
+            callback(self.__isEstopped)
+
+    def __propagateEstop(self, name):
+        try:
+            with self.__lock:
+                machineMotion = self.__controllers.get(name)
+
+            if machineMotion != None:
+                machineMotion.triggerEstop()
+        except Exception as error:
+            self.logger.error('Could not propagate the estop to controller {}: {}'.format(name, error))
+        finally:
+            with self.__lock:
+                self.__estopsInFlight.discard(name)
+
+    def shutdown(self):
+        ''' Stops the worker threads once their current commands are done '''
+        with self.__lock:
+            executors = [ self.__safetyExecutor, self.__executor ]
+            self.__safetyExecutor = None
+            self.__executor = None
+
+        for executor in executors:
+            if executor != None:
+                executor.shutdown(wait=False)
@@ -1,16 +1,34 @@
-from time import sleep
 import logging
-import paho.mqtt.client as mqtt
-import paho.mqtt.subscribe as MQTTsubscribe
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from internal.mqtt_hub import getMqttHub
+from internal.topic_trie import TopicTrie
+from internal.motion_simulator import MotionSimulator, VirtualClock
+from internal.telemetry import TelemetryService
+from internal.machine_motion import MotionProgram
+
+'''
+Virtual seconds simulated per real second by the fake MachineMotions created without an
+explicit simulator. Raise it to run many machine cycles quickly, or set it to None to run
+on a discrete clock where waiting for motion returns immediately.
+'''
+DEFAULT_TIME_COMPRESSION = 1.0
 
 class MachineMotion:
-    def __init__(self, ip):
+    '''
+    Fake MachineMotion used for local development. Motion, end stops and IO are simulated
+    by a MotionSimulator, so moves take as long as they would on the machine (scaled by the
+    simulator's clock) and positions can be read back.
+    '''
+
+    class MotionCompletionTimeout(Exception):
+        pass
+
+    def __init__(self, ip, simulator=None):
         self.ip = ip
-        self.current_position = {
-            1: 0,
-            2: 0,
-            3: 0
-        }
+        self.simulator = simulator if simulator != None else MotionSimulator(VirtualClock(DEFAULT_TIME_COMPRESSION))
+        self.simulator.addInputListener(self.__onInputChanged)
+
         self.steps_mm = {
             1: 1,
             2: 1,
@@ -20,23 +38,38 @@ class MachineMotion:
         self._is_stopped = False
         self._complete_batching = False
         self.logger = logging.getLogger(__name__)
-        self.mqttCallbacks = []
+        self.mqttCallbacks = TopicTrie()
+        self.eStopCallback = None
+        self.__stopGeneration = 0
+        self.__isRelative = False
 
-        self.myMqttClient = mqtt.Client()
-        self.myMqttClient.on_connect = self.__onConnect
-        self.myMqttClient.on_message = self.__onMessage
-        self.myMqttClient.on_disconnect = self.__onDisconnect
-        self.myMqttClient.connect(ip)
-        self.myMqttClient.loop_start()
+        self.__mqttHub = getMqttHub(ip)
+        self.myMqttClient = self.__mqttHub.client
+        self.__mqttHub.addConnectionListener(self.__onConnect, self.__onDisconnect)
 
         self.__registeredInputMap = {}
+        self.__asyncExecutor = ThreadPoolExecutor(max_workers = 1)
+        self.__telemetry = None
 
-    def addMqttCallback(self, func):
-        if not func in self.mqttCallbacks:
-            self.mqttCallbacks.append(func)
+    @property
+    def current_position(self):
+        return self.getCurrentPositions()
 
-    def removeMqttCallback(self, func):
-        self.mqttCallbacks.remove(func)
+    def addMqttCallback(self, func, topicFilter = None):
+        self.mqttCallbacks.add('#' if topicFilter is None else topicFilter, func)
+        if topicFilter is not None:
+            self.mqttSubscribe(topicFilter)
+
+    def removeMqttCallback(self, func, topicFilter = None):
+        self.mqttCallbacks.remove('#' if topicFilter is None else topicFilter, func)
+        if topicFilter is not None:
+            self.mqttUnsubscribe(topicFilter)
+
+    def mqttSubscribe(self, topic):
+        self.__mqttHub.subscribe(topic, self.__onMessage)
+
+    def mqttUnsubscribe(self, topic):
+        self.__mqttHub.unsubscribe(topic, self.__onMessage)
 
     def __onConnect(self, client, userData, flags, rc):
         if rc == 0:
@@ -45,59 +78,96 @@ class MachineMotion:
     def __onDisconnect(self, client, userData, rc):
            self.logger.info("Disconnected with rtn code [%d]", rc)
 
-    def __onMessage(self, client, userData, msg):
-        for callback in self.mqttCallbacks:
-            callback(msg.topic, msg.payload.decode('utf-8'))
+    def __onMessage(self, msg):
+        self.__dispatch(msg.topic, msg.topicParts, msg.payload)
 
-    def stopMqtt(self):
-        pass
+    def __dispatch(self, topic, topicParts, payload):
+        for callback in self.mqttCallbacks.match(topicParts):
+            callback(topic, payload)
+
+    def __onInputChanged(self, device, pin, value):
+        # Simulated inputs are reported like the IO modules do, through MQTT callbacks
+        topic = 'devices/io-expander/{}/digital-input/{}'.format(device, pin)
+        self.__dispatch(topic, topic.split('/'), str(value))
 
-    def waitForMotionCompletion(self):
+    def stopMqtt(self):
         pass
 
     def configAxis(self, axis, uStep, mechGain):
         pass
 
+    def __setEstopped(self, isEstopped):
+        self._is_stopped = isEstopped
+        if isEstopped:
+            self.__stopGeneration += 1
+        self.simulator.setEstopped(isEstopped)
+        if self.eStopCallback != None:
+            self.eStopCallback(isEstopped)
+
     def triggerEstop(self):
-        self._is_stopped = True
-        pass
+        self.__setEstopped(True)
+        return True
 
     def releaseEstop(self):
-        self._is_stopped = False
-        pass
+        self.__setEstopped(False)
+        return True
 
     def resetSystem(self):
-        pass
+        return True
 
-    def lockBrake(self, aux, safety):
-        pass
+    def triggerEstopAsync(self):
+        return self.__completedFuture(self.triggerEstop())
 
-    def unlockBrake(self, aux, safety):
-        pass
+    def releaseEstopAsync(self):
+        return self.__completedFuture(self.releaseEstop())
+
+    def resetSystemAsync(self):
+        return self.__completedFuture(self.resetSystem())
+
+    def __completedFuture(self, result):
+        future = Future()
+        future.set_result(result)
+        return future
 
-    def emitSpeed(self, speed):
+    def lockBrake(self, aux, safety = False):
         pass
 
-    def emitAcceleration(self, accel):
+    def unlockBrake(self, aux, safety = False):
         pass
 
-    def waitForMotionCompletion(self):
-        sleep(5)
-        
+    def emitSpeed(self, speed, units = "mm per second"):
+        self.simulator.speed = speed / 60.0 if units == "mm per minute" else speed
+
+    def emitAcceleration(self, accel, units = "mm per second"):
+        self.simulator.acceleration = accel / 3600.0 if units == "mm per minute" else accel
+
+    def waitForMotionCompletion(self, timeout = None, **kwargs):
+        startTime = self.simulator.now()
+        stopGeneration = self.__stopGeneration
+
+        if not self.simulator.waitForMotionCompletion(timeout):
+            raise self.MotionCompletionTimeout("Motion not completed after " + str(timeout) + " seconds : " + str(self.ip))
+
+        completed = stopGeneration == self.__stopGeneration
+        return { "completed": completed, "elapsedSeconds": self.simulator.now() - startTime, "pollCount": 1 }
+
     def emitStop(self):
         self.logger.debug("Please Stop...")
         self._complete_batching = True
+        self.__stopGeneration += 1
+        self.simulator.stop()
+        self.simulator.sleep(0.8)           # Like the real emitStop
 
     def configMachineMotionIp(self, mode, ip, gateway, mask):
         pass
 
     def emitAbsoluteMove(self, axis, position):
         self.logger.debug("Move: {} to {}".format(axis, position))
-        pass
+        self.simulator.queueMove({ axis: position })
 
     def emitCombinedAxesAbsoluteMove(self, axes, positions):
         self.logger.debug("Move: {} to {}".format(axes, positions))
-        pass
+        self.simulator.queueMove(dict(zip(axes, positions)))
 
     def emitRelativeMove(self, axis, direction, distance):
         self.logger.debug("Move: {} Axis in {} direction by {}".format(axis, direction, distance))
@@ -106,63 +176,148 @@ class MachineMotion:
             sign = 1
         else:
             sign = -1
-        self.current_position[axis] = self.current_position[axis] + (distance * sign)
-        
+        self.simulator.queueRelativeMove({ axis: distance * sign })
+
+    def emitCombinedAxisRelativeMove(self, axes, directions, distances):
+        self.logger.debug("Move: {} Axes in {} directions by {}".format(axes, directions, distances))
+        signedDistances = {}
+        for axis, direction, distance in zip(axes, directions, distances):
+            signedDistances[axis] = distance if direction == "positive" else -distance
+        self.simulator.queueRelativeMove(signedDistances)
+
     def digitalWrite(self, deviceNetworkId, pin, value):
         self.logger.debug("Writing (pin={}, networkId={}, value={})".format(pin, deviceNetworkId, value))
-        pass
+        self.simulator.writeOutput(deviceNetworkId, pin, value)
 
     def digitalRead(self, deviceNetworkId, pin):
-        return 0
+        return self.simulator.readInput(deviceNetworkId, pin)
 
     def configAxisDirection(self, axis, direction):
         pass
 
-    def emitHome(self, accel):
-        pass
+    def emitHome(self, axis):
+        self.simulator.queueHome([ axis ])
 
     def emitHomeAll(self):
-        pass
+        for axis in MotionSimulator.AXES:       # Axes home one after the other
+            self.simulator.queueHome([ axis ])
 
     def detectIOModules(self):
         pass
 
     def emitgCode(self, gCode):
         self.logger.debug("Emitting gcode, Line: {}".format(gCode))
-        pass
-
-    def emitgCodeBatch(self, gCodeList, onDataReceived, onKillFuncReceived):
+        self.__executegCode(gCode)
+        return "echo: " + gCode + "\nok\n"
+
+    def __executegCode(self, gCode):
+        '''
+        Simulates the subset of g-code that moves the machine (G0/G1, G28, G90/G91, G92, M204, M400, M410).
+        Anything else is accepted and ignored.
+        '''
+        words = { letter.upper(): value for letter, value in re.findall(r'([A-Za-z])\s*(-?[0-9.]*)', gCode.split(';')[0]) }
+        axisValues = {}
+        for axis, name in MotionSimulator.AXIS_NAMES.items():
+            if name.upper() in words and words[name.upper()] != '':
+                axisValues[axis] = float(words[name.upper()])
+
+        command = None
+        if 'G' in words:
+            command = 'G' + str(int(float(words['G'])))
+        elif 'M' in words:
+            command = 'M' + str(int(float(words['M'])))
+
+        if command in ('G0', 'G1'):
+            if 'F' in words and words['F'] != '':
+                self.simulator.speed = float(words['F']) / 60.0
+            if len(axisValues) == 0:
+                return
+            if self.__isRelative:
+                self.simulator.queueRelativeMove(axisValues)
+            else:
+                self.simulator.queueMove(axisValues)
+        elif command == 'G28':
+            homedAxes = [ axis for axis, name in MotionSimulator.AXIS_NAMES.items() if name.upper() in words ]
+            if len(homedAxes) == 0:
+                homedAxes = MotionSimulator.AXES
+            for axis in homedAxes:
+                self.simulator.queueHome([ axis ])
+        elif command == 'G90':
+            self.__isRelative = False
+        elif command == 'G91':
+            self.__isRelative = True
+        elif command == 'G92':
+            for axis, position in axisValues.items():
+                self.simulator.setPosition(axis, position)
+        elif command == 'M204' and 'T' in words and words['T'] != '':
+            self.simulator.acceleration = float(words['T'])
+        elif command == 'M400':
+            self.simulator.waitForMotionCompletion()
+        elif command == 'M410':
+            self.simulator.stop()
+
+    def emitgCodeBatch(self, gCodeList, onDataReceived = None, onKillFuncReceived = None):
         self._complete_batching = False
+        linesSent = 0
         for idx, gcode in enumerate(gCodeList):
-            if self._is_stopped:
-                return
-
-            if self._complete_batching:
+            if self._is_stopped or self._complete_batching:
                 self._complete_batching = False
-                return
+                if onKillFuncReceived is not None:
+                    onKillFuncReceived()
+                return linesSent
+
+            gcode = gcode.strip()
+            if len(gcode) == 0 or gcode.startswith(';'):
+                continue
+
+            reply = self.emitgCode(gcode)
+            linesSent += 1
+            if onDataReceived is not None:
+                onDataReceived([ { "index": idx, "line": gcode, "reply": reply } ])
 
-            self.emitgCode(gcode)
-            onDataReceived([ { "index": idx, "line": gcode } ])
-            sleep(0.5)
+        if self._is_stopped or self._complete_batching:
+            self._complete_batching = False
+            if onKillFuncReceived is not None:
+                onKillFuncReceived()
+
+        return linesSent
+
+    def createMotionProgram(self, mergeMoves = True):
+        return MotionProgram(self, mergeMoves)
+
+    def submitMotionProgram(self, program, onDataReceived = None, onKillFuncReceived = None):
+        lines, _ = program.compile()
+        return self.emitgCodeBatch(lines, onDataReceived, onKillFuncReceived)
 
     def getCurrentPositions(self):
-        return self.current_position
+        return self.simulator.getPositions()
 
     def getCurrentSteps(self):
-        return self.current_position
+        return self.simulator.getPositions()
 
     def getEndStopState(self):
-        return {
-            "x_min": "TRIGGERED",
-            "y_min": "TRIGGERED",
-            "z_min": "TRIGGERED",
-            "x_max": "TRIGGERED",
-            "y_max": "TRIGGERED",
-            "z_max": "TRIGGERED"
-        }
+        return self.simulator.getEndStopStates()
 
     def setPosition(self, axis, value):
-        pass
+        self.simulator.setPosition(axis, value)
+
+    def enableTelemetry(self, refreshIntervalSeconds = TelemetryService.DEFAULT_REFRESH_INTERVAL_SECONDS, refreshEndStops = True):
+        if self.__telemetry is None:
+            self.__telemetry = TelemetryService(self, refreshIntervalSeconds, refreshEndStops)
+        else:
+            self.__telemetry.refreshIntervalSeconds = refreshIntervalSeconds
+            self.__telemetry.refreshEndStops = refreshEndStops
+
+        self.__telemetry.start()
+        return self.__telemetry
+
+    def disableTelemetry(self):
+        if self.__telemetry is not None:
+            self.__telemetry.stop()
+            self.__telemetry = None
+
+    def getTelemetry(self):
+        return self.__telemetry
 
     def setBatchNotificationState(self, toggleOn):
         if (toggleOn):
@@ -171,13 +326,16 @@ class MachineMotion:
             return self.emitgCode("V6 P0")
 
     def bindeStopEvent(self, callback):
-        pass
+        self.eStopCallback = callback
 
     def setContinuousMove(self, axis, speed, accel = None):
-        pass
+        # Runs towards the end stop in the direction of the speed
+        if accel is not None:
+            self.simulator.acceleration = accel
+        self.simulator.queueMove({ axis: self.simulator.axisLengths[axis] if speed > 0 else 0 }, abs(speed))
 
     def stopContinuousMove(self, axis, accel = None):
-        pass
+        self.simulator.stop()
 
     def registerInput(self, name, digitalIo, pin):
         self.__registeredInputMap[name] = 'devices/io-expander/' + str(digitalIo) + '/digital-input/' + str(pin)
@@ -189,4 +347,37 @@ class MachineMotion:
         return self.__registeredInputMap[name]
 
     def isEstopped(self):
-        return False
\ No newline at end of file
+        return self._is_stopped
+
+    def runAsync(self, func, *args, **kwargs):
+        return self.__asyncExecutor.submit(func, *args, **kwargs)
+
+    def emitSpeedAsync(self, speed, units = "mm per second"):
+        return self.runAsync(self.emitSpeed, speed, units)
+
+    def emitAccelerationAsync(self, accel, units = "mm per second"):
+        return self.runAsync(self.emitAcceleration, accel, units)
+
+    def emitAbsoluteMoveAsync(self, axis, position):
+        return self.runAsync(self.emitAbsoluteMove, axis, position)
+
+    def emitCombinedAxesAbsoluteMoveAsync(self, axes, positions):
+        return self.runAsync(self.emitCombinedAxesAbsoluteMove, axes, positions)
+
+    def emitRelativeMoveAsync(self, axis, direction, distance):
+        return self.runAsync(self.emitRelativeMove, axis, direction, distance)
+
+    def emitCombinedAxisRelativeMoveAsync(self, axes, directions, distances):
+        return self.runAsync(self.emitCombinedAxisRelativeMove, axes, directions, distances)
+
+    def emitHomeAsync(self, axis):
+        return self.runAsync(self.emitHome, axis)
+
+    def emitHomeAllAsync(self):
+        return self.runAsync(self.emitHomeAll)
+
+    def emitgCodeAsync(self, gCode):
+        return self.runAsync(self.emitgCode, gCode)
+
+    def waitForMotionCompletionAsync(self, timeout = None):
+        return self.runAsync(self.waitForMotionCompletion, timeout)
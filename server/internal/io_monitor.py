@@ -1,4 +1,5 @@
 from internal.notifier import getNotifier, NotificationLevel
+from threading import Event, Lock, Thread
 
 class IOValue:
     def __init__(self, name, device, pin):
@@ -6,6 +7,7 @@ class IOValue:
         self.device = device
         self.pin = pin
         self.state = 0
+        self.hasReceivedValue = False
 
     def isEqual(self, device, pin):
         return self.device == device and self.pin == pin
@@ -22,14 +24,40 @@ class IOMonitor:
     '''
     Used to monitor the state of a group of IO modules and return their
     current values to the Web Client via the Notifier.
+
+    The state of every monitored IO is sent in a single IO_STATE_SNAPSHOT message whose
+    payload maps each IO name to its value. Changes are not sent one by one: a snapshot goes
+    out at most every snapshotIntervalSeconds when any IO changed, so a burst of changes
+    costs one message. Without changes, the snapshot is still sent every
+    REFRESH_INTERVAL_SECONDS so that clients that connect later are brought up to date.
     '''
+    DEFAULT_SNAPSHOT_INTERVAL_SECONDS = 0.1
+    REFRESH_INTERVAL_SECONDS = 1.0
 
-    def __init__(self, machineMotion):
+    def __init__(self, machineMotion, snapshotIntervalSeconds=DEFAULT_SNAPSHOT_INTERVAL_SECONDS):
+        '''
+        params:
+            machineMotion: MachineMotion
+                Controller whose IO modules are monitored
+
+            snapshotIntervalSeconds: float
+                (Optional) Minimum time between two snapshot messages. This is the longest a
+                change waits before it is sent, and bounds the message rate.
+        '''
         self.__notifier = getNotifier()
         self.__machineMotion = machineMotion
 
-        self.__monitorList = []
-        self.__machineMotion.addMqttCallback(self.__mqttEventCallback)
+        self.__lock = Lock()
+        self.__monitoredByName = {}                 # Name -> IOValue
+        self.__monitoredByIo = {}                   # (device, pin) -> list of IOValue
+        self.__machineMotion.addMqttCallback(self.__mqttEventCallback, 'devices/io-expander/+/digital-input/+')
+
+        self.__snapshotIntervalSeconds = snapshotIntervalSeconds
+        self.__changedEvent = Event()               # Set when an IO changed since the last snapshot
+        self.__closedEvent = Event()
+        thread = Thread(name='IOMonitorSnapshot', target=self.__snapshotLoop)
+        thread.daemon = True
+        thread.start()
 
     def startMonitoring(self, name, device, pin):
         '''
@@ -49,12 +77,14 @@ class IOMonitor:
             bool
                 Specifies whether or not the provided name is already taken
         '''
-        for monitoredItem in self.__monitorList:
-            if monitoredItem.name == name:
+        with self.__lock:
+            if name in self.__monitoredByName:
                 return False
 
-        self.__monitorList.append(IOValue(name, device, pin))
-        return True
+            monitoredItem = IOValue(name, device, pin)
+            self.__monitoredByName[name] = monitoredItem
+            self.__monitoredByIo.setdefault((device, pin), []).append(monitoredItem)
+            return True
 
     def stopMonitoring(self, name):
         '''
@@ -68,28 +98,67 @@ class IOMonitor:
             bool
                 Whether or not it could be removed
         '''
-        for idx in range(self.__monitorList):
-            if self.__monitorList[idx].name == name:
-                del self.__monitorList[idx]
-                return True
-        
-        return False
+        with self.__lock:
+            monitoredItem = self.__monitoredByName.pop(name, None)
+            if monitoredItem == None:
+                return False
 
-    def __mqttEventCallback(self, topic, msg):
-        topicParts = topic.split('/')
-        deviceType = topicParts[1]
-        if deviceType != 'io-expander':
-            return
+            ioKey = (monitoredItem.device, monitoredItem.pin)
+            self.__monitoredByIo[ioKey].remove(monitoredItem)
+            if len(self.__monitoredByIo[ioKey]) == 0:
+                del self.__monitoredByIo[ioKey]
 
-        if (topicParts[3] == 'available'):
-            return
+            return True
 
+    def getSnapshot(self):
+        '''
+        Retrieves the current state of every monitored IO.
+
+        returns:
+            dict
+                Name of each monitored IO to its last known value
+        '''
+        with self.__lock:
+            return { name: item.state for name, item in self.__monitoredByName.items() }
+
+    def close(self):
+        ''' Stops the periodic snapshots and stops listening to IO updates '''
+        self.__closedEvent.set()
+        self.__changedEvent.set()
+        self.__machineMotion.removeMqttCallback(self.__mqttEventCallback, 'devices/io-expander/+/digital-input/+')
+
+    def __snapshotLoop(self):
+        while not self.__closedEvent.is_set():
+            self.__changedEvent.wait(IOMonitor.REFRESH_INTERVAL_SECONDS)
+            if self.__closedEvent.is_set():
+                break
+
+            # Changes received from here on go in the next snapshot
+            self.__changedEvent.clear()
+            snapshot = self.getSnapshot()
+            if len(snapshot) > 0:
+                # Snapshots are coalesced by the notifier: a client that has fallen behind only gets the latest
+                self.__notifier.sendMessage(NotificationLevel.IO_STATE_SNAPSHOT, '', snapshot)
+
+            # Changes received meanwhile are folded into the next snapshot
+            self.__closedEvent.wait(self.__snapshotIntervalSeconds)
+
+    def __mqttEventCallback(self, topic, msg):
+        # Only digital inputs are routed here (see the topic filter in the constructor)
+        topicParts = topic.split('/')
         device = int( topicParts[2] )
         pin = int( topicParts[4] )
         value  = msg
 
-        for monitorItem in self.__monitorList:
-            if monitorItem.isEqual(device, pin):
+        isChanged = False
+        with self.__lock:
+            for monitorItem in self.__monitoredByIo.get((device, pin), []):
+                if monitorItem.hasReceivedValue and monitorItem.state == value:
+                    continue # Only changes wake up the snapshot loop
+
                 monitorItem.state = value
-                self.__notifier.sendMessage(NotificationLevel.IO_STATE, '', monitorItem.toJson())
-                break
\ No newline at end of file
+                monitorItem.hasReceivedValue = True
+                isChanged = True
+
+        if isChanged:
+            self.__changedEvent.set()
@@ -5,14 +5,15 @@
 #                       ./documentation                             #
 
 # Import standard libraries
-import json, time, threading, sys
-
-# Import package dependent libraries
-import paho.mqtt.client as mqtt
-import paho.mqtt.subscribe as MQTTsubscribe
+import json, time, threading, sys, collections, random, socket
 
 import logging
-import traceback
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+
+from internal.mqtt_hub import getMqttHub
+from internal.topic_trie import TopicTrie
+from internal.telemetry import TelemetryService
+from internal.reply_parser import isAck, parsePositions, parseEndStops, isMotionCompleted
 
 import urllib
 # Import if python 2
@@ -22,6 +23,9 @@ if sys.version_info[0] < 3 :
 else :
     import http.client
 
+# Clock used to measure latencies
+_latencyClock = time.perf_counter if sys.version_info[0] >= 3 else time.time
+
 class CONTROL_DEVICE_SIGNALS:
     SIGNAL0 = "SIGNAL0"
     SIGNAL1 = "SIGNAL1"
@@ -127,38 +131,451 @@ class MQTT :
 
     TIMEOUT = 10.0 # Number of seconds while we wait for MQTT response
 
-def HTTPSend(host, path, data=None) :
-    # Note:
-    #   The intent of retrying upon failure here is primarily to reconnect to a dead or unreachable server.
-    #   The assumption is that an exception at this level reflects a server failure not to be expected by the client.
-    #   This behavior could be made optional.
-    while True :
-        lConn = None
-        try :
-            # Review: use keep-alive
+    # Request topic -> response topic, for the requests that expect an answer
+    RESPONSES = {
+        PATH.ESTOP_TRIGGER_REQUEST : PATH.ESTOP_TRIGGER_RESPONSE,
+        PATH.ESTOP_RELEASE_REQUEST : PATH.ESTOP_RELEASE_RESPONSE,
+        PATH.ESTOP_SYSTEMRESET_REQUEST : PATH.ESTOP_SYSTEMRESET_RESPONSE
+    }
+
+    # Topics that MachineMotion listens to
+    SUBSCRIPTIONS = [
+        'devices/io-expander/+/available',
+        'devices/io-expander/+/digital-input/#',
+        'devices/encoder/+/realtime-position',
+        'devices/encoder/+/stable-position',
+        PATH.ESTOP_STATUS,
+        PATH.AUX_PORT_SAFETY + '/+/status',
+        PATH.AUX_PORT_POWER + '/+/status'
+    ]
+
+def _newHTTPConnection(host, timeout = None) :
+    # If python 2
+    if sys.version_info[0] < 3 :
+        return httplib.HTTPConnection(host, timeout = timeout)
+    # Else python 3
+    else :
+        return http.client.HTTPConnection(host, timeout = timeout)
+
+# Errors raised while reading the reply when the server had closed an idle keep-alive socket
+# before our request reached it
+if sys.version_info[0] < 3 :
+    _STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, socket.error)
+else :
+    _STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
 
-            # If python 2
-            if sys.version_info[0] < 3 :
-                lConn = httplib.HTTPConnection(host)
-            # Else python 3
+#
+# Raised by HTTPConnectionPool.request when the request was sent but its reply could not be read
+# (e.g. the reply timeout expired). The controller may have executed the request, so it must
+# not be sent again.
+# @status
+#
+class HTTPReplyError(Exception) :
+
+    def __init__(self, host, cause) :
+        super(HTTPReplyError, self).__init__("No reply from %s: %s" % (host, cause))
+        self.host = host
+        self.cause = cause
+
+#
+# Thread-safe pool of persistent (keep-alive) HTTP/1.1 connections, keyed by host.
+# A connection is checked out for the duration of one request/response and handed
+# back to the pool afterwards. Sockets closed by the server while idle are re-opened.
+# @status
+#
+class HTTPConnectionPool :
+
+    def __init__(self, maxIdlePerHost = 4) :
+        self.maxIdlePerHost = maxIdlePerHost
+        self.__lock = threading.Lock()
+        self.__idleConnections = {}                     # host -> list of idle connections
+        self.__stats = {}                               # host -> { "connects", "reuses", "reconnects" }
+
+    def __getHostStats(self, host) :
+        if not host in self.__stats :
+            self.__stats[host] = { "connects": 0, "reuses": 0, "reconnects": 0 }
+        return self.__stats[host]
+
+    def __acquire(self, host) :
+        with self.__lock :
+            idleList = self.__idleConnections.get(host)
+            if idleList :
+                self.__getHostStats(host)["reuses"] += 1
+                return idleList.pop(), True
+
+            self.__getHostStats(host)["connects"] += 1
+
+        return None, False
+
+    def __release(self, host, lConn) :
+        with self.__lock :
+            idleList = self.__idleConnections.setdefault(host, [])
+            if len(idleList) < self.maxIdlePerHost :
+                idleList.append(lConn)
+                return
+
+        lConn.close()
+
+    def request(self, host, path, data=None, connectTimeout=None, replyTimeout=None) :
+        '''
+        desc: Sends a single request over a pooled connection and returns the raw response body.
+        note: If a reused connection turns out to have been closed by the server while idle, the request is sent again once on a fresh connection. Failures to connect or to send the request are raised as is. Once the request is sent, any other failure, including the reply timeout, raises HTTPReplyError and the request is never sent again. Timeouts are in seconds, None to wait forever.
+        '''
+        lConn, isReused = self.__acquire(host)
+        if lConn is None :
+            lConn = _newHTTPConnection(host, connectTimeout)
+
+        while True :
+            try :
+                if lConn.sock is None :
+                    lConn.timeout = connectTimeout
+                    lConn.connect()
+                lConn.sock.settimeout(replyTimeout)
+
+                if None == data:
+                    lConn.request("GET", path)
+                else:
+                    lConn.request("POST", path, data, {"Content-type": "application/octet-stream"})
+            except Exception :
+                lConn.close()
+                if not isReused :
+                    raise
+
+                # Stale keep-alive socket: reconnect and send again
+                with self.__lock :
+                    self.__getHostStats(host)["reconnects"] += 1
+                lConn, isReused = _newHTTPConnection(host, connectTimeout), False
+                continue
+
+            try :
+                lResponse = lConn.getresponse()
+                lBody = lResponse.read()
+            except socket.timeout as e :
+                lConn.close()
+                raise HTTPReplyError(host, e)
+            except _STALE_CONNECTION_ERRORS as e :
+                lConn.close()
+                if not isReused :
+                    raise HTTPReplyError(host, e)
+
+                # Closed by the server while idle, before our request reached it: reconnect and send again
+                with self.__lock :
+                    self.__getHostStats(host)["reconnects"] += 1
+                lConn, isReused = _newHTTPConnection(host, connectTimeout), False
+                continue
+            except Exception as e :
+                lConn.close()
+                raise HTTPReplyError(host, e)
+
+            if lResponse.will_close :
+                lConn.close()
             else :
-                lConn = http.client.HTTPConnection(host)
-
-            if None == data:
-                lConn.request("GET", path)
-            else:
-                lConn.request("POST", path, data, {"Content-type": "application/octet-stream"});
-            lResponse = lConn.getresponse()
-            lResponse = lResponse.read()
+                self.__release(host, lConn)
+
+            return lBody
+
+    def closeAll(self, host = None) :
+        '''
+        desc: Closes the idle connections of a single host, or of every host when none is given.
+        '''
+        with self.__lock :
+            hosts = [host] if host is not None else list(self.__idleConnections.keys())
+            closing = []
+            for h in hosts :
+                closing.extend(self.__idleConnections.pop(h, []))
+
+        for lConn in closing :
             lConn.close()
-            return str(lResponse) # Casting as a string is necessary for python3
-        except Exception :
-            logging.warning("Could not GET %s: %s" % (path, traceback.format_exc()))
-            if lConn :
-                lConn.close()
-                lConn = None
-            time.sleep(1)
-    return ""
+
+    def getStats(self, host = None) :
+        '''
+        desc: Returns how many connections were opened, reused and re-opened after a broken socket.
+        returnValue: The counters of the given host, or a dictionary of counters keyed by host.
+        returnValueType: Dictionary
+        '''
+        with self.__lock :
+            if host is not None :
+                return dict(self.__getHostStats(host))
+            return dict((h, dict(stats)) for h, stats in self.__stats.items())
+
+httpConnectionPool = HTTPConnectionPool()
+
+#
+# Bounded trace of the g-code commands sent to the controllers: verb, latency, reply size and
+# retries of every command, kept in a ring buffer, with a rolling window of latencies per verb
+# (G0, G90, V0, M114, ...) to compute percentiles. Recording is cheap: percentiles are only
+# computed when the statistics are queried.
+# @status
+#
+class GCodeTracer :
+
+    def __init__(self, capacity = 4096, windowPerVerb = 512) :
+        self.enabled = True
+        self.capacity = capacity
+        self.windowPerVerb = windowPerVerb
+        self.__lock = threading.Lock()
+        self.__traces = collections.deque(maxlen = capacity)
+        self.__verbs = {}                               # (host, verb) -> { "count", "retries", "totalSeconds", "latencies" }
+
+    @staticmethod
+    def getVerb(gCode) :
+        words = gCode.split(None, 1)
+        return words[0].upper() if len(words) > 0 else ""
+
+    def record(self, host, gCode, latencySeconds, replySize, retries) :
+        if not self.enabled : return
+
+        verb = GCodeTracer.getVerb(gCode)
+        with self.__lock :
+            self.__traces.append((time.time(), host, verb, gCode, latencySeconds, replySize, retries))
+
+            verbStats = self.__verbs.get((host, verb))
+            if verbStats is None :
+                verbStats = { "count": 0, "retries": 0, "totalSeconds": 0.0, "latencies": collections.deque(maxlen = self.windowPerVerb) }
+                self.__verbs[(host, verb)] = verbStats
+            verbStats["count"] += 1
+            verbStats["retries"] += retries
+            verbStats["totalSeconds"] += latencySeconds
+            verbStats["latencies"].append(latencySeconds)
+
+    def getTraces(self, host = None, count = None) :
+        '''
+        desc: Returns the most recent commands, oldest first.
+        returnValue: A list of dictionaries {timeSeconds, host, verb, gCode, latencyMs, replySize, retries}.
+        returnValueType: List
+        '''
+        with self.__lock :
+            traces = [ trace for trace in self.__traces if host is None or trace[1] == host ]
+
+        if count is not None :
+            traces = traces[-count:] if count > 0 else []
+
+        return [ { "timeSeconds": timeSeconds, "host": traceHost, "verb": verb, "gCode": gCode, "latencyMs": 1000 * latency, "replySize": replySize, "retries": retries }
+                    for (timeSeconds, traceHost, verb, gCode, latency, replySize, retries) in traces ]
+
+    def getStats(self, host = None) :
+        '''
+        desc: Returns latency statistics per verb, over every host or a single one.
+        returnValue: A dictionary keyed by verb of {count, retries, totalMs, meanMs, p50Ms, p95Ms, p99Ms, maxMs}. count, retries and totalMs cover every command, the percentiles only the most recent ones.
+        returnValueType: Dictionary
+        '''
+        merged = {}
+        with self.__lock :
+            for (verbHost, verb), verbStats in self.__verbs.items() :
+                if host is not None and verbHost != host : continue
+                entry = merged.setdefault(verb, { "count": 0, "retries": 0, "totalSeconds": 0.0, "latencies": [] })
+                entry["count"] += verbStats["count"]
+                entry["retries"] += verbStats["retries"]
+                entry["totalSeconds"] += verbStats["totalSeconds"]
+                entry["latencies"].extend(verbStats["latencies"])
+
+        stats = {}
+        for verb, entry in merged.items() :
+            latencies = sorted(entry["latencies"])
+            def percentile(fraction) :
+                return 1000 * latencies[min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))]
+
+            stats[verb] = {
+                "count"     : entry["count"],
+                "retries"   : entry["retries"],
+                "totalMs"   : 1000 * entry["totalSeconds"],
+                "meanMs"    : 1000 * entry["totalSeconds"] / entry["count"],
+                "p50Ms"     : percentile(0.50),
+                "p95Ms"     : percentile(0.95),
+                "p99Ms"     : percentile(0.99),
+                "maxMs"     : 1000 * latencies[-1]
+            }
+
+        return stats
+
+    def dump(self, path, host = None) :
+        '''
+        desc: Writes the statistics per verb and the traced commands to a JSON file.
+        '''
+        with open(path, "w") as dumpFile :
+            json.dump({ "stats": self.getStats(host), "traces": self.getTraces(host) }, dumpFile, indent = 4)
+
+    def clear(self) :
+        with self.__lock :
+            self.__traces.clear()
+            self.__verbs = {}
+
+gCodeTracer = GCodeTracer()
+
+#
+# Raised when a request to a controller could not be completed: every attempt allowed by the
+# HTTP retry policy failed, or the circuit breaker of the controller is open.
+# @status
+#
+class ControllerUnreachableError(Exception) :
+
+    def __init__(self, host, message, attempts = 0) :
+        super(ControllerUnreachableError, self).__init__("Controller %s unreachable: %s" % (host, message))
+        self.host = host
+        self.attempts = attempts
+
+#
+# How HTTPSend retries a request that could not be delivered: exponential backoff with random
+# jitter, bounded by a maximum number of attempts and by an overall deadline per request.
+# Only connection failures are retried. Once a request is sent, it is never sent again, since
+# g-code commands are not idempotent.
+# @status
+#
+class HTTPRetryPolicy :
+
+    def __init__(self, maxAttempts = 5, initialDelaySeconds = 0.1, maxDelaySeconds = 2.0, backoffFactor = 2.0, jitter = 0.25, deadlineSeconds = 10.0, connectTimeoutSeconds = 5.0, replyTimeoutSeconds = None, replyTimeoutsPerVerb = None) :
+        self.maxAttempts = maxAttempts                      # Attempts per request, including the first one. None for no limit
+        self.initialDelaySeconds = initialDelaySeconds      # Delay before the first retry
+        self.maxDelaySeconds = maxDelaySeconds              # Upper bound of the delay between two attempts
+        self.backoffFactor = backoffFactor                  # The delay is multiplied by this factor after each retry
+        self.jitter = jitter                                # Each delay is randomly shortened or lengthened by up to this fraction
+        self.deadlineSeconds = deadlineSeconds              # No retry is started past this time after the first attempt. None for no deadline
+        self.connectTimeoutSeconds = connectTimeoutSeconds  # Time allowed to connect to the controller. None to wait forever
+        self.replyTimeoutSeconds = replyTimeoutSeconds      # Time allowed for the reply once the request is sent. None to wait forever
+        self.replyTimeoutsPerVerb = replyTimeoutsPerVerb    # g-code verb -> reply timeout, overriding replyTimeoutSeconds. By default, homing and dwells wait forever
+        if self.replyTimeoutsPerVerb is None :
+            self.replyTimeoutsPerVerb = { "G28": None, "G4": None }
+
+    def getReplyTimeout(self, verb = None) :
+        '''
+        desc: Returns the reply timeout of a g-code verb (e.g. "G28"), or of a request that is not g-code when verb is None.
+        '''
+        if verb is not None and verb in self.replyTimeoutsPerVerb :
+            return self.replyTimeoutsPerVerb[verb]
+        return self.replyTimeoutSeconds
+
+    def getDelay(self, retry) :
+        '''
+        desc: Returns the time to wait before a retry (1 for the first retry).
+        '''
+        delay = min(self.maxDelaySeconds, self.initialDelaySeconds * (self.backoffFactor ** (retry - 1)))
+        return max(0.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+#
+# Per-host circuit breaker. After 'failureThreshold' failed connection attempts in a row, the circuit opens
+# and requests to the host fail right away for 'openSeconds'. Then a single trial request is let
+# through: the circuit closes if it succeeds and opens again if it fails.
+# @status
+#
+class CircuitBreaker :
+
+    CLOSED      = "closed"
+    OPEN        = "open"
+    HALF_OPEN   = "half_open"
+
+    def __init__(self, failureThreshold = 5, openSeconds = 5.0) :
+        self.failureThreshold = failureThreshold
+        self.openSeconds = openSeconds
+        self.__lock = threading.Lock()
+        self.__state = CircuitBreaker.CLOSED
+        self.__failureCount = 0
+        self.__openedAt = None
+
+    def allowRequest(self) :
+        with self.__lock :
+            if self.__state == CircuitBreaker.CLOSED :
+                return True
+
+            if self.__state == CircuitBreaker.OPEN and time.time() - self.__openedAt >= self.openSeconds :
+                self.__state = CircuitBreaker.HALF_OPEN       # Let this request through as the trial
+                return True
+
+            return False
+
+    def recordSuccess(self) :
+        with self.__lock :
+            self.__state = CircuitBreaker.CLOSED
+            self.__failureCount = 0
+
+    def recordFailure(self) :
+        '''
+        desc: Records a failed attempt.
+        returnValue: True if the circuit is open after this failure.
+        returnValueType: Boolean
+        '''
+        with self.__lock :
+            self.__failureCount += 1
+            if self.__state == CircuitBreaker.HALF_OPEN or self.__failureCount >= self.failureThreshold :
+                self.__state = CircuitBreaker.OPEN
+                self.__openedAt = time.time()
+            return self.__state == CircuitBreaker.OPEN
+
+    def getState(self) :
+        with self.__lock :
+            return self.__state
+
+httpRetryPolicy = HTTPRetryPolicy()
+circuitBreakerFailureThreshold = 5
+circuitBreakerOpenSeconds = 5.0
+_circuitBreakers = {}                                       # host -> CircuitBreaker
+_circuitBreakersLock = threading.Lock()
+
+def setHTTPRetryPolicy(policy) :
+    '''
+    desc: Replaces the retry policy used by every HTTP request to the controllers.
+    '''
+    global httpRetryPolicy
+    httpRetryPolicy = policy
+
+def getCircuitBreaker(host) :
+    with _circuitBreakersLock :
+        breaker = _circuitBreakers.get(host)
+        if breaker is None :
+            breaker = CircuitBreaker(circuitBreakerFailureThreshold, circuitBreakerOpenSeconds)
+            _circuitBreakers[host] = breaker
+        return breaker
+
+def HTTPSendCounted(host, path, data=None, policy=None, verb=None) :
+    '''
+    desc: Same as HTTPSend, but also returns how many times the request had to be sent again.
+    params:
+        verb:
+            desc: g-code verb of the request, used to pick its reply timeout. See HTTPRetryPolicy.getReplyTimeout.
+            type: String
+    returnValue: A tuple (reply, retries).
+    returnValueType: Tuple
+    note: Raises ControllerUnreachableError if the request could not be delivered, and HTTPReplyError if it was sent but no reply could be read.
+    '''
+    if policy is None :
+        policy = httpRetryPolicy
+
+    breaker = getCircuitBreaker(host)
+    if not breaker.allowRequest() :
+        raise ControllerUnreachableError(host, "circuit breaker open after repeated failures")
+
+    startTime = time.time()
+    attempts = 0
+    while True :
+        attempts += 1
+        try :
+            lResponse = httpConnectionPool.request(host, path, data, policy.connectTimeoutSeconds, policy.getReplyTimeout(verb))
+            breaker.recordSuccess()
+            return str(lResponse), attempts - 1 # Casting as a string is necessary for python3
+        except HTTPReplyError as e :
+            # The controller accepted the request: it is reachable, but the request may have been executed
+            breaker.recordSuccess()
+            logging.error("Sent %s to %s but got no reply: %s" % (path, host, e.cause))
+            raise
+        except Exception as e :
+            isOpen = breaker.recordFailure()
+            delay = policy.getDelay(attempts)
+
+            if isOpen :
+                reason = "circuit breaker opened"
+            elif policy.maxAttempts is not None and attempts >= policy.maxAttempts :
+                reason = "no more attempts"
+            elif policy.deadlineSeconds is not None and time.time() + delay - startTime > policy.deadlineSeconds :
+                reason = "deadline reached"
+            else :
+                logging.warning("Could not send %s to %s (attempt %d), retrying in %.2f s: %s" % (path, host, attempts, delay, e))
+                time.sleep(delay)
+                continue
+
+            logging.error("Could not send %s to %s after %d attempt(s), %s: %s" % (path, host, attempts, reason, e))
+            raise ControllerUnreachableError(host, "%s after %d attempt(s): %s" % (reason, attempts, e), attempts)
+
+def HTTPSend(host, path, data=None) :
+    return HTTPSendCounted(host, path, data)[0]
 
 #
 # Class that handles all gCode related communications
@@ -208,6 +625,14 @@ class GCode:
 
         return HTTPSend(self.myIp + self.libPort, cmd, data)
 
+    #
+    # Same as __send__, but also returns how many times the request had to be sent again.
+    # PRIVATE
+    #
+    def __sendCounted__(self, cmd, data=None, verb=None) :
+
+        return HTTPSendCounted(self.myIp + self.libPort, cmd, data, verb = verb)
+
     #
     # Function to send a raw G-Code ASCII command
     # @param gCode --- Description: gCode is string representing the G-Code command to send to the controller. Type: string.
@@ -215,12 +640,17 @@ class GCode:
     #
     def __emit__(self, gCode) :
 
+        startTime = _latencyClock()
+        verb = GCodeTracer.getVerb(gCode)
+
         # If python 2
         if sys.version_info[0] < 3 :
-            rep = self.__send__("/gcode?%s" % urllib.urlencode({"gcode": "%s" % gCode}))
+            rep, retries = self.__sendCounted__("/gcode?%s" % urllib.urlencode({"gcode": "%s" % gCode}), verb = verb)
         # Else python 3
         else :
-            rep = self.__send__("/gcode?%s" % urllib.parse.urlencode({"gcode": "%s" % gCode}))
+            rep, retries = self.__sendCounted__("/gcode?%s" % urllib.parse.urlencode({"gcode": "%s" % gCode}), verb = verb)
+
+        gCodeTracer.record(self.myIp + self.libPort, gCode, _latencyClock() - startTime, len(rep), retries)
 
         # Call user callback only if relevant
         if self.__userCallback__ is None : pass
@@ -275,6 +705,240 @@ class GCode:
 
         return
 
+#
+# Checks that a value is one of the constants of a class such as DIRECTION or AXIS_NUMBER.
+# PRIVATE
+#
+def _checkInputValue(argName, argValue, argClass):
+
+    validParams = [i for i in argClass.__dict__.keys() if i[:1] != '_']
+    validValues = [argClass.__dict__[i] for i in validParams]
+
+    if argValue in validValues:
+        pass
+    else:
+        class InvalidInput(Exception):
+            pass
+        errorMessage = "An invalid selection was made. Given parameter '" + str(argName) + "' must be one of the following values:"
+        for param in validParams:
+            errorMessage = errorMessage + "\n" + argClass.__name__ + "." + param + " (" + str(argClass.__dict__[param]) +")"
+        raise InvalidInput(errorMessage)
+
+    return
+
+#
+# Builder for a sequence of moves and speed or acceleration changes, compiled to as few g-code
+# lines as possible and sent to the controller in a single batch:
+#   - Speed, acceleration and positioning mode (G90/G91) are only sent when they change, and
+#     speed changes are folded into the next move line.
+#   - Consecutive moves on different axes, in the same positioning mode and with the same
+#     speed and acceleration, are merged into a single combined move line.
+#
+# Merged moves run simultaneously, like emitCombinedAxesAbsoluteMove, instead of one after the
+# other. Create the program with mergeMoves = False, or call breakMerge between two moves, where
+# the order of the moves matters.
+#
+#   program = machineMotion.createMotionProgram()
+#   program.emitSpeed(200).emitAbsoluteMove(1, 100).emitAbsoluteMove(2, 50)
+#   program.submit()                # Sends "G90" and "G0 X100 Y50 F12000" at most
+# @status
+#
+class MotionProgram :
+
+    AXIS_NAMES = { 1: "X", 2: "Y", 3: "Z" }
+
+    def __init__(self, machineMotion = None, mergeMoves = True) :
+        self.machineMotion = machineMotion
+        self.mergeMoves = mergeMoves
+        self.__operations = []
+
+    def __len__(self) :
+        return len(self.__operations)
+
+    def emitSpeed(self, speed, units = UNITS_SPEED.mm_per_sec) :
+        _checkInputValue("units", units, UNITS_SPEED)
+
+        if units == UNITS_SPEED.mm_per_min:
+            speed_mm_per_min = speed
+        elif units == UNITS_SPEED.mm_per_sec:
+            speed_mm_per_min = 60*speed
+
+        self.__operations.append(("feedrate", speed_mm_per_min))
+        return self
+
+    def emitAcceleration(self, acceleration, units = UNITS_ACCEL.mm_per_sec_sqr) :
+        _checkInputValue("units", units, UNITS_ACCEL)
+
+        if units == UNITS_ACCEL.mm_per_sec_sqr:
+            accel_mm_per_sec_sqr = acceleration
+        elif units == UNITS_ACCEL.mm_per_min_sqr:
+            accel_mm_per_sec_sqr = acceleration/3600
+
+        self.__operations.append(("acceleration", accel_mm_per_sec_sqr))
+        return self
+
+    def emitAbsoluteMove(self, axis, position) :
+        return self.emitCombinedAxesAbsoluteMove([axis], [position])
+
+    def emitCombinedAxesAbsoluteMove(self, axes, positions) :
+        if (not isinstance(axes, list) or not isinstance(positions, list)):
+            raise TypeError("Axes and Postions must be lists")
+
+        for axis in axes:
+            _checkInputValue("axis", axis, AXIS_NUMBER)
+
+        self.__operations.append(("move", "G90", list(zip(axes, [ str(position) for position in positions ]))))
+        return self
+
+    def emitRelativeMove(self, axis, direction, distance) :
+        return self.emitCombinedAxisRelativeMove([axis], [direction], [distance])
+
+    def emitCombinedAxisRelativeMove(self, axes, directions, distances) :
+        if (not isinstance(axes, list) or not isinstance(directions, list) or not isinstance(distances, list)):
+            raise TypeError("Axes, Postions and Distances must be lists")
+
+        moves = []
+        for axis, direction, distance in zip(axes, directions, distances):
+            _checkInputValue("axis", axis, AXIS_NUMBER)
+            _checkInputValue("direction", direction, DIRECTION)
+
+            if direction == DIRECTION.POSITIVE :
+                distance = "" + str(distance)
+            elif direction  == DIRECTION.NEGATIVE :
+                distance = "-" + str(distance)
+            moves.append((axis, distance))
+
+        self.__operations.append(("move", "G91", moves))
+        return self
+
+    def emitHome(self, axis) :
+        _checkInputValue("axis", axis, AXIS_NUMBER)
+        self.__operations.append(("line", "G28 " + MotionProgram.AXIS_NAMES[axis]))
+        return self
+
+    def emitHomeAll(self) :
+        self.__operations.append(("line", "G28"))
+        return self
+
+    def setPosition(self, axis, position) :
+        _checkInputValue("axis", axis, AXIS_NUMBER)
+        self.__operations.append(("line", "G92 " + MotionProgram.AXIS_NAMES[axis] + str(position)))
+        return self
+
+    def emitgCode(self, gCode) :
+        '''
+        desc: Adds a raw g-code line. The speed, acceleration and positioning mode are unknown after it, so they are sent again by the next move.
+        '''
+        self.__operations.append(("raw", gCode))
+        return self
+
+    def breakMerge(self) :
+        '''
+        desc: Prevents the moves added before and after this call from being merged.
+        '''
+        self.__operations.append(("break",))
+        return self
+
+    def compile(self, modalState = None) :
+        '''
+        desc: Compiles the program to g-code lines.
+        params:
+            modalState:
+                desc: Known positioning mode ("G90" or "G91"), feedrate (mm/min) and acceleration (mm/s^2) of the controller, as {"positioning", "feedrate", "acceleration"}. Unknown values (None or missing) are always sent.
+                type: Dictionary
+        returnValue: A tuple (lines, modalState), where modalState is the state of the controller once every line is executed.
+        returnValueType: Tuple
+        '''
+        state = { "positioning": None, "feedrate": None, "acceleration": None }
+        if modalState is not None :
+            for key in state.keys() :
+                state[key] = modalState.get(key)
+
+        lines = []
+        pending = { "feedrate": None, "acceleration": None }       # Requested, not sent yet
+        openMove = []                                               # [positioning, [(axis, value)], feedrate or None], not sent yet
+
+        def isChange(key) :
+            return pending[key] is not None and pending[key] != state[key]
+
+        def closeMove() :
+            if len(openMove) == 0 : return
+            positioning, moves, feedrate = openMove
+            line = "G0 " + " ".join(MotionProgram.AXIS_NAMES[axis] + value for axis, value in moves)
+            if feedrate is not None :
+                line += " F" + str(feedrate)
+            lines.append(line)
+            del openMove[:]
+
+        def sendPending() :
+            if isChange("acceleration") :
+                lines.append("M204 T" + str(pending["acceleration"]))
+                state["acceleration"] = pending["acceleration"]
+            if isChange("feedrate") :
+                lines.append("G0 F" + str(pending["feedrate"]))
+                state["feedrate"] = pending["feedrate"]
+            pending["feedrate"] = pending["acceleration"] = None
+
+        for operation in self.__operations :
+            kind = operation[0]
+
+            if kind in ("feedrate", "acceleration") :
+                pending[kind] = operation[1]
+
+            elif kind == "move" :
+                positioning, moves = operation[1], operation[2]
+                movedAxes = [ axis for axis, _ in moves ]
+
+                canMerge = self.mergeMoves and len(openMove) > 0 and openMove[0] == positioning and not isChange("feedrate") and not isChange("acceleration") \
+                    and len(movedAxes) == len(set(movedAxes)) and not any(axis in [ openAxis for openAxis, _ in openMove[1] ] for axis in movedAxes)
+                if canMerge :
+                    openMove[1].extend(moves)
+                    pending["feedrate"] = pending["acceleration"] = None
+                    continue
+
+                closeMove()
+                if isChange("acceleration") :
+                    lines.append("M204 T" + str(pending["acceleration"]))
+                    state["acceleration"] = pending["acceleration"]
+                if positioning != state["positioning"] :
+                    lines.append(positioning)
+                    state["positioning"] = positioning
+
+                feedrate = None
+                if isChange("feedrate") :
+                    feedrate = pending["feedrate"]
+                    state["feedrate"] = feedrate
+                pending["feedrate"] = pending["acceleration"] = None
+
+                openMove.extend([ positioning, list(moves), feedrate ])
+
+            elif kind == "line" :
+                closeMove()
+                lines.append(operation[1])
+
+            elif kind == "raw" :
+                closeMove()
+                sendPending()
+                lines.append(operation[1])
+                state = { "positioning": None, "feedrate": None, "acceleration": None }
+
+            elif kind == "break" :
+                closeMove()
+
+        closeMove()
+        sendPending()           # Speed or acceleration requested after the last move
+
+        return lines, state
+
+    def submit(self, onDataReceived = None, onKillFuncReceived = None) :
+        '''
+        desc: Sends the program to the MachineMotion it was created by. See MachineMotion.submitMotionProgram.
+        '''
+        if self.machineMotion is None :
+            raise Exception("This MotionProgram is not bound to a MachineMotion, use MachineMotion.submitMotionProgram")
+
+        return self.machineMotion.submitMotionProgram(self, onDataReceived, onKillFuncReceived)
+
 #
 # Class used to encapsulate the MachineMotion controller
 # @status
@@ -288,6 +952,12 @@ class MachineMotion :
     class HomingSpeedOutOfBounds(Exception):
         pass
 
+    class MotionCompletionTimeout(Exception):
+        pass
+
+    ControllerUnreachableError = ControllerUnreachableError
+    HTTPReplyError = HTTPReplyError
+
     # Class constructor
     def __init__(self, machineIp, gCodeCallback=None) :
 
@@ -304,15 +974,42 @@ class MachineMotion :
         self.myConfiguration['machineIp'] = machineIp
         self.IP = machineIp
 
-        # MQTT
-        self.mqttCallbacks = []                         # Custom MachineApp template variable
-        self.myMqttClient = None
-        self.myMqttClient = mqtt.Client()
-        self.myMqttClient.on_connect = self.__onConnect
-        self.myMqttClient.on_message = self.__onMessage
-        self.myMqttClient.on_disconnect = self.__onDisconnect
-        self.myMqttClient.connect(machineIp)
-        self.myMqttClient.loop_start()
+        # Modal state cache (positioning mode, feedrate, acceleration, per-axis V5 mode)
+        self.__modalLock = threading.RLock()
+        self.__modalGeneration = 0                      # Incremented every time the cache is invalidated
+        self.__modalSends = {}                          # Key -> token of the latest modal command sent for it and not acknowledged yet
+        self.invalidateModalState()
+
+        # Motion completion waits
+        self.__motionCondition = threading.Condition()
+        self.__motionCancelGeneration = 0               # Incremented on stop and e-stop to cancel pending waits
+        self.__motionSignalCount = 0                    # Incremented on every push-based completion signal
+        self.__motionCompletionTopic = None
+
+        # Asynchronous API
+        self.__asyncLock = threading.Lock()
+        self.__asyncExecutor = None                     # Created on first use
+        self.__pendingFutures = set()
+
+        # Cached positions and end stop states, refreshed in the background once enabled
+        self.__telemetry = None
+
+        # MQTT (the connection to the broker is shared with every other user of this IP)
+        self.__mqttCallbacks = TopicTrie()              # Custom MachineApp template variable: topic filter -> callbacks
+        self.__mqttCallbackLock = threading.Lock()
+        self.__mqttHub = getMqttHub(machineIp)
+        self.myMqttClient = self.__mqttHub.client
+        self.__mqttHub.addConnectionListener(self.__onConnect, self.__onDisconnect)
+        for topic in MQTT.SUBSCRIPTIONS :
+            self.__mqttHub.subscribe(topic, self.__onMessage)
+
+        # MQTT requests waiting for their response: response topic -> (deadline, Future), oldest first.
+        # Response topics are subscribed up front, so a request is a single publish.
+        self.__mqttRequestLock = threading.Lock()
+        self.__pendingMqttRequests = {}
+        for topic in MQTT.RESPONSES.values() :
+            self.__pendingMqttRequests[topic] = collections.deque()
+            self.__mqttHub.subscribe(topic, self.__onMqttResponse)
 
         # Default callback
         def emptyCallBack(data) : pass
@@ -339,20 +1036,7 @@ class MachineMotion :
     #If the parameter does not belong to the class, it raises a descriptive error.
     def _restrictInputValue(self, argName, argValue, argClass):
 
-        validParams = [i for i in argClass.__dict__.keys() if i[:1] != '_']
-        validValues = [argClass.__dict__[i] for i in validParams]
-
-        if argValue in validValues:
-            pass
-        else:
-            class InvalidInput(Exception):
-                pass
-            errorMessage = "An invalid selection was made. Given parameter '" + str(argName) + "' must be one of the following values:"
-            for param in validParams:
-                errorMessage = errorMessage + "\n" + argClass.__name__ + "." + param + " (" + str(argClass.__dict__[param]) +")"
-            raise InvalidInput(errorMessage)
-
-        return
+        return _checkInputValue(argName, argValue, argClass)
 
     def setContinuousMove(self, axis, speed, accel = 100) :
 
@@ -383,17 +1067,12 @@ class MachineMotion :
             if not isinstance(accel, (int, float)) : raise Exception('Error in accel variable type')
 
         # set motor to speed mode
-        reply = self.myGCode.__emit__("V5 " + self.getAxisName(axis) + "2")
-
-        if ( "echo" in reply and "ok" in reply ) : pass
-        else :
-            raise Exception('Error in gCode execution')
-            return False
+        self.__emitModal(("axisMode", axis), 2, "V5 " + self.getAxisName(axis) + "2")
 
         # Send speed command with accel
         reply = self.myGCode.__emit__("V4 S" + str(speed / self.mech_gain[axis] * STEPPER_MOTOR.steps_per_turn * self.u_step[axis]) + " A" + str(accel / self.mech_gain[axis] * STEPPER_MOTOR.steps_per_turn * self.u_step[axis]) + " " + self.getAxisName(axis))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else :
             raise Exception('Error in gCode execution')
             return False
@@ -424,7 +1103,7 @@ class MachineMotion :
         # Send speed command with accel
         reply = self.myGCode.__emit__("V4 S0" + " A" + str(accel / self.mech_gain[axis] * STEPPER_MOTOR.steps_per_turn * self.u_step[axis]) + " " + self.getAxisName(axis))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else :
             raise Exception('Error in gCode execution')
             return False
@@ -446,48 +1125,28 @@ class MachineMotion :
 
         if rotation is not None :
             # set motor to position mode
-            reply = self.myGCode.__emit__("V5 " + self.getAxisName(motor) + "1")
-
-            if ( "echo" in reply and "ok" in reply ) : pass
-            else :
-                raise Exception('Error in gCode execution')
-                return False
+            self.__emitModal(("axisMode", motor), 1, "V5 " + self.getAxisName(motor) + "1")
 
             if speed is not None :
                 # send speed command (need to convert rotation/s to mm/min )
-                reply = self.myGCode.__emit__("G0 F" + str(speed * 60 * self.mech_gain[motor]))
-
-                if ( "echo" in reply and "ok" in reply ) : pass
-                else :
-                    raise Exception('Error in gCode execution')
-                    return False
-
+                feedrate = speed * 60 * self.mech_gain[motor]
+                self.__emitModal("feedrate", feedrate, "G0 F" + str(feedrate))
 
             if accel is not None :
                 # send accel command (need to convert rotation/s^2 to mm/s^2)
-                reply = self.myGCode.__emit__("M204 T" + str(accel * self.mech_gain[motor]))
-
-                if ( "echo" in reply and "ok" in reply ) : pass
-                else :
-                    raise Exception('Error in gCode execution')
-                    return False
+                acceleration = accel * self.mech_gain[motor]
+                self.__emitModal("acceleration", acceleration, "M204 T" + str(acceleration))
 
             if reference is "absolute" :
                 # send absolute move command
 
                 # Set to absolute motion mode
-                reply = self.myGCode.__emit__("G90")
-
-                if ( "echo" in reply and "ok" in reply ) :
+                self.__emitModal("positioning", "G90", "G90")
 
-                    # Transmit move command
-                    reply = self.myGCode.__emit__("G0 " + self.getAxisName(motor) + str(rotation * self.mech_gain[motor]))
-
-                    if ( "echo" in reply and "ok" in reply ) : pass
-                    else :
-                        raise Exception('Error in gCode execution')
-                        return False
+                # Transmit move command
+                reply = self.myGCode.__emit__("G0 " + self.getAxisName(motor) + str(rotation * self.mech_gain[motor]))
 
+                if isAck(reply) : pass
                 else :
                     raise Exception('Error in gCode execution')
                     return False
@@ -495,17 +1154,12 @@ class MachineMotion :
             elif reference is "relative" :
                 # send relative move command
                 # Set to relative motion mode
-                reply = self.myGCode.__emit__("G91")
-
-                if ( "echo" in reply and "ok" in reply ) :
-                    # Transmit move command
-                    reply = self.myGCode.__emit__("G0 " + self.getAxisName(motor) + str(rotation * self.mech_gain[motor]))
+                self.__emitModal("positioning", "G91", "G91")
 
-                    if ( "echo" in reply and "ok" in reply ) : pass
-                    else :
-                        raise Exception('Error in gCode execution')
-                        return False
+                # Transmit move command
+                reply = self.myGCode.__emit__("G0 " + self.getAxisName(motor) + str(rotation * self.mech_gain[motor]))
 
+                if isAck(reply) : pass
                 else :
                     raise Exception('Error in gCode execution')
                     return False
@@ -522,17 +1176,12 @@ class MachineMotion :
         else :
             if speed is not None and accel is not None :
                 # set motor to speed mode
-                reply = self.myGCode.__emit__("V5 " + self.getAxisName(motor) + "2")
-
-                if ( "echo" in reply and "ok" in reply ) : pass
-                else :
-                    raise Exception('Error in gCode execution')
-                    return False
+                self.__emitModal(("axisMode", motor), 2, "V5 " + self.getAxisName(motor) + "2")
 
                 # Send speed command
                 reply = self.myGCode.__emit__("V4 S" + str(speed * STEPPER_MOTOR.steps_per_turn * self.u_step[motor]) + " A" + str(accel * STEPPER_MOTOR.steps_per_turn * self.u_step[motor]) + " " + self.getAxisName(motor))
 
-                if ( "echo" in reply and "ok" in reply ) : pass
+                if isAck(reply) : pass
                 else :
                     raise Exception('Error in gCode execution')
                     return False
@@ -609,23 +1258,11 @@ class MachineMotion :
         exampleCodePath: getCurrentPositions.py
         '''
 
-        positions = {
-            1 : None,
-            2 : None,
-            3 : None
-        }
-
-        reply = self.myGCode.__emit__("M114")
+        result = parsePositions(self.myGCode.__emit__("M114"))
 
-        if ( "echo" in reply and "ok" in reply ) :
+        if not result.isAck : raise Exception('Error in gCode execution')
 
-            positions[1] = float(reply[reply.find('X')+2:(reply.find('Y')-1)])
-            positions[2] = float(reply[reply.find('Y')+2:(reply.find('Z')-1)])
-            positions[3] = float(reply[reply.find('Z')+2:(reply.find('E')-1)])
-
-        else : raise Exception('Error in gCode execution')
-
-        return positions
+        return result.positions
 
     def getEndStopState(self):
         '''
@@ -635,87 +1272,11 @@ class MachineMotion :
         exampleCodePath: getEndStopState.py
         '''
 
-        states = {
-            'x_min' : None,
-            'x_max' : None,
-            'y_min' : None,
-            'y_max' : None,
-            'z_min' : None,
-            'z_max' : None,
-        }
-
-        def trimUntil(S, key) :
-            return S[S.find(key) + len(key) :]
-
-        reply = self.myGCode.__emit__("M119")
-
-        if ( "echo" in reply and "ok" in reply ) :
-            #Remove first line (echo line)
-            reply = trimUntil(reply, "\n")
-
-            if "x_min" in reply :
-                keyB = "x_min: "
-                keyE = " \n"
-                states['x_min'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
-
-                #Remove x_min line
-                reply = trimUntil(reply, "\n")
-
-            else : raise Exception('Error in gCode')
-
-            if "x_max" in reply :
-                keyB = "x_max: "
-                keyE = " \n"
-                states['x_max'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
+        result = parseEndStops(self.myGCode.__emit__("M119"))
 
-                #Remove x_max line
-                reply = trimUntil(reply, "\n")
+        if not result.isAck : raise Exception('Error in gCode execution')
 
-            else : raise Exception('Error in gCode')
-
-            if "y_min" in reply :
-                keyB = "y_min: "
-                keyE = " \n"
-                states['y_min'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
-
-                #Remove y_min line
-                reply = trimUntil(reply, "\n")
-
-            else : raise Exception('Error in gCode')
-
-            if "y_max" in reply :
-                keyB = "y_max: "
-                keyE = " \n"
-                states['y_max'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
-
-                #Remove y_max line
-                reply = trimUntil(reply, "\n")
-
-            else : raise Exception('Error in gCode')
-
-            if "z_min" in reply :
-                keyB = "z_min: "
-                keyE = " \n"
-                states['z_min'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
-
-                #Remove z_min line
-                reply = trimUntil(reply, "\n")
-
-            else : raise Exception('Error in gCode')
-
-            if "z_max" in reply :
-                keyB = "z_max: "
-                keyE = " \n"
-                states['z_max'] = reply[(reply.find(keyB) + len(keyB)) : (reply.find(keyE))]
-
-                #Remove z_max line
-                reply = trimUntil(reply, "\n")
-
-            else : raise Exception('Error in gCode')
-
-        else : raise Exception('Error in gCode execution')
-
-        return states
+        return result.states
 
     def emitStop(self):
         '''
@@ -724,9 +1285,11 @@ class MachineMotion :
         exampleCodePath: emitStop.py
         '''
 
+        self.__cancelMotionWaits()
+
         reply = self.myGCode.__emit__("M410")
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         # Wait to insure that other commands after the emit stop are not flushed.
@@ -742,7 +1305,7 @@ class MachineMotion :
 
         reply = self.myGCode.__emit__("G28")
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -761,7 +1324,7 @@ class MachineMotion :
 
         reply = self.myGCode.__emit__("G28 " + self.myGCode.__getTrueAxis__(axis))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -787,10 +1350,7 @@ class MachineMotion :
         elif units == UNITS_SPEED.mm_per_sec:
             speed_mm_per_min = 60*speed
 
-        reply = self.myGCode.__emit__("G0 F" +str(speed_mm_per_min))
-
-        if ( "echo" in reply and "ok" in reply ) : pass
-        else : raise Exception('Error in gCode execution')
+        self.__emitModal("feedrate", speed_mm_per_min, "G0 F" +str(speed_mm_per_min))
 
         return
 
@@ -816,10 +1376,7 @@ class MachineMotion :
         elif units == UNITS_ACCEL.mm_per_min_sqr:
             accel_mm_per_sec_sqr = acceleration/3600
 
-        reply = self.myGCode.__emit__("M204 T" + str(accel_mm_per_sec_sqr))
-
-        if ( "echo" in reply and "ok" in reply ) : pass
-        else : raise Exception('Error in gCode execution')
+        self.__emitModal("acceleration", accel_mm_per_sec_sqr, "M204 T" + str(accel_mm_per_sec_sqr))
 
         return
 
@@ -839,17 +1396,12 @@ class MachineMotion :
         self._restrictInputValue("axis", axis, AXIS_NUMBER)
 
         # Set to absolute motion mode
-        reply = self.myGCode.__emit__("G90")
-
-        if ( "echo" in reply and "ok" in reply ) :
-
-            # Transmit move command
-            reply = self.myGCode.__emit__("G0 " + self.myGCode.__getTrueAxis__(axis) + str(position))
-
-            if ( "echo" in reply and "ok" in reply ) : pass
+        self.__emitModal("positioning", "G90", "G90")
 
-            else : raise Exception('Error in gCode execution')
+        # Transmit move command
+        reply = self.myGCode.__emit__("G0 " + self.myGCode.__getTrueAxis__(axis) + str(position))
 
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -875,19 +1427,16 @@ class MachineMotion :
             self._restrictInputValue("axis", axis, AXIS_NUMBER)
 
         # Set to absolute motion mode
-        reply = self.myGCode.__emit__("G90")
+        self.__emitModal("positioning", "G90", "G90")
 
-        if ( "echo" in reply and "ok" in reply ) :
-            # Transmit move command
-            command = "G0 "
-            for axis, position in zip(axes, positions):
-                command += self.myGCode.__getTrueAxis__(axis) + str(position) + " "
+        # Transmit move command
+        command = "G0 "
+        for axis, position in zip(axes, positions):
+            command += self.myGCode.__getTrueAxis__(axis) + str(position) + " "
 
-            reply = self.myGCode.__emit__(command)
-
-            if ( "echo" in reply and "ok" in reply ) : pass
-            else : raise Exception('Error in gCode execution')
+        reply = self.myGCode.__emit__(command)
 
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -912,21 +1461,17 @@ class MachineMotion :
         self._restrictInputValue("direction", direction, DIRECTION)
 
         # Set to relative motion mode
-        reply = self.myGCode.__emit__("G91")
-
-        if ( "echo" in reply and "ok" in reply ) :
-
-            if direction == DIRECTION.POSITIVE :
-                distance = "" + str(distance)
-            elif direction  == DIRECTION.NEGATIVE :
-                distance = "-" + str(distance)
+        self.__emitModal("positioning", "G91", "G91")
 
-            # Transmit move command
-            reply = self.myGCode.__emit__("G0 " + self.myGCode.__getTrueAxis__(axis) + str(distance))
+        if direction == DIRECTION.POSITIVE :
+            distance = "" + str(distance)
+        elif direction  == DIRECTION.NEGATIVE :
+            distance = "-" + str(distance)
 
-            if ( "echo" in reply and "ok" in reply ) : pass
-            else : raise Exception('Error in gCode execution')
+        # Transmit move command
+        reply = self.myGCode.__emit__("G0 " + self.myGCode.__getTrueAxis__(axis) + str(distance))
 
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -952,23 +1497,20 @@ class MachineMotion :
             raise TypeError("Axes, Postions and Distances must be lists")
 
         # Set to relative motion mode
-        reply = self.myGCode.__emit__("G91")
+        self.__emitModal("positioning", "G91", "G91")
 
-        if ( "echo" in reply and "ok" in reply ) :
-            # Transmit move command
-            command = "G0 "
-            for axis, direction, distance in zip(axes, directions, distances):
-                if direction == DIRECTION.POSITIVE :
-                    distance = "" + str(distance)
-                elif direction  == DIRECTION.NEGATIVE :
-                    distance = "-" + str(distance)
-                command += self.myGCode.__getTrueAxis__(axis) + str(distance) + " "
-
-            reply = self.myGCode.__emit__(command)
+        # Transmit move command
+        command = "G0 "
+        for axis, direction, distance in zip(axes, directions, distances):
+            if direction == DIRECTION.POSITIVE :
+                distance = "" + str(distance)
+            elif direction  == DIRECTION.NEGATIVE :
+                distance = "-" + str(distance)
+            command += self.myGCode.__getTrueAxis__(axis) + str(distance) + " "
 
-            if ( "echo" in reply and "ok" in reply ) : pass
-            else : raise Exception('Error in gCode execution')
+        reply = self.myGCode.__emit__(command)
 
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -990,7 +1532,7 @@ class MachineMotion :
         # Transmit move command
         reply = self.myGCode.__emit__("G92 " + self.myGCode.__getTrueAxis__(axis) + str(position))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
     def emitgCode(self, gCode):
@@ -1005,13 +1547,135 @@ class MachineMotion :
 
         '''
 
+        # Raw g-code may change any modal setting behind our back
+        self.invalidateModalState()
+
         reply = self.myGCode.__emit__(gCode)
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution (reply: %s)' % reply)
 
         return
 
+    def emitgCodeBatch(self, gCodeList, onDataReceived = None, onKillFuncReceived = None):
+        '''
+        desc: Streams a sequence of g-code lines to the controller.
+        params:
+            gCodeList:
+                desc: The g-code lines to send. Any iterable works, including generators and open files, which are consumed lazily.
+                type: Iterable of strings
+            onDataReceived:
+                desc: Called after each line is acknowledged with a list holding one dictionary {index, line, reply}.
+                type: function
+            onKillFuncReceived:
+                desc: Called without arguments if the batch is aborted by emitStop or an e-stop.
+                type: function
+        returnValue: The number of lines sent.
+        returnValueType: Integer
+        note: Blank lines and lines starting with ';' are skipped. Each line is sent once the previous one is acknowledged. Lines are read from gCodeList one at a time, as they are sent, so memory use does not grow with the program length.
+        '''
+
+        # Raw g-code may change any modal setting behind our back
+        self.invalidateModalState()
+
+        return self.__sendgCodeBatch(gCodeList, onDataReceived, onKillFuncReceived)
+
+    def createMotionProgram(self, mergeMoves = True):
+        '''
+        desc: Creates a MotionProgram bound to this MachineMotion, to build a sequence of moves that is sent in a single batch.
+        params:
+            mergeMoves:
+                desc: Set to False to send every move on its own line instead of merging consecutive moves on different axes into one combined move.
+                defaultValue: True
+                type: Boolean
+        returnValue: The new program.
+        returnValueType: MotionProgram
+        '''
+        return MotionProgram(self, mergeMoves)
+
+    def submitMotionProgram(self, program, onDataReceived = None, onKillFuncReceived = None):
+        '''
+        desc: Compiles a MotionProgram against the known state of the controller and streams it in a single batch.
+        params:
+            program:
+                desc: The program to send.
+                type: MotionProgram
+            onDataReceived:
+                desc: See emitgCodeBatch.
+                type: function
+            onKillFuncReceived:
+                desc: See emitgCodeBatch.
+                type: function
+        returnValue: The number of lines sent.
+        returnValueType: Integer
+        note: Speed, acceleration and positioning mode already set on the controller are not sent again. Once the whole program is acknowledged, the state it leaves the controller in is cached for the next commands.
+        '''
+        with self.__modalLock:
+            lines, modalState = program.compile(self.__modalState)
+
+            # Unknown until every line is acknowledged
+            self.invalidateModalState()
+            modalGeneration = self.__modalGeneration
+
+        with self.__motionCondition:
+            cancelGeneration = self.__motionCancelGeneration
+
+        # Sent without holding the modal lock, so that e-stops and reconnections are not held up by the batch
+        linesSent = self.__sendgCodeBatch(lines, onDataReceived, onKillFuncReceived)
+
+        with self.__motionCondition:
+            isCancelled = self.__motionCancelGeneration != cancelGeneration
+
+        with self.__modalLock:
+            # The cache may have been invalidated (e-stop, reconnection, raw g-code) while the batch was streaming
+            if linesSent == len(lines) and not isCancelled and modalGeneration == self.__modalGeneration :
+                self.__modalState.update(modalState)
+
+        return linesSent
+
+    #
+    # Streams g-code lines to the controller, see emitgCodeBatch. The modal state cache is left as is.
+    # PRIVATE
+    # @status
+    #
+    def __sendgCodeBatch(self, gCodeList, onDataReceived = None, onKillFuncReceived = None):
+
+        with self.__motionCondition:
+            cancelGeneration = self.__motionCancelGeneration
+
+        def isCancelled():
+            return self.__isEstopped or self.__motionCancelGeneration != cancelGeneration
+
+        def abort():
+            logging.info("G-code batch aborted after %d lines" % linesSent)
+            if onKillFuncReceived is not None :
+                onKillFuncReceived()
+
+        linesSent = 0
+        for idx, line in enumerate(gCodeList) :
+            line = line.strip()
+            if len(line) == 0 or line.startswith(';') :
+                continue
+
+            if isCancelled() :
+                abort()
+                return linesSent
+
+            reply = self.myGCode.__emit__(line)
+
+            if isAck(reply) : pass
+            else : raise Exception('Error in gCode execution (line %d: %s, reply: %s)' % (idx, line, reply))
+
+            linesSent += 1
+            if onDataReceived is not None :
+                onDataReceived([ { "index": idx, "line": line, "reply": reply } ])
+
+        # A stop or e-stop during the last line still aborts the batch
+        if isCancelled() :
+            abort()
+
+        return linesSent
+
     def configAxisDirection(self, axis, direction):
         '''
         desc: Configures a single axis to operate in either clockwise (normal) or counterclockwise (reverse) mode. Refer to the Automation System Diagram for the correct axis setting.
@@ -1037,11 +1701,61 @@ class MachineMotion :
         elif (direction == DIRECTION.REVERSE):
             reply = self.myGCode.__emit__("M92 " + self.myGCode.__getTrueAxis__(axis) + "-"+ str(self.steps_mm[axis]))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
 
+    def invalidateModalState(self):
+        '''
+        desc: Forgets the cached positioning mode, feedrate, acceleration and axis modes, so that the next command that needs them sends them again.
+        note: This is done automatically on resetSystem, e-stop events, reconnection and after emitgCode.
+        '''
+        with self.__modalLock:
+            self.__modalGeneration += 1
+            self.__modalState = {
+                "positioning"   : None,
+                "feedrate"      : None,
+                "acceleration"  : None,
+                ("axisMode", 1) : None,
+                ("axisMode", 2) : None,
+                ("axisMode", 3) : None
+            }
+
+    #
+    # Sends a modal g-code command, unless the controller is already known to be in the requested state.
+    # PRIVATE
+    # @param key --- Description: Entry of the modal state cache affected by the command.
+    # @param value --- Description: Value of that entry once the command is acknowledged.
+    # @param gCode --- Description: The g-code command to send.
+    # @status
+    #
+    def __emitModal(self, key, value, gCode):
+        with self.__modalLock:
+            if self.__modalState.get(key) == value : return
+
+            # Unknown until the controller acknowledges the command
+            self.__modalState[key] = None
+            modalGeneration = self.__modalGeneration
+            sendToken = object()
+            self.__modalSends[key] = sendToken
+
+        # Sent without holding the modal lock, so that e-stops and reconnections are not held up by a slow reply
+        reply = self.myGCode.__emit__(gCode)
+
+        with self.__modalLock:
+            # Only cache the value if nothing invalidated the cache or sent another value for this key meanwhile
+            isLatest = self.__modalSends.get(key) is sendToken
+            if isLatest :
+                del self.__modalSends[key]
+
+            if isAck(reply) :
+                if isLatest and modalGeneration == self.__modalGeneration :
+                    self.__modalState[key] = value
+            else : raise Exception('Error in gCode execution')
+
+        return
+
     #
     # Function that indicates if the GCode communication port is ready to send another command.
     # @status
@@ -1050,6 +1764,84 @@ class MachineMotion :
         return True
         #return self.myGCode.__isReady__()
 
+    def getConnectionStats(self):
+        '''
+        desc: Returns the keep-alive statistics of the HTTP connections to this controller.
+        returnValue: A dictionary with the number of fresh connects, reused connections and reconnections after a broken socket.
+        returnValueType: Dictionary
+        '''
+        return httpConnectionPool.getStats(self.IP + ":8000")
+
+    def enableTelemetry(self, refreshIntervalSeconds = TelemetryService.DEFAULT_REFRESH_INTERVAL_SECONDS, refreshEndStops = True):
+        '''
+        desc: Starts refreshing the axis positions and end stop states in the background, so that they can be read from a cache with getTelemetry().
+        params:
+            refreshIntervalSeconds:
+                desc: Time between two refreshes.
+                defaultValue: 0.1
+                type: Number
+            refreshEndStops:
+                desc: Set to False to only refresh the positions in the background.
+                defaultValue: True
+                type: Boolean
+        returnValue: The telemetry service. Calling enableTelemetry again only updates its settings.
+        returnValueType: TelemetryService
+        note: getCurrentPositions and getEndStopState keep querying the controller on every call.
+        '''
+        if self.__telemetry is None :
+            self.__telemetry = TelemetryService(self, refreshIntervalSeconds, refreshEndStops)
+        else :
+            self.__telemetry.refreshIntervalSeconds = refreshIntervalSeconds
+            self.__telemetry.refreshEndStops = refreshEndStops
+
+        self.__telemetry.start()
+        return self.__telemetry
+
+    def disableTelemetry(self):
+        '''
+        desc: Stops the background refresh started by enableTelemetry.
+        '''
+        if self.__telemetry is not None :
+            self.__telemetry.stop()
+            self.__telemetry = None
+
+    def getTelemetry(self):
+        '''
+        desc: Returns the telemetry service started by enableTelemetry, or None if it is not enabled.
+        returnValueType: TelemetryService
+        '''
+        return self.__telemetry
+
+    def getGCodeStats(self):
+        '''
+        desc: Returns the latency statistics of the g-code commands sent to this controller, per command verb (G0, G90, V0, M114, ...).
+        returnValue: A dictionary keyed by verb of {count, retries, totalMs, meanMs, p50Ms, p95Ms, p99Ms, maxMs}.
+        returnValueType: Dictionary
+        '''
+        return gCodeTracer.getStats(self.IP + ":8000")
+
+    def getGCodeTraces(self, count = None):
+        '''
+        desc: Returns the most recent g-code commands sent to this controller, with their latency, reply size and retries.
+        params:
+            count:
+                desc: Maximum number of commands to return. All the traced commands are returned if None.
+                type: Integer
+        returnValue: A list of dictionaries {timeSeconds, host, verb, gCode, latencyMs, replySize, retries}, oldest first.
+        returnValueType: List
+        '''
+        return gCodeTracer.getTraces(self.IP + ":8000", count)
+
+    def dumpGCodeTraces(self, path):
+        '''
+        desc: Writes the g-code statistics and traces of this controller to a JSON file.
+        params:
+            path:
+                desc: Path of the file to write.
+                type: String
+        '''
+        gCodeTracer.dump(path, self.IP + ":8000")
+
     def isMotionCompleted(self):
         '''
         desc: Indicates if the last move command has completed.
@@ -1058,38 +1850,200 @@ class MachineMotion :
         '''
 
         #Sending gCode V0 command to
-        reply = self.myGCode.__emit__("V0")
+        completed = isMotionCompleted(self.myGCode.__emit__("V0"))
 
         #Check if not error message
-        if ( "echo" in reply and "ok" in reply ) :
-            if ("COMPLETED" in reply) : return True
-            else : return False
-        else : raise Exception('Error in gCode execution')
+        if completed is None : raise Exception('Error in gCode execution')
 
-        return
+        return completed
 
-    def waitForMotionCompletion(self):
+    def waitForMotionCompletion(self, timeout = None, initialPollInterval = 0.01, maxPollInterval = 0.25, backoffFactor = 2.0):
         '''
         desc: Pauses python program execution until machine has finished its current movement.
+        params:
+            timeout:
+                desc: Maximum time to wait in seconds. Waits forever when None.
+                defaultValue: None
+                type: Number
+            initialPollInterval:
+                desc: Delay in seconds before the second V0 poll. The delay grows by backoffFactor after every poll.
+                defaultValue: 0.01
+                type: Number
+            maxPollInterval:
+                desc: Upper bound of the delay between two V0 polls, in seconds.
+                defaultValue: 0.25
+                type: Number
+            backoffFactor:
+                desc: Factor applied to the polling delay after each poll.
+                defaultValue: 2.0
+                type: Number
+        returnValue: A dictionary {completed, elapsedSeconds, pollCount}. completed is False when the wait was cancelled by emitStop or an e-stop.
+        returnValueType: Dictionary
+        note: If a completion topic was configured with setMotionCompletionTopic, a message on that topic wakes the wait up immediately. Raises MotionCompletionTimeout if the timeout expires.
         exampleCodePath: waitForMotionCompletion.py
 
         '''
-        #Sending gCode V0 command to
-        reply = self.myGCode.__emit__("V0")
+        startTime = time.time()
+        pollInterval = initialPollInterval
+        pollCount = 0
 
-        #Check if not error message
-        if ( "echo" in reply and "ok" in reply ) :
+        with self.__motionCondition:
+            cancelGeneration = self.__motionCancelGeneration
 
-            #Recursively calls the function until motion is completed
-            if ("COMPLETED" in reply) : return
-            else :
-                print( "Motion not completed : " + str(self.IP))
-                time.sleep(0.5)
-                return self.waitForMotionCompletion()
+        def result(completed):
+            return { "completed": completed, "elapsedSeconds": time.time() - startTime, "pollCount": pollCount }
 
-        else : raise Exception('Error in gCode execution')
+        while True :
+            with self.__motionCondition:
+                signalCount = self.__motionSignalCount
 
-        return
+            #Sending gCode V0 command to
+            completed = isMotionCompleted(self.myGCode.__emit__("V0"))
+            pollCount += 1
+
+            #Check if not error message
+            if completed is None : raise Exception('Error in gCode execution')
+
+            if completed : return result(True)
+
+            elapsedSeconds = time.time() - startTime
+            if timeout is not None and elapsedSeconds >= timeout :
+                raise self.MotionCompletionTimeout("Motion not completed after " + str(timeout) + " seconds : " + str(self.IP))
+
+            waitSeconds = pollInterval if timeout is None else min(pollInterval, timeout - elapsedSeconds)
+
+            # Sleep until the next poll, unless a completion signal, stop or e-stop arrives first
+            with self.__motionCondition:
+                if self.__motionCancelGeneration == cancelGeneration and self.__motionSignalCount == signalCount :
+                    self.__motionCondition.wait(waitSeconds)
+
+                if self.__motionCancelGeneration != cancelGeneration :
+                    return result(False)
+
+            pollInterval = min(pollInterval * backoffFactor, maxPollInterval)
+
+    #
+    # Wakes up every thread blocked in waitForMotionCompletion and makes it return.
+    # PRIVATE
+    # @status
+    #
+    def __cancelMotionWaits(self):
+        self.__cancelPendingAsync()
+
+        with self.__motionCondition:
+            self.__motionCancelGeneration += 1
+            self.__motionCondition.notify_all()
+
+    def notifyMotionCompleted(self):
+        '''
+        desc: Push-based completion signal. Wakes up waitForMotionCompletion so that it confirms completion right away instead of waiting for its next poll.
+        '''
+        with self.__motionCondition:
+            self.__motionSignalCount += 1
+            self.__motionCondition.notify_all()
+
+    def setMotionCompletionTopic(self, topic):
+        '''
+        desc: Subscribes to an MQTT topic on which the controller publishes motion completion events. Every message on that topic calls notifyMotionCompleted.
+        params:
+            topic:
+                desc: The MQTT topic to listen to, or None to go back to polling only.
+                type: String
+        '''
+        if self.__motionCompletionTopic is not None :
+            self.mqttUnsubscribe(self.__motionCompletionTopic)
+
+        self.__motionCompletionTopic = topic
+
+        if topic is not None :
+            self.mqttSubscribe(topic)
+
+    # ------------------------------------------------------------------------
+    # Asynchronous API
+    #
+    # Every *Async method queues the matching synchronous call on a dedicated I/O
+    # thread and immediately returns a concurrent.futures.Future. Calls execute
+    # one at a time, in submission order, so the controller receives the same
+    # command sequence as with the synchronous API. Pending calls are cancelled
+    # by emitStop and e-stops.
+
+    def runAsync(self, func, *args, **kwargs):
+        '''
+        desc: Queues any callable on this controller's I/O thread.
+        params:
+            func:
+                desc: The function to call, usually a bound MachineMotion method.
+                type: function
+        returnValue: A future holding the return value (or exception) of the call.
+        returnValueType: concurrent.futures.Future
+        '''
+        with self.__asyncLock:
+            if self.__asyncExecutor is None :
+                self.__asyncExecutor = ThreadPoolExecutor(max_workers = 1)
+
+            future = self.__asyncExecutor.submit(func, *args, **kwargs)
+            self.__pendingFutures.add(future)
+
+        future.add_done_callback(self.__onAsyncDone)
+        return future
+
+    def __onAsyncDone(self, future):
+        with self.__asyncLock:
+            self.__pendingFutures.discard(future)
+
+    #
+    # Cancels every asynchronous call that has not started yet.
+    # PRIVATE
+    # @status
+    #
+    def __cancelPendingAsync(self):
+        with self.__asyncLock:
+            pendingFutures = list(self.__pendingFutures)
+
+        for future in pendingFutures :
+            future.cancel()
+
+    def emitSpeedAsync(self, speed, units = UNITS_SPEED.mm_per_sec):
+        ''' desc: Asynchronous version of emitSpeed. Returns a Future. '''
+        return self.runAsync(self.emitSpeed, speed, units)
+
+    def emitAccelerationAsync(self, acceleration, units = UNITS_ACCEL.mm_per_sec_sqr):
+        ''' desc: Asynchronous version of emitAcceleration. Returns a Future. '''
+        return self.runAsync(self.emitAcceleration, acceleration, units)
+
+    def emitAbsoluteMoveAsync(self, axis, position):
+        ''' desc: Asynchronous version of emitAbsoluteMove. Returns a Future. '''
+        return self.runAsync(self.emitAbsoluteMove, axis, position)
+
+    def emitCombinedAxesAbsoluteMoveAsync(self, axes, positions):
+        ''' desc: Asynchronous version of emitCombinedAxesAbsoluteMove. Returns a Future. '''
+        return self.runAsync(self.emitCombinedAxesAbsoluteMove, axes, positions)
+
+    def emitRelativeMoveAsync(self, axis, direction, distance):
+        ''' desc: Asynchronous version of emitRelativeMove. Returns a Future. '''
+        return self.runAsync(self.emitRelativeMove, axis, direction, distance)
+
+    def emitCombinedAxisRelativeMoveAsync(self, axes, directions, distances):
+        ''' desc: Asynchronous version of emitCombinedAxisRelativeMove. Returns a Future. '''
+        return self.runAsync(self.emitCombinedAxisRelativeMove, axes, directions, distances)
+
+    def emitHomeAsync(self, axis):
+        ''' desc: Asynchronous version of emitHome. Returns a Future. '''
+        return self.runAsync(self.emitHome, axis)
+
+    def emitHomeAllAsync(self):
+        ''' desc: Asynchronous version of emitHomeAll. Returns a Future. '''
+        return self.runAsync(self.emitHomeAll)
+
+    def emitgCodeAsync(self, gCode):
+        ''' desc: Asynchronous version of emitgCode. Returns a Future. '''
+        return self.runAsync(self.emitgCode, gCode)
+
+    def waitForMotionCompletionAsync(self, timeout = None):
+        '''
+        desc: Asynchronous version of waitForMotionCompletion. Returns a Future that resolves with the same dictionary as waitForMotionCompletion once all previously queued commands have been sent and the motion is complete.
+        '''
+        return self.runAsync(self.waitForMotionCompletion, timeout)
 
     def configMachineMotionIp(self, mode = None, machineIp = None, machineNetmask = None, machineGateway = None):
         '''
@@ -1178,7 +2132,7 @@ class MachineMotion :
 
         reply = self.myGCode.__emit__(gCodeCommand)
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -1219,7 +2173,7 @@ class MachineMotion :
 
         reply = self.myGCode.__emit__(gCodeCommand)
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -1251,7 +2205,7 @@ class MachineMotion :
         self.steps_mm[axis] = STEPPER_MOTOR.steps_per_turn * self.u_step[axis] / self.mech_gain[axis]
         reply = self.myGCode.__emit__("M92 " + self.myGCode.__getTrueAxis__(axis) + str(self.steps_mm[axis]))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -1400,7 +2354,7 @@ class MachineMotion :
         '''
         reply = self.myGCode.__emit__("G4 P"+str(milliseconds))
 
-        if ( "echo" in reply and "ok" in reply ) : pass
+        if isAck(reply) : pass
         else : raise Exception('Error in gCode execution')
 
         return
@@ -1448,6 +2402,9 @@ class MachineMotion :
 
     def eStopEvent(self, status) :
         self.__isEstopped = status
+        if status :
+            self.__cancelMotionWaits()
+        self.invalidateModalState()
         self.eStopCallback(status)
         return
 
@@ -1457,102 +2414,172 @@ class MachineMotion :
     def triggerEstop (self) :
         '''
         desc: Triggers the MachineMotion software emergency stop, cutting power to all drives and enabling brakes (if any). The software E stop must be released (using releaseEstop()) in order to re-enable the machine.
+        returnValue: The response of the controller.
+        returnValueType: Boolean
+        note: From an MQTT callback (e.g. a registered input), use triggerEstopAsync instead. Called from there, the request is still sent but its response cannot be waited for, and None is returned.
         '''
-        # Creating return value for the function. If nothing good happens, it will return False
-        return_value = False
-
-        def mqttResponse() :
-            # Wait for response
-            return_value = json.loads(MQTTsubscribe.simple(MQTT.PATH.ESTOP_TRIGGER_RESPONSE, retained = False, hostname = self.IP).payload.decode('utf-8'))
-
-            return
-
-        mqttResponseThread = threading.Thread(target = mqttResponse)
-        mqttResponseThread.daemon = True
-        mqttResponseThread.start()
-
-        # Adding a delay to make sure MQTT simple function is launched before publish is made. Quick fix from bug on App. Launcher.
-        time.sleep(0.2)
-
         # Publish trigger request on MQTT
-        self.myMqttClient.publish(MQTT.PATH.ESTOP_TRIGGER_REQUEST, "message is not important")
-
-        mqttResponseThread.join(MQTT.TIMEOUT)
+        self.__cancelMotionWaits()
+        self.invalidateModalState()
+        return self.__mqttRequest(MQTT.PATH.ESTOP_TRIGGER_REQUEST)
 
-        if mqttResponseThread.isAlive() :
-            raise Exception('MQTT response timeout!')
-            return False
-        else :
-            return return_value
-
-        return return_value
+    def triggerEstopAsync (self) :
+        '''
+        desc: Asynchronous version of triggerEstop, which can be called from MQTT callbacks. The request is sent right away, ahead of the calls queued by the other *Async methods.
+        returnValue: A future holding the response of the controller.
+        returnValueType: concurrent.futures.Future
+        '''
+        self.__cancelMotionWaits()
+        self.invalidateModalState()
+        return self.__sendMqttRequest(MQTT.PATH.ESTOP_TRIGGER_REQUEST)
 
     def releaseEstop (self) :
         '''
         desc: Releases the software E-stop and provides power back to the drives.
+        returnValue: The response of the controller.
+        returnValueType: Boolean
+        note: From an MQTT callback, use releaseEstopAsync instead. Called from there, the request is still sent but its response cannot be waited for, and None is returned.
         '''
-        # Creating return value for the function. If nothing good happens, it will return False
-        return_value = False
-
-        def mqttResponse() :
-            # Wait for response
-            return_value = json.loads(MQTTsubscribe.simple(MQTT.PATH.ESTOP_RELEASE_RESPONSE, retained = False, hostname = self.IP).payload.decode('utf-8'))
+        # Publish release request on MQTT
+        self.invalidateModalState()
+        return self.__mqttRequest(MQTT.PATH.ESTOP_RELEASE_REQUEST)
 
-            return
+    def releaseEstopAsync (self) :
+        '''
+        desc: Asynchronous version of releaseEstop, which can be called from MQTT callbacks.
+        returnValue: A future holding the response of the controller.
+        returnValueType: concurrent.futures.Future
+        '''
+        self.invalidateModalState()
+        return self.__sendMqttRequest(MQTT.PATH.ESTOP_RELEASE_REQUEST)
 
-        mqttResponseThread = threading.Thread(target = mqttResponse)
-        mqttResponseThread.daemon = True
-        mqttResponseThread.start()
+    def resetSystem (self) :
+        '''
+        desc: Resets the system after an eStop event
+        returnValue: The response of the controller.
+        returnValueType: Boolean
+        note: From an MQTT callback, use resetSystemAsync instead. Called from there, the request is still sent but its response cannot be waited for, and None is returned.
+        '''
+        # Publish reset system request on MQTT
+        self.invalidateModalState()
+        return self.__mqttRequest(MQTT.PATH.ESTOP_SYSTEMRESET_REQUEST)
 
-        # Adding a delay to make sure MQTT simple function is launched before publish is made. Quick fix from bug on App. Launcher.
-        time.sleep(0.2)
+    def resetSystemAsync (self) :
+        '''
+        desc: Asynchronous version of resetSystem, which can be called from MQTT callbacks.
+        returnValue: A future holding the response of the controller.
+        returnValueType: concurrent.futures.Future
+        '''
+        self.invalidateModalState()
+        return self.__sendMqttRequest(MQTT.PATH.ESTOP_SYSTEMRESET_REQUEST)
 
-        # Publish release request on MQTT
-        self.myMqttClient.publish(MQTT.PATH.ESTOP_RELEASE_REQUEST, "message is not important")
+    #
+    # Publishes a request and waits for its response on the already connected MQTT client.
+    # Responses carry no request identifier, so they are matched to the requests in the
+    # order the requests were sent.
+    # Responses are received on the network thread of the shared MQTT hub. When called from
+    # that thread (i.e. from any MQTT callback on this broker: IOMonitor, sensors, custom
+    # callbacks...), waiting would block the very thread that has to receive the response, so
+    # the request is only published and None is returned.
+    # PRIVATE
+    # @param requestTopic --- Description: One of the request topics of MQTT.RESPONSES.
+    # @param payload --- Description: The request payload.
+    # @return --- Description: The decoded JSON response, or None when called from the MQTT network thread.
+    # @status
+    #
+    def __mqttRequest(self, requestTopic, payload = "message is not important"):
+        if self.__mqttHub.isNetworkThread() :
+            logging.warning("%s requested from an MQTT callback, not waiting for the response. Use the Async version instead." % requestTopic)
+            self.__sendMqttRequest(requestTopic, payload)
+            return None
 
-        mqttResponseThread.join(MQTT.TIMEOUT)
+        responseTopic = MQTT.RESPONSES[requestTopic]
+        deadline = time.time() + MQTT.TIMEOUT
+        request = (deadline, Future())
 
-        if mqttResponseThread.isAlive() :
-            raise Exception('MQTT response timeout!')
-            return False
-        else :
-            return return_value
+        with self.__mqttRequestLock:
+            self.__pendingMqttRequests[responseTopic].append(request)
 
-        return return_value
+        try :
+            if not self.__mqttHub.waitForConnection(MQTT.TIMEOUT) :
+                raise Exception('MQTT response timeout!')
 
-    def resetSystem (self) :
-        '''
-        desc: Resets the system after an eStop event
-        '''
+            self.myMqttClient.publish(requestTopic, payload)
 
-        # Creating return value for the function. If nothing good happens, it will return False
-        return_value = False
+            try :
+                return request[1].result(max(0, deadline - time.time()))
+            except FutureTimeoutError :
+                raise Exception('MQTT response timeout!')
+        finally :
+            with self.__mqttRequestLock:
+                pendingRequests = self.__pendingMqttRequests[responseTopic]
+                if request in pendingRequests :
+                    pendingRequests.remove(request)
 
-        def mqttResponse() :
-            # Wait for response
-            return_value = json.loads(MQTTsubscribe.simple(MQTT.PATH.ESTOP_SYSTEMRESET_RESPONSE, retained = False, hostname = self.IP).payload.decode('utf-8'))
+    #
+    # Publishes a request without waiting for its response, so it can be called from any thread.
+    # PRIVATE
+    # @param requestTopic --- Description: One of the request topics of MQTT.RESPONSES.
+    # @param payload --- Description: The request payload.
+    # @return --- Description: A Future of the decoded JSON response. It fails if no response arrives within MQTT.TIMEOUT.
+    # @status
+    #
+    def __sendMqttRequest(self, requestTopic, payload = "message is not important"):
+        responseTopic = MQTT.RESPONSES[requestTopic]
+        request = (time.time() + MQTT.TIMEOUT, Future())
 
-            return
+        with self.__mqttRequestLock:
+            self.__pendingMqttRequests[responseTopic].append(request)
 
-        mqttResponseThread = threading.Thread(target = mqttResponse)
-        mqttResponseThread.daemon = True
-        mqttResponseThread.start()
+        def expire() :
+            with self.__mqttRequestLock:
+                pendingRequests = self.__pendingMqttRequests[responseTopic]
+                if not request in pendingRequests :
+                    return
+                pendingRequests.remove(request)
+            request[1].set_exception(Exception('MQTT response timeout!'))
 
-        # Adding a delay to make sure MQTT simple function is launched before publish is made. Quick fix from bug on App. Launcher.
-        time.sleep(0.2)
+        timer = threading.Timer(MQTT.TIMEOUT, expire)
+        timer.daemon = True
+        timer.start()
+        request[1].add_done_callback(lambda future : timer.cancel())
 
-        # Publish reset system request on MQTT
-        self.myMqttClient.publish(MQTT.PATH.ESTOP_SYSTEMRESET_REQUEST, "message is not important")
+        self.myMqttClient.publish(requestTopic, payload)
+        return request[1]
 
-        mqttResponseThread.join(MQTT.TIMEOUT)
+    # ------------------------------------------------------------------------
+    # Completes the oldest pending request of a response topic. Requests past their
+    # deadline that nobody waits for anymore are dropped first. Responses nobody waits
+    # for (e.g. to requests made by another client) are ignored.
+    #
+    # @param msg      - The MQTT message recieved, already decoded and split by the MQTT hub
+    def __onMqttResponse(self, msg):
+        now = time.time()
+        expiredFutures = []
+        future = None
+
+        with self.__mqttRequestLock:
+            pendingRequests = self.__pendingMqttRequests.get(msg.topic)
+            while pendingRequests :
+                deadline, oldestFuture = pendingRequests.popleft()
+                if deadline < now :
+                    expiredFutures.append(oldestFuture)
+                    continue
+                future = oldestFuture
+                break
+
+        for expiredFuture in expiredFutures :
+            expiredFuture.set_exception(Exception('MQTT response timeout!'))
+
+        if future is None :
+            return
 
-        if mqttResponseThread.isAlive() :
-            raise Exception('MQTT response timeout!')
-            return False
-        else :
-            return return_value
+        try :
+            future.set_result(json.loads(msg.payload))
+        except ValueError as e :
+            future.set_exception(e)
 
-        return return_value
+        return
 
     def bindeStopEvent (self, callback_function) :
         '''
@@ -1641,7 +2668,8 @@ class MachineMotion :
 
 
     # ------------------------------------------------------------------------
-    # Register to the MQTT broker on each connection.
+    # React to each (re)connection to the MQTT broker. Topic subscriptions are
+    # restored by the shared MQTT hub.
     #
     # @param client   - The MQTT client identifier (us)
     # @param userData - The user data we have supply on registration (none)
@@ -1649,34 +2677,37 @@ class MachineMotion :
     # @param rc       - The connection return code
     def __onConnect(self, client, userData, flags, rc):
         if rc == 0:
-            self.myMqttClient.subscribe('devices/io-expander/+/available')
-            self.myMqttClient.subscribe('devices/io-expander/+/digital-input/#')
-            self.myMqttClient.subscribe('devices/encoder/+/realtime-position')
-            self.myMqttClient.subscribe('devices/encoder/+/stable-position')
-            self.myMqttClient.subscribe(MQTT.PATH.ESTOP_STATUS)
-            self.myMqttClient.subscribe(MQTT.PATH.AUX_PORT_SAFETY + '/+/status')
-            self.myMqttClient.subscribe(MQTT.PATH.AUX_PORT_POWER + '/+/status')
+            # The controller may have been restarted while we were disconnected
+            self.invalidateModalState()
 
         return
 
     # ------------------------------------------------------------------------
     # Update our internal state from the messages received from the MQTT broker
     #
-    # @param client   - The MQTT client identifier (us)
-    # @param userData - The user data we have supply on registration (none)
-    # @param msg      - The MQTT message recieved
-    def __onMessage(self, client, userData, msg):
-        # Custom callback list for MachineApps
-        for callback in self.mqttCallbacks:
-            callback(msg.topic, msg.payload.decode('utf-8'))
-        
-        topicParts = msg.topic.split('/')
+    # @param msg      - The MQTT message recieved, already decoded and split by the MQTT hub
+    def __onMessage(self, msg):
+        # Custom callbacks for MachineApps, only those whose topic filter matches
+        with self.__mqttCallbackLock:
+            callbacks = self.__mqttCallbacks.match(msg.topicParts)
+
+        for callback in callbacks:
+            callback(msg.topic, msg.payload)
+
+        if msg.topic == self.__motionCompletionTopic :
+            self.notifyMotionCompleted()
+            return
+
+        topicParts = msg.topicParts
+        if len(topicParts) < 2 :
+            return
+
         deviceType = topicParts[1]
 
         if (deviceType == 'io-expander'):
             device = int( topicParts[2] )
             if (topicParts[3] == 'available'):
-                availability = json.loads(msg.payload.decode('utf-8'))
+                availability = json.loads(msg.payload)
                 if (availability):
                     self.myIoExpanderAvailabilityState[device-1] = True
                     return
@@ -1686,7 +2717,7 @@ class MachineMotion :
             pin = int( topicParts[4] )
             if ( not self.isIoExpanderInputIdValid(device, pin) ):
                 return
-            value  = int( msg.payload.decode('utf-8') )
+            value  = int( msg.payload )
             if (not hasattr(self, 'digitalInputs')):
                 self.digitalInputs = {}
             if (not device in self.digitalInputs):
@@ -1697,7 +2728,7 @@ class MachineMotion :
             try:
                 device = int( topicParts[2] )
                 position_type = topicParts[3]
-                position = float( msg.payload.decode('utf-8') )
+                position = float( msg.payload )
                 if position_type == ENCODER_TYPE.real_time :
                     self.myEncoderRealtimePositions[device] = position
                 elif position_type == ENCODER_TYPE.stable :
@@ -1708,18 +2739,18 @@ class MachineMotion :
 
         elif (topicParts[0] == MQTT.PATH.ESTOP) :
             if (topicParts[1] == "status") :
-                self.eStopEvent(json.loads(msg.payload.decode('utf-8')))
+                self.eStopEvent(json.loads(msg.payload))
             return
 
         elif (topicParts[0] == MQTT.PATH.AUX_PORT_POWER) :
             if (topicParts[2] == "status") :
                 aux_port = int( topicParts[1] )
-                self.brakeStatus_control[aux_port-1] = msg.payload.decode('utf-8')
+                self.brakeStatus_control[aux_port-1] = msg.payload
 
         elif (topicParts[0] == MQTT.PATH.AUX_PORT_SAFETY) :
             if (topicParts[2] == "status") :
                 aux_port = int( topicParts[1] )
-                self.brakeStatus_safety[aux_port-1] = msg.payload.decode('utf-8')
+                self.brakeStatus_safety[aux_port-1] = msg.payload
 
         return
 
@@ -1732,6 +2763,7 @@ class MachineMotion :
 
         # Create the web socket
         self.myGCode = GCode(self.IP)
+        self.invalidateModalState()
 
         # Set the callback to the user specified function. This callback is used to process incoming messages from the machineMotion controller
         self.myGCode.__setUserCallback__(callback)
@@ -1739,12 +2771,38 @@ class MachineMotion :
         return
 
     # Custom MachineApp template-specific code
-    def addMqttCallback(self, func):
-        if not func in self.mqttCallbacks:
-            self.mqttCallbacks.append(func)
+    def addMqttCallback(self, func, topicFilter = None):
+        '''
+        desc: Registers func(topic, msg) to be called on the MQTT thread for incoming messages.
+        params:
+            func:
+                desc: The callback. msg is the decoded payload.
+                type: function
+            topicFilter:
+                desc: MQTT topic filter, wildcards allowed. The topic is subscribed on the broker if needed. When None, func receives every message that MachineMotion listens to.
+                type: String
+        '''
+        with self.__mqttCallbackLock:
+            self.__mqttCallbacks.add('#' if topicFilter is None else topicFilter, func)
+
+        if topicFilter is not None :
+            self.mqttSubscribe(topicFilter)
+
+    def removeMqttCallback(self, func, topicFilter = None):
+        with self.__mqttCallbackLock:
+            self.__mqttCallbacks.remove('#' if topicFilter is None else topicFilter, func)
+
+        if topicFilter is not None :
+            self.mqttUnsubscribe(topicFilter)
+
+    def mqttSubscribe(self, topic):
+        '''
+        desc: Routes messages of an additional MQTT topic to this MachineMotion and its MQTT callbacks. Every call must be balanced by a call to mqttUnsubscribe.
+        '''
+        self.__mqttHub.subscribe(topic, self.__onMessage)
 
-    def removeMqttCallback(self, func):
-        self.mqttCallbacks.remove(func)
+    def mqttUnsubscribe(self, topic):
+        self.__mqttHub.unsubscribe(topic, self.__onMessage)
 
     def registerInput(self, name, digitalIo, pin):
         self.__registeredInputMap[name] = 'devices/io-expander/' + str(digitalIo) + '/digital-input/' + str(pin)
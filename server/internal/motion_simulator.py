@@ -0,0 +1,407 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+class VirtualClock:
+    '''
+    Time source of a simulation.
+
+    With a time compression factor, virtual time runs that many times faster than real time
+    (1.0 is real time). With a factor of None, the clock is discrete: it only moves when
+    someone sleeps on it, and sleeping returns right away. A simulation driven from a single
+    thread in discrete mode is fully deterministic.
+    '''
+
+    def __init__(self, timeCompression=1.0):
+        if timeCompression != None and timeCompression <= 0:
+            raise ValueError('The time compression factor must be positive, or None for a discrete clock')
+
+        self.timeCompression = timeCompression
+        self.__lock = threading.Lock()
+        self.__discreteNow = 0.0
+        self.__realStart = time.monotonic()
+
+    def isDiscrete(self):
+        return self.timeCompression == None
+
+    def now(self):
+        ''' Current virtual time, in seconds since the clock was created '''
+        if self.isDiscrete():
+            with self.__lock:
+                return self.__discreteNow
+
+        return (time.monotonic() - self.__realStart) * self.timeCompression
+
+    def toRealSeconds(self, virtualSeconds):
+        if self.isDiscrete():
+            return 0
+        return max(0, virtualSeconds) / self.timeCompression
+
+    def advanceTo(self, virtualTime):
+        '''
+        Moves a discrete clock forward to a point in time. Has no effect on a compressed clock,
+        whose time follows real time.
+        '''
+        if self.isDiscrete():
+            with self.__lock:
+                self.__discreteNow = max(self.__discreteNow, virtualTime)
+
+class TrapezoidalProfile:
+    '''
+    Velocity profile of a point-to-point move: constant acceleration up to the maximum speed,
+    cruise, then constant deceleration. Short moves never reach the maximum speed and have a
+    triangular profile instead.
+    '''
+
+    def __init__(self, distance, maxSpeed, acceleration):
+        self.distance = abs(distance)
+        self.maxSpeed = maxSpeed
+        self.acceleration = acceleration
+
+        if self.distance == 0:
+            self.accelTime = 0
+            self.cruiseTime = 0
+            self.peakSpeed = 0
+        elif maxSpeed * maxSpeed / acceleration >= self.distance:
+            self.accelTime = math.sqrt(self.distance / acceleration)
+            self.cruiseTime = 0
+            self.peakSpeed = acceleration * self.accelTime
+        else:
+            self.accelTime = maxSpeed / acceleration
+            self.cruiseTime = (self.distance - maxSpeed * self.accelTime) / maxSpeed
+            self.peakSpeed = maxSpeed
+
+        self.duration = 2 * self.accelTime + self.cruiseTime
+
+    def distanceAt(self, elapsed):
+        ''' Distance travelled 'elapsed' seconds after the start of the move '''
+        if elapsed <= 0:
+            return 0
+        if elapsed >= self.duration:
+            return self.distance
+
+        accelDistance = 0.5 * self.acceleration * self.accelTime * self.accelTime
+        if elapsed < self.accelTime:
+            return 0.5 * self.acceleration * elapsed * elapsed
+
+        if elapsed < self.accelTime + self.cruiseTime:
+            return accelDistance + self.peakSpeed * (elapsed - self.accelTime)
+
+        remaining = self.duration - elapsed
+        return self.distance - 0.5 * self.acceleration * remaining * remaining
+
+class MotionSegment:
+    ''' A queued move of one or more axes, following a single profile along the straight line between its ends '''
+
+    def __init__(self, startTime, startPositions, endPositions, maxSpeed, acceleration):
+        self.startTime = startTime
+        self.startPositions = dict(startPositions)
+        self.endPositions = dict(endPositions)
+
+        deltas = [ endPositions[axis] - startPositions[axis] for axis in startPositions ]
+        self.length = math.sqrt(sum(delta * delta for delta in deltas))
+        self.profile = TrapezoidalProfile(self.length, maxSpeed, acceleration)
+        self.endTime = startTime + self.profile.duration
+
+    def positionsAt(self, t):
+        if t >= self.endTime or self.length == 0:
+            return dict(self.endPositions)
+
+        fraction = self.profile.distanceAt(t - self.startTime) / self.length
+        return { axis: start + (self.endPositions[axis] - start) * fraction for axis, start in self.startPositions.items() }
+
+class MotionSimulator:
+    '''
+    Discrete-event model of a MachineMotion controller: per-axis positions following
+    trapezoidal profiles, end stops, digital IO and timed events, all on a VirtualClock.
+
+    Moves are queued one after another like on the controller's planner, and positions
+    are computed from the queued segments when asked for, so nothing is stepped in the
+    background. Scheduled events (input changes) fire in time order, on the sleeping
+    thread for a discrete clock, or on a helper thread for a compressed clock.
+    '''
+    AXES = (1, 2, 3)
+    AXIS_NAMES = { 1: 'x', 2: 'y', 3: 'z' }
+    END_STOP_TRIGGERED = 'TRIGGERED'
+    END_STOP_OPEN = 'open'
+
+    def __init__(self, clock=None, axisLengths=None, speed=100.0, acceleration=500.0, homingSpeed=50.0):
+        '''
+        params:
+            clock: VirtualClock
+                (Optional) Time source, real time by default. Share a clock between simulators to
+                simulate several controllers on the same timeline.
+            axisLengths: dict<int, float>
+                (Optional) Travel of each axis in mm. Moves are stopped by the end stops at 0 and at this length.
+            speed, acceleration: float
+                Initial speed (mm/s) and acceleration (mm/s^2)
+            homingSpeed: float
+                Speed of homing moves (mm/s)
+        '''
+        self.__logger = logging.getLogger(__name__)
+        self.clock = clock if clock != None else VirtualClock()
+        self.axisLengths = { axis: 1000.0 for axis in self.AXES }
+        if axisLengths != None:
+            self.axisLengths.update(axisLengths)
+
+        self.speed = speed
+        self.acceleration = acceleration
+        self.homingSpeed = homingSpeed
+
+        self.__condition = threading.Condition()
+        self.__segments = []                        # Queued MotionSegment, in execution order
+        self.__restPositions = { axis: 0.0 for axis in self.AXES }     # Positions once the queue is done
+        self.__isEstopped = False
+
+        self.__inputs = {}                          # (device, pin) -> value
+        self.__outputs = {}                         # (device, pin) -> value
+        self.__outputLinks = {}                     # (device, pin) -> list of (inputDevice, inputPin, delaySeconds, invert)
+        self.__inputListeners = []                  # func(device, pin, value)
+
+        self.__events = []                          # Heap of (time, sequence, func, args)
+        self.__eventSequence = 0
+        self.__eventThread = None
+
+    # ------------------------------------------------------------------------
+    # Time
+
+    def now(self):
+        return self.clock.now()
+
+    def sleep(self, seconds):
+        ''' Lets 'seconds' of virtual time pass, firing the events that fall within that period '''
+        self.sleepUntil(self.now() + seconds)
+
+    def sleepUntil(self, virtualTime):
+        if not self.clock.isDiscrete():
+            time.sleep(self.clock.toRealSeconds(virtualTime - self.now()))
+            self.__fireDueEvents()
+            return
+
+        while True:
+            with self.__condition:
+                if len(self.__events) == 0 or self.__events[0][0] > virtualTime:
+                    break
+                eventTime = self.__events[0][0]
+
+            self.clock.advanceTo(eventTime)
+            self.__fireDueEvents()
+
+        self.clock.advanceTo(virtualTime)
+
+    def schedule(self, delaySeconds, func, *args):
+        ''' Calls func(*args) once 'delaySeconds' of virtual time have passed '''
+        with self.__condition:
+            heapq.heappush(self.__events, (self.now() + max(0, delaySeconds), self.__eventSequence, func, args))
+            self.__eventSequence += 1
+
+            if not self.clock.isDiscrete() and self.__eventThread == None:
+                self.__eventThread = threading.Thread(name='MotionSimulatorEvents', target=self.__eventLoop)
+                self.__eventThread.daemon = True
+                self.__eventThread.start()
+
+            self.__condition.notify_all()
+
+    def __fireDueEvents(self):
+        while True:
+            with self.__condition:
+                if len(self.__events) == 0 or self.__events[0][0] > self.now():
+                    return
+                _, _, func, args = heapq.heappop(self.__events)
+
+            try:
+                func(*args)
+            except Exception as e:
+                self.__logger.error('Exception in simulated event: {}'.format(str(e)))
+
+    def __eventLoop(self):
+        while True:
+            with self.__condition:
+                if len(self.__events) == 0:
+                    self.__condition.wait()
+                    continue
+
+                waitSeconds = self.clock.toRealSeconds(self.__events[0][0] - self.now())
+                if waitSeconds > 0:
+                    self.__condition.wait(waitSeconds)
+                    continue
+
+            self.__fireDueEvents()
+
+    # ------------------------------------------------------------------------
+    # Motion
+
+    def __pruneSegments(self, t):
+        ''' Drops the segments that are complete at time t. Must hold the condition. '''
+        while len(self.__segments) > 0 and self.__segments[0].endTime <= t:
+            self.__segments.pop(0)
+
+    def __positionsAt(self, t):
+        ''' Must hold the condition. '''
+        for segment in self.__segments:
+            if t < segment.startTime:
+                return dict(segment.startPositions)
+            if t < segment.endTime:
+                return segment.positionsAt(t)
+
+        return dict(self.__restPositions)
+
+    def getPositions(self):
+        with self.__condition:
+            return self.__positionsAt(self.now())
+
+    def getMotionEndTime(self):
+        ''' Virtual time at which every queued move is complete '''
+        with self.__condition:
+            if len(self.__segments) == 0:
+                return self.now()
+            return self.__segments[-1].endTime
+
+    def isMoving(self):
+        return self.getMotionEndTime() > self.now()
+
+    def queueMove(self, targets, speed=None):
+        '''
+        Queues a move of one or more axes after the moves already queued. Targets beyond
+        the travel of an axis stop at its end stop.
+
+        params:
+            targets: dict<int, float>
+                Absolute target position of each moving axis
+            speed: float
+                (Optional) Speed of this move, the current speed by default
+
+        returns:
+            MotionSegment
+        '''
+        with self.__condition:
+            if self.__isEstopped:
+                raise Exception('Cannot move while the machine is in estop')
+
+            now = self.now()
+            self.__pruneSegments(now)
+
+            startPositions = dict(self.__restPositions)
+            endPositions = dict(startPositions)
+            for axis, target in targets.items():
+                endPositions[axis] = min(max(float(target), 0.0), self.axisLengths[axis])
+
+            startTime = max(now, self.__segments[-1].endTime if len(self.__segments) > 0 else now)
+            segment = MotionSegment(startTime, startPositions, endPositions, speed if speed != None else self.speed, self.acceleration)
+            self.__segments.append(segment)
+            self.__restPositions = dict(endPositions)
+            return segment
+
+    def queueRelativeMove(self, distances, speed=None):
+        with self.__condition:
+            self.__pruneSegments(self.now())
+            targets = { axis: self.__restPositions[axis] + distance for axis, distance in distances.items() }
+            return self.queueMove(targets, speed)
+
+    def queueHome(self, axes=None):
+        return self.queueMove({ axis: 0.0 for axis in (axes if axes != None else self.AXES) }, self.homingSpeed)
+
+    def setPosition(self, axis, position):
+        ''' Redefines the current position of an idle axis, like G92 '''
+        with self.__condition:
+            self.__pruneSegments(self.now())
+            self.__restPositions[axis] = float(position)
+
+    def stop(self):
+        ''' Halts every axis where it currently is and drops the queued moves '''
+        with self.__condition:
+            self.__restPositions = self.__positionsAt(self.now())
+            self.__segments = []
+            self.__condition.notify_all()
+
+    def waitForMotionCompletion(self, timeout=None):
+        '''
+        Sleeps on the virtual clock until every queued move is complete. A call to stop
+        wakes the wait up right away.
+
+        returns:
+            bool
+                Whether or not the motion completed before the timeout
+        '''
+        deadline = None if timeout == None else self.now() + timeout
+        while True:
+            endTime = self.getMotionEndTime()
+            if endTime <= self.now():
+                return True
+            if deadline != None and self.now() >= deadline:
+                return False
+
+            wakeTime = endTime if deadline == None else min(endTime, deadline)
+            if self.clock.isDiscrete():
+                self.sleepUntil(wakeTime)
+            else:
+                with self.__condition:
+                    self.__condition.wait(self.clock.toRealSeconds(wakeTime - self.now()))
+
+    def getEndStopStates(self):
+        positions = self.getPositions()
+        states = {}
+        for axis in self.AXES:
+            name = self.AXIS_NAMES[axis]
+            states[name + '_min'] = self.END_STOP_TRIGGERED if positions[axis] <= 0 else self.END_STOP_OPEN
+            states[name + '_max'] = self.END_STOP_TRIGGERED if positions[axis] >= self.axisLengths[axis] else self.END_STOP_OPEN
+        return states
+
+    def setEstopped(self, isEstopped):
+        if isEstopped:
+            self.stop()
+        with self.__condition:
+            self.__isEstopped = isEstopped
+
+    def isEstopped(self):
+        with self.__condition:
+            return self.__isEstopped
+
+    # ------------------------------------------------------------------------
+    # Digital IO
+
+    def addInputListener(self, func):
+        ''' Registers func(device, pin, value), called whenever a digital input changes '''
+        with self.__condition:
+            self.__inputListeners.append(func)
+
+    def readInput(self, device, pin):
+        with self.__condition:
+            return self.__inputs.get((device, pin), 0)
+
+    def setInput(self, device, pin, value, delaySeconds=0):
+        ''' Changes a digital input, now or after 'delaySeconds' of virtual time '''
+        if delaySeconds > 0:
+            self.schedule(delaySeconds, self.setInput, device, pin, value)
+            return
+
+        with self.__condition:
+            if self.__inputs.get((device, pin), 0) == value:
+                return
+            self.__inputs[(device, pin)] = value
+            listeners = list(self.__inputListeners)
+
+        for listener in listeners:
+            listener(device, pin, value)
+
+    def readOutput(self, device, pin):
+        with self.__condition:
+            return self.__outputs.get((device, pin), 0)
+
+    def writeOutput(self, device, pin, value):
+        with self.__condition:
+            self.__outputs[(device, pin)] = value
+            links = list(self.__outputLinks.get((device, pin), []))
+
+        for inputDevice, inputPin, delaySeconds, invert in links:
+            self.setInput(inputDevice, inputPin, (1 - value) if invert else value, delaySeconds)
+
+    def linkOutputToInput(self, device, pin, inputDevice, inputPin, delaySeconds=0, invert=False):
+        '''
+        Makes a digital input follow a digital output after a delay, for example the end-of-stroke
+        sensor of a cylinder driven by that output.
+        '''
+        with self.__condition:
+            self.__outputLinks.setdefault((device, pin), []).append((inputDevice, inputPin, delaySeconds, invert))
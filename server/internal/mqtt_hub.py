@@ -0,0 +1,190 @@
+import logging
+import threading
+import paho.mqtt.client as mqtt
+from internal.topic_trie import TopicTrie
+
+class MqttMessage:
+    '''
+    Incoming MQTT message. The topic is split and the payload decoded once, no matter
+    how many subscribers receive the message.
+    '''
+    def __init__(self, topic, rawPayload):
+        self.topic = topic
+        self.topicParts = topic.split('/')
+        self.rawPayload = rawPayload
+        self.payload = rawPayload.decode('utf-8', 'replace')
+
+class MqttHub:
+    '''
+    Single MQTT connection to a broker, shared by every object that talks to it
+    (MachineMotion, Sensor, Pneumatic, ...). Objects subscribe with a callback instead
+    of opening their own client, so a machine with many sensors still uses one socket
+    and one network thread per broker.
+
+    Subscriptions are reference counted: the broker subscription is made when the first
+    callback registers for a topic, and removed when the last one leaves. They are
+    restored automatically when the connection comes back. Incoming messages are matched
+    against a topic trie, so only the matching callbacks are visited.
+
+    Do not construct this class yourself; use getMqttHub instead.
+    '''
+
+    def __init__(self, ipAddress):
+        self.__logger = logging.getLogger(__name__)
+        self.__ipAddress = ipAddress
+        self.__lock = threading.RLock()
+        self.__subscriptions = TopicTrie()              # Topic filter -> callbacks
+        self.__connectionListeners = []                 # (onConnect, onDisconnect) pairs
+        self.__connectedEvent = threading.Event()
+        self.__networkThread = None                     # Thread running the callbacks, known once it ran one
+
+        self.client = mqttClientFactory()
+        self.client.on_connect = self.__onConnect
+        self.client.on_message = self.__onMessage
+        self.client.on_disconnect = self.__onDisconnect
+        self.client.connect(ipAddress)
+        self.client.loop_start()
+
+    def getIpAddress(self):
+        return self.__ipAddress
+
+    def isConnected(self):
+        return self.__connectedEvent.is_set()
+
+    def isNetworkThread(self):
+        '''
+        Returns whether the caller runs on the network thread of the hub, i.e. inside one of
+        its callbacks. Messages are only received between callbacks, so code running there
+        must not block waiting for a message.
+        '''
+        return self.__networkThread is threading.current_thread()
+
+    def waitForConnection(self, timeout=None):
+        '''
+        Blocks until the hub is connected to the broker.
+
+        params:
+            timeout: float
+                Maximum time to wait in seconds, or None to wait forever
+
+        returns:
+            bool
+                Whether or not the hub is connected
+        '''
+        return self.__connectedEvent.wait(timeout)
+
+    def addConnectionListener(self, onConnect=None, onDisconnect=None):
+        '''
+        Registers callbacks for connection events. They have the same signatures as the
+        on_connect and on_disconnect callbacks of a paho client.
+        '''
+        with self.__lock:
+            self.__connectionListeners.append((onConnect, onDisconnect))
+
+    def removeConnectionListener(self, onConnect=None, onDisconnect=None):
+        with self.__lock:
+            if (onConnect, onDisconnect) in self.__connectionListeners:
+                self.__connectionListeners.remove((onConnect, onDisconnect))
+
+    def subscribe(self, topic, callback):
+        '''
+        Subscribes a callback to a topic filter. Wildcards ('+' and '#') are supported.
+
+        params:
+            topic: str
+                MQTT topic filter
+
+            callback: func(message: MqttMessage) -> void
+                Called on the network thread for every message matching the filter
+        '''
+        with self.__lock:
+            if self.__subscriptions.add(topic, callback):
+                self.client.subscribe(topic)
+
+    def unsubscribe(self, topic, callback):
+        '''
+        Removes one reference of a callback from a topic filter.
+        '''
+        with self.__lock:
+            if self.__subscriptions.remove(topic, callback):
+                self.client.unsubscribe(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def close(self):
+        ''' Disconnects from the broker and stops the network thread '''
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def __onConnect(self, client, userData, flags, rc):
+        self.__networkThread = threading.current_thread()
+
+        with self.__lock:
+            if rc == 0:
+                for topic in self.__subscriptions.getFilters():
+                    self.client.subscribe(topic)
+
+                self.__connectedEvent.set()
+                self.__logger.info('Connected to MQTT broker at {}'.format(self.__ipAddress))
+
+            listeners = list(self.__connectionListeners)
+
+        for onConnect, _ in listeners:
+            if onConnect != None:
+                onConnect(client, userData, flags, rc)
+
+    def __onDisconnect(self, client, userData, rc):
+        self.__connectedEvent.clear()
+        self.__logger.info('Disconnected from MQTT broker at {} with code {}'.format(self.__ipAddress, rc))
+
+        with self.__lock:
+            listeners = list(self.__connectionListeners)
+
+        for _, onDisconnect in listeners:
+            if onDisconnect != None:
+                onDisconnect(client, userData, rc)
+
+    def __onMessage(self, client, userData, msg):
+        self.__networkThread = threading.current_thread()
+        message = MqttMessage(msg.topic, msg.payload)
+
+        # Each callback runs once per message, even when several of its filters match
+        with self.__lock:
+            matchingCallbacks = self.__subscriptions.match(message.topicParts)
+
+        for callback in matchingCallbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                self.__logger.error('Exception in MQTT callback for {}: {}'.format(msg.topic, str(e)))
+
+hubLock = threading.Lock()
+hubsByIpAddress = {}
+mqttClientFactory = mqtt.Client
+
+def setMqttClientFactory(factory):
+    '''
+    Replaces the function used to create the MQTT client of new hubs. It takes no argument
+    and returns an object with the interface of a paho client. Used to run against an
+    in-process broker (see benchmarks/fake_mqtt.py) instead of a controller.
+
+    The hubs created so far are closed and forgotten, so that getMqttHub creates new ones
+    with the new factory. Objects still holding one of the old hubs stop receiving messages.
+    '''
+    global mqttClientFactory
+    with hubLock:
+        mqttClientFactory = factory
+        hubs = list(hubsByIpAddress.values())
+        hubsByIpAddress.clear()
+
+    for hub in hubs:
+        hub.close()
+
+def getMqttHub(ipAddress):
+    ''' Retrieves the shared MQTT hub of a broker, connecting to it on first use '''
+    with hubLock:
+        if not ipAddress in hubsByIpAddress:
+            hubsByIpAddress[ipAddress] = MqttHub(ipAddress)
+
+        return hubsByIpAddress[ipAddress]
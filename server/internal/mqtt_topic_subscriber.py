@@ -8,8 +8,8 @@ class MqttTopicSubscriber:
         self.__lock = RLock()
         self.__queue = []
         self.__callbacks = {}
+        self.__topicListeners = {}                      # Topic filter -> listener registered on the machine motion
         self.__machineMotion = machineMotion
-        self.__machineMotion.addMqttCallback(self.__mqttEventCallback)
         self.__logger = logging.getLogger(__name__)
         self.__logger.info('Registered new MQTT callback')
 
@@ -20,12 +20,25 @@ class MqttTopicSubscriber:
         '''
         Must be called when your Mqtt subscriber is no longer in use
         '''
-        self.__machineMotion.removeMqttCallback(self.__mqttEventCallback)
+        for topic, listener in self.__topicListeners.items():
+            self.__machineMotion.removeMqttCallback(listener, topic)
+
+        self.__topicListeners.clear()
+        self.__callbacks.clear()
         self.__logger.info('Removed MQTT callback')
 
-    def __mqttEventCallback(self, topic, msg):
-        with self.__lock:
-            self.__queue.append((topic, msg))
+    def __listenTo(self, topic):
+        '''
+        Registers a listener for a single topic filter on the machine motion. Messages are
+        queued together with the filter they matched, so that 'update' can dispatch them
+        without matching the topic again.
+        '''
+        def listener(messageTopic, msg):
+            with self.__lock:
+                self.__queue.append((topic, messageTopic, msg))
+
+        self.__topicListeners[topic] = listener
+        self.__machineMotion.addMqttCallback(listener, topic)
 
     def registerCallback(self, topic, callback):
         ''' 
@@ -34,15 +47,14 @@ class MqttTopicSubscriber:
 
         params:
             topic: str
-                MQTT topic that you'd like to subscribe to
+                MQTT topic that you'd like to subscribe to. Wildcards ('+' and '#') are supported.
 
             callback: func(topic: str, msg: str) -> void
                 Callback that gets called when we receive data on that topic
         '''
-        self.__machineMotion.myMqttClient.subscribe(topic)
-
         if not topic in self.__callbacks:
             self.__callbacks[topic] = []
+            self.__listenTo(topic)
 
         self.__callbacks[topic].append(callback)
         return True
@@ -59,10 +71,13 @@ class MqttTopicSubscriber:
             callback: func(topic: str, msg: str) -> void
                 Callback that gets called when we receive data on that topic
         '''
-        if not topic in self.__callbacks:
+        if not topic in self.__callbacks or not callback in self.__callbacks[topic]:
             return
 
         self.__callbacks[topic].remove(callback)
+        if len(self.__callbacks[topic]) == 0:
+            del self.__callbacks[topic]
+            self.__machineMotion.removeMqttCallback(self.__topicListeners.pop(topic), topic)
 
     def update(self):
         '''
@@ -75,8 +90,9 @@ class MqttTopicSubscriber:
 
         for item in processQueue:
             topic = item[0]
-            msg = item[1]
+            messageTopic = item[1]
+            msg = item[2]
             if topic in self.__callbacks:
                 callbackList = self.__callbacks[topic]
                 for callback in callbackList:
-                    callback(topic, msg)
\ No newline at end of file
+                    callback(messageTopic, msg)
@@ -1,9 +1,10 @@
 import websockets
 import asyncio
-from threading import RLock, Thread
+from threading import Lock, Thread
 import logging
 import json
 import time
+from collections import OrderedDict
 
 class NotificationLevel:
     ''' 
@@ -22,14 +23,72 @@ class NotificationLevel:
     WARNING             = 'warning'
     ERROR               = 'error'
     IO_STATE            = 'io_state'
+    IO_STATE_SNAPSHOT   = 'io_state_snapshot'
+    STATE_PROFILE       = 'state_profile'
 
 
+class ClientChannel:
+    '''
+    Outgoing message buffer of a single websocket client. Messages are sent in batches
+    (one JSON array per flush) by a task dedicated to this client, so that a slow
+    client only delays its own messages.
+
+    The buffer is bounded: when it is full, the oldest message is dropped. Messages
+    sharing a coalescing key replace each other, so that only the latest one is sent.
+
+    If a send fails, the flush task ends and onSendFailed(channel, error) is called, so
+    that the owner stops buffering messages for a dead client.
+    '''
+    def __init__(self, websocket, maxQueueSize, onSendFailed=None):
+        self.websocket = websocket
+        self.maxQueueSize = maxQueueSize
+        self.droppedCount = 0
+        self.onSendFailed = onSendFailed
+        self.__pending = OrderedDict()                  # Coalescing key (or unique id) -> message
+        self.__nextId = 0
+        self.__hasPending = asyncio.Event()
+
+    def push(self, message, coalesceKey):
+        if coalesceKey == None:
+            coalesceKey = self.__nextId
+            self.__nextId += 1
+
+        # A superseded message is replaced where it stands, so messages keep their order
+        self.__pending[coalesceKey] = message
+        while len(self.__pending) > self.maxQueueSize:
+            self.__pending.popitem(last=False)
+            self.droppedCount += 1
+
+        self.__hasPending.set()
+
+    async def flushForever(self):
+        while True:
+            await self.__hasPending.wait()
+            self.__hasPending.clear()
+
+            batch = list(self.__pending.values())
+            self.__pending.clear()
+            if len(batch) > 0:
+                try:
+                    await self.websocket.send(json.dumps(batch))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    if self.onSendFailed != None:
+                        self.onSendFailed(self, error)
+                    return
+
 class Notifier:
     ''' Websocket server used to stream information about a run in progress to the web client '''
+    MAX_CLIENT_QUEUE_SIZE = 500
+
     def __init__(self):
         self.__logger = logging.getLogger(__name__)
-        self.lock = RLock()
-        self.queue = []
+        self.lock = Lock()
+        self.loop = None
+        self.messageQueue = None
+        self.pendingBeforeStart = []        # Messages sent before the event loop was ready
+        self.channels = {}
 
         thread = Thread(name='Notifier', target=self.__run, args=('0.0.0.0', '8081'))
         thread.daemon = True
@@ -41,14 +100,24 @@ class Notifier:
         asyncio.set_event_loop(loop)
         self.server = websockets.serve(self.handler, ip, port)
         self.clients = set()
+        self.messageQueue = asyncio.Queue()
+
+        # Once the loop is published, producers hand messages straight to the queue
+        with self.lock:
+            for item in self.pendingBeforeStart:
+                self.messageQueue.put_nowait(item)
+            self.pendingBeforeStart = []
+            self.loop = loop
         
-        self.__logger.info('Websocket loop exiting.')
         asyncio.get_event_loop().create_task(self.run())
         asyncio.get_event_loop().run_until_complete(self.server)
         asyncio.get_event_loop().run_forever()
 
     async def handler(self, websocket, path):
         self.clients.add(websocket)
+        channel = ClientChannel(websocket, Notifier.MAX_CLIENT_QUEUE_SIZE, self.__onSendFailed)
+        self.channels[websocket] = channel
+        flushTask = asyncio.get_event_loop().create_task(channel.flushForever())
         try:
             while True:
                 message = await websocket.recv()
@@ -56,34 +125,64 @@ class Notifier:
         except websockets.ConnectionClosed:
             pass
         finally:
-            self.clients.remove(websocket)
+            flushTask.cancel()
+            self.__unregister(websocket)
+
+            if channel.droppedCount > 0:
+                self.__logger.warning('Dropped {} messages for a slow websocket client'.format(channel.droppedCount))
+
+    def __unregister(self, websocket):
+        ''' Stops delivering messages to a client. Runs on the event loop '''
+        self.channels.pop(websocket, None)
+        self.clients.discard(websocket)
+
+    def __onSendFailed(self, channel, error):
+        '''
+        Called by a client channel whose send failed (e.g. the connection is closed). The client is
+        dropped right away, and its connection closed so that its handler ends too.
+        '''
+        self.__logger.warning('Could not send to a websocket client, disconnecting it: {}'.format(error))
+        self.__unregister(channel.websocket)
+        asyncio.get_event_loop().create_task(channel.websocket.close())
 
     async def run(self):
         self.isRunning = True
         while self.isRunning:
-            sendQueue = []
-            with self.lock:
-                sendQueue = self.queue.copy()
-                self.queue.clear()
+            item = await self.messageQueue.get()
+
+            # Hand every message that is already queued over to each client; the actual
+            # sends happen in the client flush tasks
+            while item != None:
+                jsonMsg, coalesceKey = item
+                for channel in self.channels.values():
+                    channel.push(jsonMsg, coalesceKey)
 
-            for item in sendQueue:
-                jsonifiedMsg = json.dumps(item)
                 try:
-                    await asyncio.gather(
-                        *[ws.send(jsonifiedMsg) for ws in self.clients],
-                        return_exceptions=False
-                    )
-                except Exception as e:
-                    self.__logger.error('Exception while trying to send data: {}'.format(str(e)))
-
-            await asyncio.sleep(0.16)
+                    item = self.messageQueue.get_nowait()
+                except asyncio.QueueEmpty:
+                    item = None
         
         self.__logger.info('Websocket loop exiting.')
+
+    def __post(self, item):
+        '''
+        Hands an item over to the event loop. Safe to call from any thread.
+        '''
+        loop = self.loop
+        if loop == None:
+            with self.lock:
+                if self.loop == None:
+                    self.pendingBeforeStart.append(item)
+                    return
+                loop = self.loop
+
+        loop.call_soon_threadsafe(self.messageQueue.put_nowait, item)
             
     def setDead(self):
         self.isRunning = False
+        self.__post(None)                   # Wakes up the loop so that it notices
 
-    def sendMessage(self, level, message, customPayload=None):
+    def sendMessage(self, level, message, customPayload=None, coalesceKey=None):
         '''
         Broadcast a message to all connected clients
 
@@ -94,6 +193,10 @@ class Notifier:
                 message to be shown on the client
             customPayload: dict
                 (Optional) Custom data to be sent to the client, if any
+            coalesceKey: hashable
+                (Optional) Messages with the same key supersede each other: a client that has
+                not received the previous one yet only gets the latest. By default, IO_STATE
+                messages are coalesced per IO and IO_STATE_SNAPSHOT messages with each other.
         '''
 
         jsonMsg = {
@@ -103,8 +206,13 @@ class Notifier:
             "customPayload": customPayload
         }
 
-        with self.lock:
-            self.queue.append(jsonMsg)
+        if coalesceKey == None:
+            if level == NotificationLevel.IO_STATE and isinstance(customPayload, dict):
+                coalesceKey = (level, customPayload.get('device'), customPayload.get('pin'))
+            elif level == NotificationLevel.IO_STATE_SNAPSHOT:
+                coalesceKey = level
+
+        self.__post((jsonMsg, coalesceKey))
 
 globalNotifier = None
 
@@ -0,0 +1,139 @@
+'''
+Parsers for the replies of the MachineMotion controller to g-code commands.
+
+Every parser reads the reply once, with precompiled regular expressions, and returns
+a typed result. A reply is acknowledged when it contains both the echo of the command
+and 'ok'. Lines may be separated by real newlines or, as returned by HTTPSend on
+python 3, by escaped '\\n' sequences.
+
+    result = parsePositions(gCode.__emit__('M114'))
+    if not result.isAck: ...
+    result.positions        # { 1: float, 2: float, 3: float }
+
+V0 is polled in a loop while waiting for motion to complete, so isMotionCompleted
+answers it with plain substring tests and no result object.
+'''
+import re
+
+_NUMBER = r'(-?[\d.]+)'
+
+_POSITIONS_PATTERN = re.compile(r'X:\s*' + _NUMBER + r'\s+Y:\s*' + _NUMBER + r'\s+Z:\s*' + _NUMBER)
+_END_STOP_PATTERN = re.compile(r'([xyz]_(?:min|max)):\s*([A-Za-z_]+)')
+
+END_STOP_NAMES = ('x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max')
+
+class ReplyParseError(Exception):
+    ''' Raised when an acknowledged reply does not hold the expected data '''
+    def __init__(self, message, reply):
+        super(ReplyParseError, self).__init__('{} (reply: {})'.format(message, reply))
+        self.reply = reply
+
+class AckReply:
+    ''' Reply to a command that only needs to be acknowledged '''
+    __slots__ = ('raw', 'isAck')
+
+    def __init__(self, raw, isAck):
+        self.raw = raw
+        self.isAck = isAck
+
+class PositionsReply(AckReply):
+    ''' Reply to M114. positions maps each axis (1, 2, 3) to its position, or is None if not acknowledged '''
+    __slots__ = ('positions',)
+
+    def __init__(self, raw, isAck, positions):
+        self.raw = raw
+        self.isAck = isAck
+        self.positions = positions
+
+class EndStopsReply(AckReply):
+    ''' Reply to M119. states maps each end stop (x_min, x_max, ...) to its state ('open', 'TRIGGERED'), or is None if not acknowledged '''
+    __slots__ = ('states',)
+
+    def __init__(self, raw, isAck, states):
+        self.raw = raw
+        self.isAck = isAck
+        self.states = states
+
+class MotionCompletedReply(AckReply):
+    ''' Reply to V0. isCompleted is True if no motion is in progress '''
+    __slots__ = ('isCompleted',)
+
+    def __init__(self, raw, isAck, isCompleted):
+        self.raw = raw
+        self.isAck = isAck
+        self.isCompleted = isCompleted
+
+def isAck(reply):
+    '''
+    Returns whether the controller acknowledged the command.
+
+    Plain substring tests are faster than a regular expression for this check, which
+    runs on every reply.
+    '''
+    return 'echo' in reply and 'ok' in reply
+
+def parseAck(reply):
+    return AckReply(reply, isAck(reply))
+
+def parsePositions(reply):
+    '''
+    Parses the reply to M114.
+
+    returns:
+        PositionsReply
+
+    raises:
+        ReplyParseError if the reply is acknowledged but holds no position
+    '''
+    if not isAck(reply):
+        return PositionsReply(reply, False, None)
+
+    match = _POSITIONS_PATTERN.search(reply)
+    if match == None:
+        raise ReplyParseError('No position in the M114 reply', reply)
+
+    return PositionsReply(reply, True, { 1: float(match.group(1)), 2: float(match.group(2)), 3: float(match.group(3)) })
+
+def parseEndStops(reply):
+    '''
+    Parses the reply to M119.
+
+    returns:
+        EndStopsReply
+
+    raises:
+        ReplyParseError if the reply is acknowledged but does not report every end stop
+    '''
+    if not isAck(reply):
+        return EndStopsReply(reply, False, None)
+
+    states = dict(_END_STOP_PATTERN.findall(reply))
+    for name in END_STOP_NAMES:
+        if not name in states:
+            raise ReplyParseError('No {} state in the M119 reply'.format(name), reply)
+
+    return EndStopsReply(reply, True, { name: states[name] for name in END_STOP_NAMES })
+
+def isMotionCompleted(reply):
+    '''
+    Fast path for the reply to V0.
+
+    returns:
+        bool
+            Whether no motion is in progress, or None if the reply is not acknowledged
+    '''
+    if 'echo' in reply and 'ok' in reply:
+        return 'COMPLETED' in reply
+    return None
+
+def parseMotionCompleted(reply):
+    '''
+    Parses the reply to V0.
+
+    returns:
+        MotionCompletedReply
+    '''
+    if not isAck(reply):
+        return MotionCompletedReply(reply, False, False)
+
+    return MotionCompletedReply(reply, True, 'COMPLETED' in reply)
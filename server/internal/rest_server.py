@@ -5,7 +5,6 @@ import time
 from threading import Thread
 from pathlib import Path
 import json
-from machine_app import MachineAppEngine
 from internal.notifier import getNotifier, NotificationLevel
 import signal
 
@@ -35,6 +34,8 @@ class RestServer(Bottle):
         self.route('/run/releaseEstop', method='POST', callback=self.releaseEstop)
         self.route('/run/resetSystem', method='POST', callback=self.resetSystem)
         self.route('/run/state', method='GET', callback=self.getState)
+        self.route('/run/profile', method='GET', callback=self.getProfile)
+        self.route('/run/profile', method='DELETE', callback=self.resetProfile)
 
         self.route('/kill', method='GET', callback=self.kill)
         self.route('/logs', method='GET', callback=self.getLog)
@@ -114,8 +115,7 @@ class RestServer(Bottle):
             abort(400, 'Failed to resume the MachineApp')
 
     def estop(self):
-        if self.__machineApp != None:
-            self.__machineApp.estop()
+        if self.__machineApp != None and self.__machineApp.estop():
             return 'OK'
         else:
             abort(400, 'Failed to estop the MachineApp')
@@ -144,6 +144,13 @@ class RestServer(Bottle):
             "isPaused": self.__machineApp.isPaused
         }
 
+    def getProfile(self):
+        return self.__machineApp.getProfile()
+
+    def resetProfile(self):
+        self.__machineApp.resetProfile()
+        return 'OK'
+
     def kill(self):
         getNotifier().setDead()
         self.__machineApp.kill()
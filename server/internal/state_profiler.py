@@ -0,0 +1,150 @@
+from threading import Lock
+from collections import deque
+
+class RollingHistogram:
+    '''
+    Keeps the last 'windowSize' samples of a duration, and summarizes them on demand.
+    The total count and sum cover every sample ever added.
+    '''
+    def __init__(self, windowSize):
+        self.__samples = deque(maxlen=windowSize)
+        self.__totalCount = 0
+        self.__totalSeconds = 0.0
+
+    def add(self, seconds):
+        self.__samples.append(seconds)
+        self.__totalCount += 1
+        self.__totalSeconds += seconds
+
+    def getSummary(self):
+        '''
+        Summarizes the window in milliseconds.
+
+        returns:
+            dict
+                count and totalMs cover every sample, the other values only the window
+        '''
+        summary = {
+            'count': self.__totalCount,
+            'totalMs': 1000 * self.__totalSeconds
+        }
+
+        values = sorted(self.__samples)
+        if len(values) == 0:
+            return summary
+
+        def percentile(fraction):
+            return 1000 * values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+        summary.update({
+            'windowCount': len(values),
+            'lastMs': 1000 * self.__samples[-1],
+            'meanMs': 1000 * sum(values) / len(values),
+            'minMs': 1000 * values[0],
+            'p50Ms': percentile(0.50),
+            'p95Ms': percentile(0.95),
+            'p99Ms': percentile(0.99),
+            'maxMs': 1000 * values[-1]
+        })
+        return summary
+
+class StateProfiler:
+    '''
+    Records how long the MachineApp spends in each state. For every state, it keeps
+    rolling histograms of the time spent in onEnter, update and onLeave, and of the
+    dwell time (from entering the state to leaving it). It also counts transitions
+    between states, and measures full cycles: the time between two entries into the
+    cycle start state, which is the default state of the engine unless set otherwise.
+
+    Recording is done by the engine thread. getReport may be called from any thread.
+    '''
+    ON_ENTER    = 'onEnter'
+    UPDATE      = 'update'
+    ON_LEAVE    = 'onLeave'
+    DWELL       = 'dwell'
+
+    WINDOW_SIZE = 500
+
+    def __init__(self, windowSize=WINDOW_SIZE):
+        self.windowSize = windowSize
+        self.cycleStartState = None                 # Entering this state completes a cycle and starts the next one
+
+        self.__lock = Lock()
+        self.__states = {}                          # State name -> { phase: RollingHistogram }
+        self.__transitionCounts = {}                # (from state, to state) -> count
+        self.__cycles = RollingHistogram(windowSize)
+        self.__cycleStartedAt = None
+        self.__enteredAt = None                     # Time at which the current state was entered
+
+    def __getHistogram(self, stateName, phase):
+        histograms = self.__states.get(stateName)
+        if histograms == None:
+            histograms = { phase: RollingHistogram(self.windowSize) for phase in [StateProfiler.ON_ENTER, StateProfiler.UPDATE, StateProfiler.ON_LEAVE, StateProfiler.DWELL] }
+            self.__states[stateName] = histograms
+
+        return histograms[phase]
+
+    def onRunStarted(self, cycleStartState):
+        '''
+        Called when the MachineApp starts. The cycle and dwell times in progress belong to
+        the previous run, so they are dropped.
+        '''
+        with self.__lock:
+            self.cycleStartState = cycleStartState
+            self.__cycleStartedAt = None
+            self.__enteredAt = None
+
+    def recordPhase(self, stateName, phase, seconds):
+        ''' Records the duration of a call to onEnter, update or onLeave '''
+        with self.__lock:
+            self.__getHistogram(stateName, phase).add(seconds)
+
+    def recordTransition(self, fromState, toState, timeSeconds):
+        '''
+        Records a transition, made at 'timeSeconds' (time.perf_counter()). The first transition
+        of a run is recorded as coming from None, whatever state the engine was left in.
+        '''
+        with self.__lock:
+            if self.__enteredAt == None:
+                fromState = None
+            else:
+                self.__getHistogram(fromState, StateProfiler.DWELL).add(timeSeconds - self.__enteredAt)
+            self.__enteredAt = timeSeconds
+
+            key = (fromState, toState)
+            self.__transitionCounts[key] = self.__transitionCounts.get(key, 0) + 1
+
+            if toState == self.cycleStartState:
+                if self.__cycleStartedAt != None:
+                    self.__cycles.add(timeSeconds - self.__cycleStartedAt)
+                self.__cycleStartedAt = timeSeconds
+
+    def reset(self):
+        ''' Clears every measurement '''
+        with self.__lock:
+            self.__states = {}
+            self.__transitionCounts = {}
+            self.__cycles = RollingHistogram(self.windowSize)
+            self.__cycleStartedAt = None
+            self.__enteredAt = None
+
+    def getReport(self):
+        '''
+        Returns every measurement, in a JSON serializable form.
+
+        returns:
+            dict
+                {
+                    'states': { stateName: { 'onEnter': summary, 'update': summary, 'onLeave': summary, 'dwell': summary } },
+                    'transitions': [ { 'from': stateName, 'to': stateName, 'count': int } ],
+                    'cycleStartState': stateName,
+                    'cycle': summary
+                }
+        '''
+        with self.__lock:
+            return {
+                'states': { stateName: { phase: histogram.getSummary() for phase, histogram in histograms.items() } for stateName, histograms in self.__states.items() },
+                'transitions': [ { 'from': fromState, 'to': toState, 'count': count } for (fromState, toState), count in self.__transitionCounts.items() ],
+                'cycleStartState': self.cycleStartState,
+                'cycle': self.__cycles.getSummary()
+            }
@@ -0,0 +1,184 @@
+import logging
+import time
+from threading import Condition, Event, Thread
+
+class TelemetryReading:
+    '''
+    A cached value, with the time at which it was read from the controller.
+    '''
+    def __init__(self, value, timeSeconds, error=None):
+        self.value = value                      # Value returned by the controller, or None if it was never read
+        self.timeSeconds = timeSeconds          # time.time() at which the value was read, or None
+        self.error = error                      # Exception raised by the last refresh attempt, None if it succeeded
+
+    def getAgeSeconds(self):
+        ''' Time elapsed since the value was read, or None if it was never read '''
+        if self.timeSeconds == None:
+            return None
+        return time.time() - self.timeSeconds
+
+    def isStale(self, maxAgeSeconds):
+        age = self.getAgeSeconds()
+        return age == None or age > maxAgeSeconds
+
+    def toJson(self):
+        return {
+            'value': self.value,
+            'timeSeconds': self.timeSeconds,
+            'ageSeconds': self.getAgeSeconds(),
+            'error': str(self.error) if self.error != None else None
+        }
+
+class TelemetryItem:
+    '''
+    Cache of a single controller query. Concurrent refreshes are merged: a caller that
+    asks for a refresh while one is in flight waits for it instead of sending another
+    request to the controller.
+    '''
+    def __init__(self, name, fetch):
+        self.name = name
+        self.__fetch = fetch
+        self.__condition = Condition()
+        self.__reading = TelemetryReading(None, None)
+        self.__isFetching = False
+
+    def getReading(self):
+        with self.__condition:
+            return self.__reading
+
+    def refresh(self, notBeforeSeconds=None):
+        '''
+        Reads the value from the controller. If a read is already in flight, its result is
+        returned instead, provided it succeeded and started at or after 'notBeforeSeconds'
+        (time.time(), None accepts any start time).
+
+        returns:
+            TelemetryReading
+        '''
+        with self.__condition:
+            while self.__isFetching:
+                self.__condition.wait()
+                reading = self.__reading
+                if reading.error == None and reading.timeSeconds != None and (notBeforeSeconds == None or reading.timeSeconds >= notBeforeSeconds):
+                    return reading
+
+            self.__isFetching = True
+
+        startTime = time.time()
+        try:
+            reading = TelemetryReading(self.__fetch(), startTime)
+        except Exception as error:
+            previous = self.getReading()
+            reading = TelemetryReading(previous.value, previous.timeSeconds, error)
+
+        with self.__condition:
+            self.__reading = reading
+            self.__isFetching = False
+            self.__condition.notify_all()
+
+        return reading
+
+class TelemetryService:
+    '''
+    Opt-in cache of the positions (M114) and end stop states (M119) of a MachineMotion.
+    A background thread refreshes both at a fixed rate, so that frequent readers (UI
+    polling, state logic) get the last known value without a round trip to the controller.
+
+        telemetry = machineMotion.enableTelemetry(refreshIntervalSeconds=0.1)
+        positions = telemetry.getPositions().value                  # Cached
+        positions = telemetry.getPositions(maxAgeSeconds=0).value   # Always fresh
+
+    Every read returns a TelemetryReading, which tells how old the value is and whether
+    the last refresh failed. A failed refresh keeps the last good value.
+    '''
+    DEFAULT_REFRESH_INTERVAL_SECONDS = 0.1
+
+    def __init__(self, machineMotion, refreshIntervalSeconds=DEFAULT_REFRESH_INTERVAL_SECONDS, refreshEndStops=True):
+        '''
+        params:
+            machineMotion: MachineMotion
+                Controller to query
+
+            refreshIntervalSeconds: float
+                Time between the start of two background refreshes
+
+            refreshEndStops: bool
+                (Optional) Set to False to only refresh positions in the background. End stop
+                states are then read on demand.
+        '''
+        self.logger = logging.getLogger(__name__)
+        self.refreshIntervalSeconds = refreshIntervalSeconds
+        self.refreshEndStops = refreshEndStops
+
+        self.__positions = TelemetryItem('positions', machineMotion.getCurrentPositions)
+        self.__endStops = TelemetryItem('endStops', machineMotion.getEndStopState)
+        self.__stoppedEvent = None                  # Stop signal of the running refresh loop, each loop has its own
+        self.__thread = None
+
+    def start(self):
+        if self.__thread != None:
+            return
+
+        # A new event, so that a loop stopped just before this call still sees its own event set
+        self.__stoppedEvent = Event()
+        self.__thread = Thread(name='TelemetryRefresh', target=self.__refreshLoop, args=(self.__stoppedEvent, ))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__stoppedEvent != None:
+            self.__stoppedEvent.set()
+        self.__stoppedEvent = None
+        self.__thread = None
+
+    def isRunning(self):
+        return self.__thread != None
+
+    def __refreshLoop(self, stoppedEvent):
+        failingItems = set()
+        while not stoppedEvent.is_set():
+            startTime = time.time()
+
+            items = [ self.__positions, self.__endStops ] if self.refreshEndStops else [ self.__positions ]
+            for item in items:
+                reading = item.refresh(startTime)
+
+                # Only log changes between failing and working, not every failed refresh
+                if reading.error != None and not item.name in failingItems:
+                    failingItems.add(item.name)
+                    self.logger.warning('Could not refresh the {} telemetry: {}'.format(item.name, reading.error))
+                elif reading.error == None and item.name in failingItems:
+                    failingItems.remove(item.name)
+                    self.logger.info('Refreshing the {} telemetry again'.format(item.name))
+
+            stoppedEvent.wait(max(0, self.refreshIntervalSeconds - (time.time() - startTime)))
+
+    def __read(self, item, maxAgeSeconds):
+        reading = item.getReading()
+        if reading.timeSeconds == None or (maxAgeSeconds != None and reading.isStale(maxAgeSeconds)):
+            reading = item.refresh(time.time() if maxAgeSeconds == 0 else None)
+        return reading
+
+    def getPositions(self, maxAgeSeconds=None):
+        '''
+        Returns the cached positions of each axis, as returned by MachineMotion.getCurrentPositions.
+
+        params:
+            maxAgeSeconds: float
+                (Optional) If the cached value is older than this, it is read from the controller
+                first. 0 always reads a fresh value. None returns the cached value as is.
+
+        returns:
+            TelemetryReading
+        '''
+        return self.__read(self.__positions, maxAgeSeconds)
+
+    def getEndStopStates(self, maxAgeSeconds=None):
+        '''
+        Returns the cached end stop states, as returned by MachineMotion.getEndStopState.
+        See getPositions for maxAgeSeconds.
+
+        returns:
+            TelemetryReading
+        '''
+        return self.__read(self.__endStops, maxAgeSeconds)
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+
+class TopicTrie:
+    '''
+    Maps MQTT topic filters to values (usually callbacks) and finds every value whose
+    filter matches a topic, with support for the '+' and '#' wildcards.
+
+    Matching walks one trie level per topic level, so its cost depends on the depth of
+    the topic rather than on the number of registered filters. The same value may be
+    added several times to a filter; it is reference counted and only removed when
+    every reference is gone.
+    '''
+
+    class Node:
+        def __init__(self):
+            self.children = {}                          # Topic level -> Node
+            self.values = OrderedDict()                 # Value -> reference count
+
+    def __init__(self):
+        self.__root = TopicTrie.Node()
+        self.__filterCount = 0
+
+    def add(self, topicFilter, value):
+        '''
+        Adds a value to a topic filter.
+
+        returns:
+            bool
+                True if the filter had no value before this call
+        '''
+        node = self.__root
+        for level in topicFilter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicTrie.Node()
+            node = child
+
+        isNewFilter = len(node.values) == 0
+        if isNewFilter:
+            self.__filterCount += 1
+
+        node.values[value] = node.values.get(value, 0) + 1
+        return isNewFilter
+
+    def remove(self, topicFilter, value):
+        '''
+        Removes one reference of a value from a topic filter.
+
+        returns:
+            bool
+                True if the filter has no value left after this call
+        '''
+        path = [self.__root]
+        levels = topicFilter.split('/')
+        for level in levels:
+            child = path[-1].children.get(level)
+            if child is None:
+                return False
+            path.append(child)
+
+        node = path[-1]
+        if not value in node.values:
+            return False
+
+        node.values[value] -= 1
+        if node.values[value] > 0:
+            return False
+
+        del node.values[value]
+        if len(node.values) > 0:
+            return False
+
+        self.__filterCount -= 1
+
+        # Prune the branches that no longer lead to any value
+        for idx in range(len(levels), 0, -1):
+            node = path[idx]
+            if len(node.values) > 0 or len(node.children) > 0:
+                break
+            del path[idx - 1].children[levels[idx - 1]]
+
+        return True
+
+    def match(self, topicParts):
+        '''
+        Returns the values of every filter that matches a topic, each value at most once.
+
+        params:
+            topicParts: list<str>
+                The topic, already split on '/'
+        '''
+        matches = OrderedDict()
+        # Per the MQTT spec, wildcards at the first level do not match topics starting with '$'
+        allowWildcards = not (len(topicParts) > 0 and topicParts[0].startswith('$'))
+        self.__match(self.__root, topicParts, 0, matches, allowWildcards)
+        return list(matches.keys())
+
+    def __match(self, node, topicParts, depth, matches, allowWildcards):
+        if allowWildcards:
+            multiLevel = node.children.get('#')
+            if multiLevel is not None:
+                for value in multiLevel.values:
+                    matches[value] = True
+
+        if depth == len(topicParts):
+            for value in node.values:
+                matches[value] = True
+            return
+
+        child = node.children.get(topicParts[depth])
+        if child is not None:
+            self.__match(child, topicParts, depth + 1, matches, True)
+
+        if allowWildcards:
+            singleLevel = node.children.get('+')
+            if singleLevel is not None:
+                self.__match(singleLevel, topicParts, depth + 1, matches, True)
+
+    def getFilters(self):
+        ''' Returns every topic filter that currently has at least one value '''
+        filters = []
+        self.__collectFilters(self.__root, [], filters)
+        return filters
+
+    def __collectFilters(self, node, levels, filters):
+        if len(node.values) > 0 and len(levels) > 0:
+            filters.append('/'.join(levels))
+
+        for level, child in node.children.items():
+            self.__collectFilters(child, levels + [level], filters)
+
+    def __len__(self):
+        return self.__filterCount
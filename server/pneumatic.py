@@ -1,66 +1,161 @@
 import logging
 log = logging.getLogger(__name__)
-import paho.mqtt.client as mqtt
-import paho.mqtt.subscribe as MQTTsubscribe
+import threading
 import time
+from concurrent.futures import Future, CancelledError
+from internal.mqtt_hub import getMqttHub
 
 
 class Pneumatic ():
-        
-    def __onConnect(self, client, userData, flags, rc):
-        # print("{} with return code {}".format(self.name, rc))
-        if rc == 0:
-            self.connected = True
-            # topic = 'devices/io-expander/'+ str(self.networkID) +'/digital-input/'+ str(self.pin)
-            # self.pneuClient.subscribe(topic)
-            # log.info(self.name + " connected to pin " + str(self.pin))
-        return
+    '''
+    Double acting cylinder driven by two digital outputs of an IO module.
+
+    Actuations return a concurrent.futures.Future (the "handle") that resolves to True once the
+    cylinder is considered in position: either after a fixed settle time, or, when an end-of-stroke
+    Sensor is provided for that direction, as soon as the sensor reports a rising edge. A handle
+    that has not completed yet is cancelled when the cylinder is actuated again.
+    '''
+    FEEDBACK_POLL_SECONDS = 0.1         # How often a wait for an end-of-stroke sensor checks whether its actuation was cancelled
 
+    class timeoutException(Exception):
+        pass
     
     def _turn_pin_on(self,pin):
         topic = "devices/io-expander/{id}/digital-output/{pin}".format(id=self.networkId, pin=pin)
         msg='1'
-        return self.pneuClient.publish(topic, msg)
+        return self.mqttHub.publish(topic, msg)
     
     def _turn_pin_off(self,pin):
         topic = "devices/io-expander/{id}/digital-output/{pin}".format(id=self.networkId, pin=pin)
         msg='0'
-        return self.pneuClient.publish(topic, msg)
+        return self.mqttHub.publish(topic, msg)
     
 
-    #TODO: Add functionality for home pin and end pin
-    def __init__(self, name, ipAddress, networkId, pushPin, pullPin):
+    def __init__(self, name, ipAddress, networkId, pushPin, pullPin, pushSettleTimeSeconds=3, pullSettleTimeSeconds=0,
+            pushedSensor=None, pulledSensor=None, feedbackTimeoutSeconds=10):
+        '''
+        params:
+            pushSettleTimeSeconds, pullSettleTimeSeconds: float
+                Time the cylinder takes to complete a push or pull stroke
+            pushedSensor, pulledSensor: Sensor
+                (Optional) End-of-stroke inputs. When provided, the matching actuation completes on
+                the rising edge of the sensor instead of after the settle time.
+            feedbackTimeoutSeconds: float
+                Maximum time to wait for an end-of-stroke sensor before failing the actuation
+        '''
         self.connected=False
         self.networkId = networkId
         self.pushPin = pushPin
         self.pullPin = pullPin
         self.name = name
-        self.pneuClient = None
-        self.pneuClient = mqtt.Client()
-        self.pneuClient.on_connect = self.__onConnect
-        self.pneuClient.connect(ipAddress)
-        self.pneuClient.loop_start()
+        self.pushSettleTimeSeconds = pushSettleTimeSeconds
+        self.pullSettleTimeSeconds = pullSettleTimeSeconds
+        self.pushedSensor = pushedSensor
+        self.pulledSensor = pulledSensor
+        self.feedbackTimeoutSeconds = feedbackTimeoutSeconds
+
+        self.__lock = threading.Lock()
+        self.__pendingHandle = None
+
+        # The broker connection is shared with every other device on the same IP
+        self.mqttHub = getMqttHub(ipAddress)
+        self.pneuClient = self.mqttHub.client
         # Block initialization until mqtt client has established connection
-        t0 = time.time()
-        while self.connected==False:
-            if time.time()-t0 > 15:
-                raise Exception("System timeout during connection to to {}".format(self.name))
-                
-            time.sleep(0.2)
+        if not self.mqttHub.waitForConnection(15):
+            raise Exception("System timeout during connection to to {}".format(self.name))
+
+        self.connected = True
+
+    def __actuate(self, offPins, onPin, settleTimeSeconds, endSensor):
+        handle = Future()
+
+        with self.__lock:
+            if self.__pendingHandle is not None:
+                self.__pendingHandle.cancel()       # Superseded by this actuation
+            self.__pendingHandle = handle
+
+            edgeCount = None
+            if endSensor is not None:
+                if endSensor.getState() == 1:
+                    settleTimeSeconds = 0           # Already at the end of the stroke, no edge will come
+                else:
+                    edgeCount = endSensor.get_rising_edge_count()
+
+            for offPin in offPins:
+                self._turn_pin_off(offPin)
+            if onPin is not None:
+                self._turn_pin_on(onPin)
+
+        if edgeCount is not None:
+            thread = threading.Thread(name='{}Feedback'.format(self.name), target=self.__waitForFeedback, args=(handle, endSensor, edgeCount))
+            thread.daemon = True
+            thread.start()
+        elif settleTimeSeconds > 0:
+            timer = threading.Timer(settleTimeSeconds, self.__complete, args=(handle, ))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.__complete(handle)
+
+        return handle
+
+    def __waitForFeedback(self, handle, endSensor, edgeCount):
+        # Waits in short slices, so that the thread ends soon after the handle is cancelled by a later actuation
+        deadline = time.time() + self.feedbackTimeoutSeconds
+        while not handle.done():
+            remainingSeconds = deadline - time.time()
+            if remainingSeconds <= 0:
+                self.__complete(handle, self.timeoutException('{} did not reach {} within {} seconds'.format(self.name, endSensor.name, self.feedbackTimeoutSeconds)))
+                return
+
+            try:
+                endSensor.wait_for_edge_count(endSensor.RISING_EDGE, edgeCount + 1, min(remainingSeconds, self.FEEDBACK_POLL_SECONDS))
+            except endSensor.timeoutException:
+                continue
+
+            self.__complete(handle)
+            return
+
+    def __complete(self, handle, exception=None):
+        with self.__lock:
+            if self.__pendingHandle is handle:
+                self.__pendingHandle = None
+            if handle.done():
+                return                              # Cancelled by a later actuation
+
+            if exception is None:
+                handle.set_result(True)
+            else:
+                handle.set_exception(exception)
+
+    def pushAsync(self):
+        ''' Starts a push stroke and returns a Future that resolves to True once it is complete '''
+        return self.__actuate([ self.pullPin ], self.pushPin, self.pushSettleTimeSeconds, self.pushedSensor)
+
+    def pullAsync(self):
+        ''' Starts a pull stroke and returns a Future that resolves to True once it is complete '''
+        return self.__actuate([ self.pushPin ], self.pullPin, self.pullSettleTimeSeconds, self.pulledSensor)
+
+    def releaseAsync(self):
+        ''' Turns both valves off and returns a Future that is already complete '''
+        return self.__actuate([ self.pullPin, self.pushPin ], None, 0, None)
     
+    def __waitForHandle(self, handle, actuation):
+        '''
+        Blocks until an actuation completes. Returns True once it is complete, and False if a
+        later actuation of the cylinder superseded it first.
+        '''
+        try:
+            return handle.result()
+        except CancelledError:
+            log.info('{} {} superseded by another actuation before completing'.format(self.name, actuation))
+            return False
+
     def push(self):
-        self._turn_pin_off(self.pullPin)
-        self._turn_pin_on(self.pushPin)
-        time.sleep(3)
-        return True
+        return self.__waitForHandle(self.pushAsync(), 'push')
         
     def pull(self):
-        self._turn_pin_off(self.pushPin)
-        self._turn_pin_on(self.pullPin)
-        return True
+        return self.__waitForHandle(self.pullAsync(), 'pull')
         
     def release(self):
-        self._turn_pin_off(self.pullPin)
-        self._turn_pin_off(self.pushPin)
-        return True
-        
+        return self.__waitForHandle(self.releaseAsync(), 'release')
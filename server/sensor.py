@@ -1,13 +1,25 @@
 import logging
 log = logging.getLogger(__name__)
-import paho.mqtt.client as mqtt
-import paho.mqtt.subscribe as MQTTsubscribe
 import time
+import threading
+from collections import deque
+from internal.mqtt_hub import getMqttHub
+
+class EdgeEvent:
+    ''' A rising or falling edge seen by a Sensor '''
+    def __init__(self, kind, timeSeconds, count):
+        self.kind = kind                        # Sensor.RISING_EDGE or Sensor.FALLING_EDGE
+        self.timeSeconds = timeSeconds          # time.time() at which the MQTT message was received
+        self.count = count                      # Number of edges of this kind seen so far, including this one
+
+    def __repr__(self):
+        return 'EdgeEvent({}, {}, {})'.format(self.kind, self.timeSeconds, self.count)
 
 class Sensor():
-    _on_rising_edge_flag = False
-    _on_falling_edge_flag = False
-    
+    RISING_EDGE = 'rising'
+    FALLING_EDGE = 'falling'
+    EDGE_HISTORY_SIZE = 256                     # Edges of each kind kept for wait_for_rising_edge and wait_for_falling_edge
+
     _on_rising_edge_cb = None
     _on_falling_edge_cb = None
     _on_state_change_cb = None
@@ -18,33 +30,42 @@ class Sensor():
     def getState(self):
         return self.state
         
-    def __onConnect(self, client, userData, flags, rc):
-        if rc == 0:
-            self.mqtt_topic = 'devices/io-expander/'+ str(self.networkId) +'/digital-input/'+ str(self.pin)
-            self.sensorClient.subscribe(self.mqtt_topic)
-            self.connected=True
-            log.info(self.name + " connected to pin " + str(self.pin))
-        
-
-    def __onMessage(self, client, userData, msg):
-        print("{} received msg {}".format(self.name, msg.payload))
-        value = msg.payload
-        self.state = int(value)
+    def __onMessage(self, msg):
+        log.debug("{} received msg {}".format(self.name, msg.payload))
+        value = int(msg.payload)
+        receivedAt = time.time()
         ret = ""
-        
-        
-        if not self.has_received_first_message:
-            return
-        
-        if self.state == 1:
-            self._on_rising_edge_flag = True
-            if self._on_rising_edge_cb is not None:
-                ret = self._on_rising_edge_cb()
-        elif self.state ==0:
-            self._on_falling_edge_flag = True
-            if self._on_falling_edge_cb is not None:
-                ret = self._on_falling_edge_cb()
-        elif self._on_state_change_cb is not None:
+
+        with self.__condition:
+            previousState = self.state
+            self.state = value
+
+            # The first message only tells us the current state
+            if not self.has_received_first_message:
+                self.has_received_first_message = True
+                return
+
+            if value == previousState:
+                return
+
+            edgeKind = None
+            if value == 1:
+                edgeKind = self.RISING_EDGE
+            elif value == 0:
+                edgeKind = self.FALLING_EDGE
+
+            if edgeKind is not None:
+                self.__edgeCounts[edgeKind] += 1
+                self.__lastEdges[edgeKind] = EdgeEvent(edgeKind, receivedAt, self.__edgeCounts[edgeKind])
+                self.__edgeHistories[edgeKind].append(self.__lastEdges[edgeKind])
+                self.__condition.notify_all()
+
+        # Callbacks run outside of the lock, so they may use the rest of the API
+        if edgeKind == self.RISING_EDGE and self._on_rising_edge_cb is not None:
+            ret = self._on_rising_edge_cb()
+        elif edgeKind == self.FALLING_EDGE and self._on_falling_edge_cb is not None:
+            ret = self._on_falling_edge_cb()
+        if self._on_state_change_cb is not None:
             ret = self._on_state_change_cb()
         return ret
         
@@ -55,22 +76,32 @@ class Sensor():
         self.networkId = networkId
         self.pin = pin
         self.name = name
-        self.sensorClient = None
-        self.sensorClient = mqtt.Client()
-        self.sensorClient.on_connect = self.__onConnect
-        self.sensorClient.on_message = self.__onMessage
-        self.sensorClient.connect(ipAddress)
+        self.state = None
         self.has_received_first_message = False
-        self.sensorClient.loop_start()
+        self.mqtt_topic = 'devices/io-expander/'+ str(self.networkId) +'/digital-input/'+ str(self.pin)
+
+        # Edges are counted rather than flagged, so that pulses arriving between two waits are not lost
+        self.__condition = threading.Condition()
+        self.__edgeCounts = { self.RISING_EDGE: 0, self.FALLING_EDGE: 0 }
+        self.__consumedCounts = { self.RISING_EDGE: 0, self.FALLING_EDGE: 0 }
+        self.__lastEdges = { self.RISING_EDGE: None, self.FALLING_EDGE: None }
+        self.__edgeHistories = { self.RISING_EDGE: deque(maxlen=self.EDGE_HISTORY_SIZE), self.FALLING_EDGE: deque(maxlen=self.EDGE_HISTORY_SIZE) }
+
+        # The broker connection is shared with every other sensor on the same IP
+        self.mqttHub = getMqttHub(ipAddress)
+        self.sensorClient = self.mqttHub.client
+        self.mqttHub.subscribe(self.mqtt_topic, self.__onMessage)
         
-        t0 = time.time()
         connection_timeout = 5 #timeout after 5 seconds
-        while self.connected==False:
-            if time.time()-t0 > connection_timeout:
-                raise self.timeoutException("system timeout during connection to to {}".format(self.name))
-                
-            time.sleep(0.2)
+        if not self.mqttHub.waitForConnection(connection_timeout):
+            raise self.timeoutException("system timeout during connection to to {}".format(self.name))
 
+        self.connected=True
+        log.info(self.name + " connected to pin " + str(self.pin))
+
+    
+    def close(self):
+        self.mqttHub.unsubscribe(self.mqtt_topic, self.__onMessage)
     
     def register_on_rising_edge(self, cb):
         self._on_rising_edge_cb = cb
@@ -78,40 +109,78 @@ class Sensor():
         self._on_falling_edge_cb = cb
     def register_on_value_change(self, cb):
         self._on_state_change_cb = cb
+
+    def get_edge_count(self, kind):
+        ''' Returns the number of edges of a kind (RISING_EDGE or FALLING_EDGE) seen since the sensor was created '''
+        with self.__condition:
+            return self.__edgeCounts[kind]
+
+    def get_rising_edge_count(self):
+        return self.get_edge_count(self.RISING_EDGE)
+
+    def get_falling_edge_count(self):
+        return self.get_edge_count(self.FALLING_EDGE)
+
+    def get_last_edge(self, kind):
+        ''' Returns the last EdgeEvent of a kind, or None if there was none yet '''
+        with self.__condition:
+            return self.__lastEdges[kind]
+
+    def wait_for_edge_count(self, kind, count, timeout = None):
+        '''
+        Blocks until at least 'count' edges of a kind have been seen since the sensor was created.
+        Combined with get_edge_count, this lets a caller wait for the next edge without missing any:
+
+            count = sensor.get_rising_edge_count()
+            ... start something ...
+            sensor.wait_for_edge_count(Sensor.RISING_EDGE, count + 1)
+
+        Returns the last EdgeEvent of that kind, and raises timeoutException on timeout.
+        '''
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__edgeCounts[kind] >= count, timeout):
+                raise self.timeoutException("system timeout wait_for_{}_edge {}".format(kind, self.name))
+            return self.__lastEdges[kind]
+
+    def __consume_edge(self, kind):
+        ''' Marks the oldest unconsumed edge of a kind as consumed and returns its EdgeEvent. Must hold the condition. '''
+        history = self.__edgeHistories[kind]
+        oldestKeptCount = self.__edgeCounts[kind] - len(history) + 1
+        if self.__consumedCounts[kind] + 1 < oldestKeptCount:
+            log.warning("{} missed {} {} edges that were no longer kept".format(
+                self.name, oldestKeptCount - self.__consumedCounts[kind] - 1, kind))
+            self.__consumedCounts[kind] = oldestKeptCount - 1
+
+        self.__consumedCounts[kind] += 1
+        return history[self.__consumedCounts[kind] - oldestKeptCount]
+
+    def __wait_for_unseen_edge(self, kind, timeout):
+        with self.__condition:
+            self.wait_for_edge_count(kind, self.__consumedCounts[kind] + 1, timeout)
+            return self.__consume_edge(kind)
         
-    #Returns true after rising edge has been detected
+    #Returns after a rising edge has been detected, with the corresponding EdgeEvent.
+    #Each call consumes one edge: if several edges were seen since the last call, the
+    #next calls return them one by one, oldest first, without waiting.
     def wait_for_rising_edge(self, timeout = None):
         print("{} waiting for rising edge\n\t{}".format(self.name, self.mqtt_topic))
-        #Wait for the rising edge flag to trigger True. 
-        t0 = time.time()
-        while self._on_rising_edge_flag == False:
-            if timeout is not None and time.time()-t0 > timeout:
-                raise self.timeoutException("system timeout wait_for_rising_edge {}".format(self.name))
-            time.sleep(0.5)
-        self._on_rising_edge_flag = False
-        return
+        return self.__wait_for_unseen_edge(self.RISING_EDGE, timeout)
     
     def wait_for_falling_edge(self, timeout = None):
-        #Wait for the rising edge flag to trigger True. 
-        t0 = time.time()
-        while self._on_falling_edge_flag == False:
-            if timeout is not None and time.time()-t0 > timeout:
-                raise Exception("system timeout wait_for_falling_edge {}".format(self.name))
-            time.sleep(0.5)
-        self._on_falling_edge_flag = False
-        return
+        return self.__wait_for_unseen_edge(self.FALLING_EDGE, timeout)
+
+    def __seen_edge(self, kind):
+        with self.__condition:
+            if self.__edgeCounts[kind] > self.__consumedCounts[kind]:
+                self.__consume_edge(kind)
+                return True
+            return False
     
     def seen_rising_edge(self):
-        if self._on_rising_edge_flag:
-            self._on_rising_edge_flag = False
-            return True
-        return False
+        return self.__seen_edge(self.RISING_EDGE)
 
     def seen_falling_edge(self):
-        if self._on_falling_edge_flag:
-            self._on_falling_edge_flag = False
-            return True
-        return False
+        return self.__seen_edge(self.FALLING_EDGE)
 
 # example code
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+import threading
+import time
+from internal.controller_registry import ControllerFanOutError, ControllerRegistry
+
+class StandInController:
+    ''' Implements the parts of MachineMotion used by the registry '''
+    def __init__(self, failWith=None):
+        self.failWith = failWith
+        self.estopCount = 0
+        self.estopped = False
+        self.eStopCallback = None
+        self.estopEvent = threading.Event()
+
+    def bindeStopEvent(self, callback):
+        self.eStopCallback = callback
+
+    def isEstopped(self):
+        return self.estopped
+
+    def triggerEstop(self):
+        if self.failWith != None:
+            raise self.failWith
+
+        self.estopCount += 1
+        self.setEstopped(True)
+        self.estopEvent.set()
+        return True
+
+    def releaseEstop(self):
+        self.setEstopped(False)
+        return True
+
+    def setEstopped(self, isEstopped):
+        ''' What the MQTT thread of the controller does when the estop status changes '''
+        self.estopped = isEstopped
+        if self.eStopCallback != None:
+            self.eStopCallback(isEstopped)
+
+def createRegistry(names, **kwargs):
+    registry = ControllerRegistry(**kwargs)
+    controllers = { name: StandInController() for name in names }
+    for name in names:
+        registry.register(name, controllers[name])
+    return registry, controllers
+
+def test_estop_fans_out_to_every_controller():
+    registry, controllers = createRegistry([ 'master', 'conveyor', 'robot' ])
+    try:
+        result = registry.triggerEstop()
+
+        assert result.isOk()
+        assert list(result.getValues().items()) == [ ('master', True), ('conveyor', True), ('robot', True) ]
+        assert all(controller.estopCount == 1 for controller in controllers.values())
+    finally:
+        registry.shutdown()
+
+def test_fan_out_reports_each_failure():
+    registry, controllers = createRegistry([ 'master', 'conveyor' ])
+    controllers['conveyor'].failWith = Exception('unreachable')
+    try:
+        result = registry.triggerEstop()
+
+        assert not result.isOk()
+        assert result.results['master'].value == True
+        assert str(result.getErrors()['conveyor']) == 'unreachable'
+
+        try:
+            result.raiseIfFailed()
+            assert False, 'raiseIfFailed did not raise'
+        except ControllerFanOutError as error:
+            assert 'conveyor: unreachable' in str(error)
+    finally:
+        registry.shutdown()
+
+def test_estop_on_one_controller_is_propagated_once():
+    registry, controllers = createRegistry([ 'master', 'conveyor', 'robot' ])
+    events = []
+    registry.bindeStopEvent(events.append)
+    try:
+        controllers['conveyor'].setEstopped(True)
+
+        assert controllers['master'].estopEvent.wait(5)
+        assert controllers['robot'].estopEvent.wait(5)
+        time.sleep(0.1)
+
+        assert controllers['conveyor'].estopCount == 0          # Already estopped on its own
+        assert controllers['master'].estopCount == 1
+        assert controllers['robot'].estopCount == 1
+        assert events == [ True ]
+        assert registry.isEstopped()
+    finally:
+        registry.shutdown()
+
+def test_estop_is_only_reported_when_propagation_is_disabled():
+    registry, controllers = createRegistry([ 'master', 'conveyor' ], propagateEstop=False)
+    events = []
+    registry.bindeStopEvent(events.append)
+    try:
+        controllers['conveyor'].setEstopped(True)
+        time.sleep(0.1)
+
+        assert controllers['master'].estopCount == 0
+        assert events == [ True ]
+    finally:
+        registry.shutdown()
+
+def test_release_is_reported_once_no_controller_is_estopped():
+    registry, controllers = createRegistry([ 'master', 'conveyor' ], propagateEstop=False)
+    events = []
+    registry.bindeStopEvent(events.append)
+    try:
+        controllers['master'].setEstopped(True)
+        controllers['conveyor'].setEstopped(True)
+        controllers['master'].setEstopped(False)
+        assert events == [ True ]
+
+        controllers['conveyor'].setEstopped(False)
+        assert events == [ True, False ]
+    finally:
+        registry.shutdown()
+
+def test_controllers_registered_later_are_bound():
+    registry, controllers = createRegistry([ 'master' ])
+    events = []
+    registry.bindeStopEvent(events.append)
+    late = StandInController()
+    registry.register('late', late)
+    try:
+        late.setEstopped(True)
+
+        assert controllers['master'].estopEvent.wait(5)
+        assert events == [ True ]
+    finally:
+        registry.shutdown()
@@ -0,0 +1,67 @@
+import pytest
+
+# machine_motion connects through the MQTT hub, which needs paho-mqtt
+pytest.importorskip('paho.mqtt.client')
+from internal.machine_motion import MotionProgram
+
+def test_moves_on_different_axes_are_fused():
+    program = MotionProgram().emitSpeed(10).emitAbsoluteMove(1, 100).emitAbsoluteMove(2, 50)
+
+    lines, state = program.compile()
+    assert lines == [ 'G90', 'G0 X100 Y50 F600' ]
+    assert state == { 'positioning': 'G90', 'feedrate': 600, 'acceleration': None }
+
+def test_moves_on_the_same_axis_are_not_fused():
+    lines, _ = MotionProgram().emitAbsoluteMove(1, 100).emitAbsoluteMove(1, 50).compile()
+    assert lines == [ 'G90', 'G0 X100', 'G0 X50' ]
+
+def test_positioning_change_ends_the_fused_move():
+    program = MotionProgram().emitAbsoluteMove(1, 100).emitAbsoluteMove(2, 50).emitRelativeMove(3, 'negative', 5)
+
+    lines, state = program.compile()
+    assert lines == [ 'G90', 'G0 X100 Y50', 'G91', 'G0 Z-5' ]
+    assert state['positioning'] == 'G91'
+
+def test_speed_change_ends_the_fused_move():
+    program = MotionProgram().emitSpeed(10).emitAbsoluteMove(1, 100).emitSpeed(20).emitAbsoluteMove(2, 50)
+
+    lines, state = program.compile()
+    assert lines == [ 'G90', 'G0 X100 F600', 'G0 Y50 F1200' ]
+    assert state['feedrate'] == 1200
+
+def test_unchanged_speed_does_not_end_the_fused_move():
+    program = MotionProgram().emitSpeed(10).emitAbsoluteMove(1, 100).emitSpeed(10).emitAbsoluteMove(2, 50)
+
+    lines, _ = program.compile()
+    assert lines == [ 'G90', 'G0 X100 Y50 F600' ]
+
+def test_acceleration_is_sent_before_the_move():
+    program = MotionProgram().emitAcceleration(500).emitAbsoluteMove(1, 100)
+
+    lines, state = program.compile()
+    assert lines == [ 'M204 T500', 'G90', 'G0 X100' ]
+    assert state['acceleration'] == 500
+
+def test_known_modal_state_is_not_sent_again():
+    program = MotionProgram().emitSpeed(10).emitAbsoluteMove(1, 100)
+
+    lines, _ = program.compile({ 'positioning': 'G90', 'feedrate': 600 })
+    assert lines == [ 'G0 X100' ]
+
+def test_break_merge_and_merge_disabled():
+    lines, _ = MotionProgram().emitAbsoluteMove(1, 100).breakMerge().emitAbsoluteMove(2, 50).compile()
+    assert lines == [ 'G90', 'G0 X100', 'G0 Y50' ]
+
+    lines, _ = MotionProgram(mergeMoves=False).emitAbsoluteMove(1, 100).emitAbsoluteMove(2, 50).compile()
+    assert lines == [ 'G90', 'G0 X100', 'G0 Y50' ]
+
+def test_raw_gcode_forgets_the_modal_state():
+    program = MotionProgram().emitSpeed(10).emitAbsoluteMove(1, 100).emitgCode('M42 P1 S1').emitAbsoluteMove(2, 50)
+
+    lines, state = program.compile()
+    assert lines == [ 'G90', 'G0 X100 F600', 'M42 P1 S1', 'G90', 'G0 Y50' ]
+    assert state == { 'positioning': 'G90', 'feedrate': None, 'acceleration': None }
+
+def test_home_ends_the_fused_move():
+    lines, _ = MotionProgram().emitAbsoluteMove(1, 100).emitHome(2).emitAbsoluteMove(2, 50).compile()
+    assert lines == [ 'G90', 'G0 X100', 'G28 Y', 'G0 Y50' ]
@@ -0,0 +1,56 @@
+import pytest
+from internal.reply_parser import isAck, isMotionCompleted, parseAck, parseEndStops, parseMotionCompleted, parsePositions, ReplyParseError
+
+def httpReply(text):
+    return str(text.encode('utf-8'))          # What HTTPSend returns on python 3
+
+POSITIONS_REPLY = 'echo:M114\nX:152.30 Y:-4.50 Z:0.00 E:0.00 Count X:12184 Y:-360 Z:0\nok\n'
+END_STOPS_REPLY = 'echo:M119\nx_min: open \nx_max: TRIGGERED \ny_min: open \ny_max: open \nz_min: open \nz_max: open \nok\n'
+
+def test_is_ack():
+    assert isAck('echo:G90\nok\n')
+    assert not isAck('echo:G90\n')
+    assert not isAck('ok\n')
+    assert parseAck('echo:G90\nok\n').isAck
+
+@pytest.mark.parametrize('reply', [ POSITIONS_REPLY, httpReply(POSITIONS_REPLY) ])
+def test_parse_positions(reply):
+    result = parsePositions(reply)
+
+    assert result.isAck
+    assert result.positions == { 1: 152.3, 2: -4.5, 3: 0.0 }
+
+def test_parse_positions_not_acknowledged():
+    result = parsePositions('Error:Printer halted\n')
+
+    assert not result.isAck
+    assert result.positions == None
+
+def test_parse_positions_without_position():
+    with pytest.raises(ReplyParseError):
+        parsePositions('echo:M114\nok\n')
+
+@pytest.mark.parametrize('reply', [ END_STOPS_REPLY, httpReply(END_STOPS_REPLY) ])
+def test_parse_end_stops(reply):
+    result = parseEndStops(reply)
+
+    assert result.isAck
+    assert result.states == { 'x_min': 'open', 'x_max': 'TRIGGERED', 'y_min': 'open', 'y_max': 'open', 'z_min': 'open', 'z_max': 'open' }
+
+def test_parse_end_stops_missing_one():
+    with pytest.raises(ReplyParseError):
+        parseEndStops(END_STOPS_REPLY.replace('z_max: open \n', ''))
+
+@pytest.mark.parametrize('reply, expected', [
+    (httpReply('echo:V0\nCOMPLETED\nok\n'), True),
+    (httpReply('echo:V0\nPROCESSING\nok\n'), False),
+    ('Error:Printer halted\n', None)
+])
+def test_is_motion_completed(reply, expected):
+    assert isMotionCompleted(reply) is expected
+
+def test_parse_motion_completed_matches_the_fast_path():
+    for reply in [ 'echo:V0\nCOMPLETED\nok\n', 'echo:V0\nPROCESSING\nok\n', 'Error\n' ]:
+        result = parseMotionCompleted(reply)
+        assert result.isAck == (isMotionCompleted(reply) is not None)
+        assert result.isCompleted == (isMotionCompleted(reply) == True)
@@ -0,0 +1,76 @@
+from internal.state_profiler import RollingHistogram, StateProfiler
+
+def test_rolling_histogram_keeps_the_window_and_the_totals():
+    histogram = RollingHistogram(3)
+    for seconds in [ 0.001, 0.002, 0.003, 0.004 ]:
+        histogram.add(seconds)
+
+    summary = histogram.getSummary()
+    assert summary['count'] == 4
+    assert abs(summary['totalMs'] - 10.0) < 1e-9
+    assert summary['windowCount'] == 3
+    assert abs(summary['minMs'] - 2.0) < 1e-9
+    assert abs(summary['maxMs'] - 4.0) < 1e-9
+    assert abs(summary['lastMs'] - 4.0) < 1e-9
+    assert abs(summary['p50Ms'] - 3.0) < 1e-9
+
+def test_empty_histogram_only_has_totals():
+    assert RollingHistogram(3).getSummary() == { 'count': 0, 'totalMs': 0.0 }
+
+def test_phases_are_recorded_per_state():
+    profiler = StateProfiler()
+    profiler.recordPhase('Clamp', StateProfiler.ON_ENTER, 0.002)
+    profiler.recordPhase('Clamp', StateProfiler.UPDATE, 0.001)
+    profiler.recordPhase('Clamp', StateProfiler.UPDATE, 0.003)
+
+    clamp = profiler.getReport()['states']['Clamp']
+    assert clamp[StateProfiler.ON_ENTER]['count'] == 1
+    assert clamp[StateProfiler.UPDATE]['count'] == 2
+    assert abs(clamp[StateProfiler.UPDATE]['meanMs'] - 2.0) < 1e-9
+    assert clamp[StateProfiler.ON_LEAVE]['count'] == 0
+
+def test_transitions_dwell_and_cycles():
+    profiler = StateProfiler()
+    profiler.onRunStarted('Home')
+
+    profiler.recordTransition('Idle', 'Home', 10.0)       # First transition of the run: recorded as coming from None
+    profiler.recordTransition('Home', 'Cut', 10.5)
+    profiler.recordTransition('Cut', 'Home', 12.0)
+    profiler.recordTransition('Home', 'Cut', 12.5)
+    profiler.recordTransition('Cut', 'Home', 15.0)
+
+    report = profiler.getReport()
+    transitions = { (transition['from'], transition['to']): transition['count'] for transition in report['transitions'] }
+    assert transitions == { (None, 'Home'): 1, ('Home', 'Cut'): 2, ('Cut', 'Home'): 2 }
+
+    assert report['cycleStartState'] == 'Home'
+    assert report['cycle']['count'] == 2
+    assert abs(report['cycle']['minMs'] - 2000.0) < 1e-6
+    assert abs(report['cycle']['maxMs'] - 3000.0) < 1e-6
+
+    assert report['states']['Home'][StateProfiler.DWELL]['count'] == 2
+    assert abs(report['states']['Cut'][StateProfiler.DWELL]['maxMs'] - 2500.0) < 1e-6
+    assert not 'Idle' in report['states']
+
+def test_a_new_run_drops_the_cycle_in_progress():
+    profiler = StateProfiler()
+    profiler.onRunStarted('Home')
+    profiler.recordTransition(None, 'Home', 0.0)
+
+    profiler.onRunStarted('Home')
+    profiler.recordTransition('Cut', 'Home', 100.0)
+    profiler.recordTransition('Home', 'Home', 101.0)
+
+    assert profiler.getReport()['cycle']['count'] == 1
+    assert abs(profiler.getReport()['cycle']['maxMs'] - 1000.0) < 1e-6
+
+def test_reset():
+    profiler = StateProfiler()
+    profiler.recordPhase('Clamp', StateProfiler.UPDATE, 0.001)
+    profiler.recordTransition(None, 'Clamp', 0.0)
+    profiler.reset()
+
+    report = profiler.getReport()
+    assert report['states'] == {}
+    assert report['transitions'] == []
+    assert report['cycle']['count'] == 0
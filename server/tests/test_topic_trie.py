@@ -0,0 +1,83 @@
+from internal.topic_trie import TopicTrie
+
+def match(trie, topic):
+    return trie.match(topic.split('/'))
+
+def test_exact_filter_only_matches_its_topic():
+    trie = TopicTrie()
+    trie.add('estop/status', 'estop')
+
+    assert match(trie, 'estop/status') == ['estop']
+    assert match(trie, 'estop/status/extra') == []
+    assert match(trie, 'estop') == []
+
+def test_single_level_wildcard():
+    trie = TopicTrie()
+    trie.add('devices/io-expander/+/digital-input/+', 'io')
+
+    assert match(trie, 'devices/io-expander/1/digital-input/3') == ['io']
+    assert match(trie, 'devices/io-expander/1/digital-input') == []
+    assert match(trie, 'devices/io-expander/1/digital-input/3/extra') == []
+
+def test_multi_level_wildcard_matches_its_parent_level():
+    trie = TopicTrie()
+    trie.add('devices/#', 'devices')
+
+    assert match(trie, 'devices') == ['devices']
+    assert match(trie, 'devices/encoder/1/realtime-position') == ['devices']
+    assert match(trie, 'estop/status') == []
+
+def test_every_matching_filter_is_returned_once():
+    trie = TopicTrie()
+    trie.add('devices/io-expander/1/digital-input/0', 'callback')
+    trie.add('devices/io-expander/+/digital-input/+', 'callback')
+    trie.add('devices/#', 'other')
+    trie.add('#', 'all')
+
+    assert sorted(match(trie, 'devices/io-expander/1/digital-input/0')) == ['all', 'callback', 'other']
+
+def test_wildcards_do_not_match_system_topics():
+    trie = TopicTrie()
+    trie.add('#', 'all')
+    trie.add('+/broker', 'single')
+    trie.add('$SYS/broker', 'system')
+
+    assert match(trie, '$SYS/broker') == ['system']
+
+def test_remove_is_reference_counted():
+    trie = TopicTrie()
+    assert trie.add('devices/+/1', 'callback') == True
+    assert trie.add('devices/+/1', 'callback') == False
+
+    assert trie.remove('devices/+/1', 'callback') == False
+    assert match(trie, 'devices/encoder/1') == ['callback']
+
+    assert trie.remove('devices/+/1', 'callback') == True
+    assert match(trie, 'devices/encoder/1') == []
+    assert len(trie) == 0
+
+def test_remove_keeps_the_other_values_of_a_filter():
+    trie = TopicTrie()
+    trie.add('estop/#', 'first')
+    trie.add('estop/#', 'second')
+
+    assert trie.remove('estop/#', 'first') == False
+    assert match(trie, 'estop/status') == ['second']
+    assert trie.getFilters() == ['estop/#']
+
+def test_remove_unknown_filter_or_value():
+    trie = TopicTrie()
+    trie.add('estop/status', 'callback')
+
+    assert trie.remove('estop/other', 'callback') == False
+    assert trie.remove('estop/status', 'unknown') == False
+    assert match(trie, 'estop/status') == ['callback']
+
+def test_removed_branches_are_pruned():
+    trie = TopicTrie()
+    trie.add('a/b/c', 'deep')
+    trie.add('a', 'shallow')
+    trie.remove('a/b/c', 'deep')
+
+    assert trie.getFilters() == ['a']
+    assert len(trie) == 1